@@ -24,16 +24,23 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from os.path import join, basename
+from collections import Counter
+from os.path import join, basename, dirname, realpath, getmtime
+import json
 import os
+import shutil
 import subprocess
 
 import pwem
 import pyworkflow
-from pyworkflow.utils import Environ
+from pyworkflow.utils import Environ, strToBoolean
 from pyseg.constants import (PYSEG_HOME, PYSEG, PYSEG_SOURCE_URL, PYSEG_ENV_ACTIVATION,
                              DEFAULT_ACTIVATION_CMD, PYSEG_ENV_NAME, CFITSIO,
-                             DISPERSE, DEFAULT_VERSION)
+                             DISPERSE, DEFAULT_VERSION, THREAD_LIMIT_VARS, PYSEG_CPU_PLACEMENT, PYSEG_SCRATCH,
+                             PYSEG_ARTIFACTS, PYSEG_ENV_SPEC, PYSEG_PACKED_ENV, DISPERSE_TARBALL, DISPERSE_URL,
+                             COMPILER_CHECK_CACHE, PYSEG_VIEWER_MAX_CELLS, DEFAULT_VIEWER_MAX_CELLS, PYTHON,
+                             MEMORY_ERROR_EXIT_STATUS)
+from pyseg.placement import getCpuPlacer, formatCpuList
 
 _logo = "icon.png"
 _references = ['MartinezSanchez2020']
@@ -46,6 +53,10 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineVar(PYSEG_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
+        cls._defineVar(PYSEG_CPU_PLACEMENT, 'False')
+        cls._defineVar(PYSEG_SCRATCH, '')
+        cls._defineVar(PYSEG_ARTIFACTS, '')
+        cls._defineVar(PYSEG_VIEWER_MAX_CELLS, str(DEFAULT_VIEWER_MAX_CELLS))
         cls._defineEmVar(PYSEG_HOME, PYSEG + '-' + DEFAULT_VERSION)
 
     @classmethod
@@ -55,8 +66,9 @@ class Plugin(pwem.Plugin):
         return activation.replace(scipionHome, "", 1)
 
     @classmethod
-    def getEnviron(cls):
-        """ Set up the environment variables needed to launch pyseg. """
+    def getEnviron(cls, nThreads=None):
+        """ Set up the environment variables needed to launch pyseg. If nThreads is provided, the thread pools of the
+        numerical libraries (OpenMP, MKL, OpenBLAS) used by the launched process are limited to it. """
         environ = Environ(os.environ)
         pySegDir = cls.getHome()
 
@@ -66,6 +78,8 @@ class Plugin(pwem.Plugin):
                                            'pyseg_system-%s' % DEFAULT_VERSION.replace('v', ''),
                                            'code')
                         })
+        if nThreads:
+            environ.update({var: str(nThreads) for var in THREAD_LIMIT_VARS})
 
         return environ
 
@@ -80,6 +94,9 @@ class Plugin(pwem.Plugin):
         DISPERSE_INSTALLED = pattern % DISPERSE
         PYSEG_INSTALLED = pattern % PYSEG
         compErrMsg = cls._checkCompilingDrivers()
+        # Offline installation: the source tarballs and the packed environment are taken from a local directory
+        artifactsDir = cls.getVar(PYSEG_ARTIFACTS)
+        nProcs = cls._getBuildProcessors(env)
         disperseCompiledFiles = ['fieldconv', 'mse', 'netconv', 'skelconv']
         disperseCompiledFiles = [join(cls.getDisperseBuildPath(pysegHome), 'bin', binFile) for binFile in
                                  disperseCompiledFiles]
@@ -92,13 +109,18 @@ class Plugin(pwem.Plugin):
                                   DISPERSE.lower(), '0.9.24_pyseg_gcc7', 'sources')
 
             # PySeg Conda environment
-            genPySegCondaEnvCmd = cls._genCmdToDefineSegCondaEnv(CONDA_ENV_INSTALLED)
+            if artifactsDir:
+                genPySegCondaEnvCmd = cls._genCmdToUnpackSegCondaEnv(artifactsDir, CONDA_ENV_INSTALLED)
+            else:
+                genPySegCondaEnvCmd = cls._genCmdToDefineSegCondaEnv(CONDA_ENV_INSTALLED)
             # PySeg source code
-            getPySegCmd = cls._genCmdToGetPySegSrcCode(pysegHome, PYSEG_SRC_DL)
+            getPySegCmd = cls._genCmdToGetPySegSrcCode(pysegHome, PYSEG_SRC_DL, artifactsDir)
             # Third party software - CFitsIO
-            installCFitsIOCmd, cfitBuildPath = cls._genCmdToInstallCFitsIO(thirdPartyPath, pysegHome, CFITSIO_INSTALLED)
+            installCFitsIOCmd, cfitBuildPath = cls._genCmdToInstallCFitsIO(thirdPartyPath, pysegHome, CFITSIO_INSTALLED,
+                                                                           nProcs)
             # Third party software - disperse
-            installDisperseCmd = cls._genCmdToInstallDisperse(cfitBuildPath, pysegHome, DISPERSE_INSTALLED)
+            installDisperseCmd = cls._genCmdToInstallDisperse(cfitBuildPath, pysegHome, DISPERSE_INSTALLED, nProcs,
+                                                              artifactsDir)
             # Flag installation finished
             genFinalTargetCmd = 'cd %s && touch %s' % (pysegHome, PYSEG_INSTALLED)
             installationCmd = [(genPySegCondaEnvCmd, CONDA_ENV_INSTALLED),
@@ -115,8 +137,23 @@ class Plugin(pwem.Plugin):
                        default=True)
 
     @staticmethod
-    def _genCmdToGetPySegSrcCode(pySegDir, controlFile):
-        installationCmd = 'wget %s && ' % PYSEG_SOURCE_URL
+    def _genCmdToGetFile(url, artifactsDir=None):
+        """ Download the file from the given url or, in offline installations, copy it from the artifacts directory
+        to the current one. """
+        if artifactsDir:
+            return 'cp %s . && ' % join(artifactsDir, basename(url))
+        return 'wget %s && ' % url
+
+    @staticmethod
+    def _getBuildProcessors(env):
+        """ Number of make jobs: the processors requested to the installer (-j) or, if not requested, all the
+        available ones. """
+        nProcs = env.getProcessors() if hasattr(env, 'getProcessors') else 1
+        return nProcs if nProcs > 1 else (os.cpu_count() or 1)
+
+    @classmethod
+    def _genCmdToGetPySegSrcCode(cls, pySegDir, controlFile, artifactsDir=None):
+        installationCmd = cls._genCmdToGetFile(PYSEG_SOURCE_URL, artifactsDir)
         installationCmd += 'tar zxf %s --directory=%s && ' % (join(pySegDir, basename(PYSEG_SOURCE_URL)), pySegDir)
         installationCmd += 'rm -rf %s && ' % join(pySegDir, DEFAULT_VERSION + '.zip')  # rm downloaded file (>600 MB)
         installationCmd += 'cd %s && ' % pySegDir
@@ -124,30 +161,29 @@ class Plugin(pwem.Plugin):
         return installationCmd
 
     @classmethod
-    def _genCmdToInstallCFitsIO(cls, thirdPartyPath, pySegDir, controlFile):
+    def _genCmdToInstallCFitsIO(cls, thirdPartyPath, pySegDir, controlFile, nProcs=1):
         CFITSIO_BUILD_PATH = join(pySegDir, '%s_build' % CFITSIO)
         installationCmd = 'tar zxf %s --directory=%s && ' % (join(thirdPartyPath, 'cfitsio_3.380.tar.gz'), pySegDir)
         installationCmd += 'cd %s && ' % join(pySegDir, CFITSIO)
         installationCmd += 'mkdir %s && ' % CFITSIO_BUILD_PATH
         installationCmd += './configure --prefix=%s && ' % CFITSIO_BUILD_PATH
-        installationCmd += 'make && make install && '
+        installationCmd += 'make -j %i && make install && ' % nProcs
         installationCmd += 'cd %s && ' % pySegDir
         installationCmd += 'touch %s ' % controlFile
         return installationCmd, CFITSIO_BUILD_PATH
 
     @classmethod
-    def _genCmdToInstallDisperse(cls, CFITSIO_BUILD_PATH, pySegDir, controlFile):
+    def _genCmdToInstallDisperse(cls, CFITSIO_BUILD_PATH, pySegDir, controlFile, nProcs=1, artifactsDir=None):
         # Remove old disperse included in pyseg distribution
-        zipName = 'master.tar.gz'
         buildPath = join(pySegDir, f'{DISPERSE}-master')
         installationCmd = 'cd %s && rm -rf disperse* && ' % pySegDir
         # Get the latest disperse
-        installationCmd += 'wget https://github.com/thierry-sousbie/DisPerSE/archive/refs/heads/%s && ' % zipName
-        installationCmd += 'tar zxf %s --directory=%s && ' % (zipName, pySegDir)
+        installationCmd += cls._genCmdToGetFile(DISPERSE_URL, artifactsDir)
+        installationCmd += 'tar zxf %s --directory=%s && ' % (DISPERSE_TARBALL, pySegDir)
         installationCmd += 'cd %s && ' % buildPath
         installationCmd += 'cmake . -DCMAKE_INSTALL_PREFIX=%s -DCFITSIO_DIR=%s && ' \
                            % (cls.getDisperseBuildPath(pySegDir), CFITSIO_BUILD_PATH)
-        installationCmd += 'make && make install && '
+        installationCmd += 'make -j %i && make install && ' % nProcs
         installationCmd += 'cd %s && ' % pySegDir
         installationCmd += 'touch %s ' % controlFile
         return installationCmd
@@ -160,39 +196,109 @@ class Plugin(pwem.Plugin):
     def _genCmdToDefineSegCondaEnv(cls, controlFileName):
         installationCmd = cls.getCondaActivationCmd()
 
-        # Create the environment
-        installationCmd += 'conda create -y -n %s -c conda-forge -c anaconda python=3.7 ' \
-                           'opencv=4.2.0 ' \
-                           'graph-tool=2.29  ' \
-                           'future=0.18.2=py37_0 && ' % PYSEG_ENV_NAME
+        # Create the environment from its specification file, solving all the conda and pip packages at once. The pip
+        # packages are built with the pinned setuptools of the environment (required by pyfits)
+        installationCmd += 'export PIP_NO_BUILD_ISOLATION=0 && '
+        envSpec = join(dirname(__file__), PYSEG_ENV_SPEC)
+        installationCmd += 'conda env create -n %s -f %s && ' % (PYSEG_ENV_NAME, envSpec)
+        installationCmd += 'touch %s ' % controlFileName
+        return installationCmd
 
-        # Activate new the environment
+    @classmethod
+    def _genCmdToUnpackSegCondaEnv(cls, artifactsDir, controlFileName):
+        """ Unpack the environment packed with conda-pack in the artifacts directory into the conda envs directory.
+        """
+        installationCmd = cls.getCondaActivationCmd()
+        envDir = '$(conda info --base)/envs/%s' % PYSEG_ENV_NAME
+        installationCmd += 'mkdir -p %s && ' % envDir
+        installationCmd += 'tar zxf %s --directory=%s && ' % (join(artifactsDir, PYSEG_PACKED_ENV), envDir)
         installationCmd += 'conda activate %s && ' % PYSEG_ENV_NAME
-
-        # Install non-conda required packages
-        installationCmd += 'pip install "setuptools<58" && '
-        installationCmd += 'pip install beautifulsoup4==4.9.3 && '
-        installationCmd += 'pip install lxml==4.6.3 && '
-        installationCmd += 'pip install pillow==6.2.2 &&'
-        installationCmd += 'pip install pywavelets==1.1.1 &&'
-        installationCmd += 'pip install pyfits==3.5 && '
-        installationCmd += 'pip install scikit-image==0.14.5 && '
-        installationCmd += 'pip install scikit-learn==0.20.4 && '
-        installationCmd += 'pip install scikit-fmm==2021.2.2 && '
-        installationCmd += 'pip install scipy==1.2.1 && '
-        installationCmd += 'pip install vtk==8.1.2 && '
-        installationCmd += 'pip install astropy==4.1 &&'
-        installationCmd += 'pip install imageio==2.9.0 &&'
+        installationCmd += 'conda-unpack && '
         installationCmd += 'touch %s ' % controlFileName
         return installationCmd
 
     @classmethod
-    def runPySeg(cls, protocol, program, args, cwd=None):
-        """ Run pySeg command from a given protocol. """
-        fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
-                                       cls.getPysegEnvActivation(),
-                                       program)
-        protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
+    def runPySeg(cls, protocol, program, args, cwd=None, timeout=None, maxMemory=None, nJobs=1, outDir=None,
+                 keep=None):
+        """ Run pySeg command from a given protocol. If a timeout (seconds) or a maxMemory (GB) are provided, the
+        program will be killed when exceeding them, raising a CalledProcessError recognized by
+        pyseg.utils.isLimitExceeded (the memory limit applies to the resident memory of the program and all its
+        children, watched by a guard that kills them and exits with a known status when exceeded). nJobs is the
+        number of processes launched by the program (its -j), used to limit the threads of each of them so the thread
+        budget of the protocol is not exceeded. If the CPU placement is enabled (PYSEG_CPU_PLACEMENT), the program is
+        bound while running to as many CPUs as threads it may use, not used by any other program placed in the
+        node. If a scratch directory is configured (PYSEG_SCRATCH) and the
+        outputs to keep are provided (glob patterns relative to the output directory outDir of the program), the
+        program is run there and only those outputs are copied back to outDir."""
+        concurrentSteps, childThreads = cls.getThreadLimits(protocol, nJobs)
+        placement = cls._isCpuPlacementEnabled()
+        if not getattr(protocol, '_threadLimitsLogged', False):
+            protocol._threadLimitsLogged = True
+            protocol.info('pySeg processes: %i concurrent steps x %i jobs x %i threads (OpenMP/MKL/OpenBLAS) for a '
+                          'budget of %i threads%s' % (concurrentSteps, nJobs, childThreads,
+                                                      max(protocol.numberOfThreads.get(), 1),
+                                                      ', CPU placement enabled' if placement else ''))
+        limits = ''
+        if maxMemory:
+            from pyseg.engines import MEMORY_GUARD
+            limits += '%s %s %i %i ' % (PYTHON, MEMORY_GUARD, MEMORY_ERROR_EXIT_STATUS, maxMemory * 1024 ** 2)  # kB
+        if timeout:
+            limits += 'timeout --signal=KILL %i ' % timeout
+        cpus = None
+        if placement:
+            stepBudget = max(1, max(protocol.numberOfThreads.get(), 1) // concurrentSteps)
+            cpus = getCpuPlacer().acquire(min(stepBudget, max(nJobs, 1) * childThreads))
+            if cpus:
+                limits += 'taskset -c %s ' % formatCpuList(cpus)
+            else:
+                protocol.info('Not enough free CPUs to place %s, running it unbound.' % program)
+        fullProgram = '%s %s && %s%s' % (cls.getCondaActivationCmd(),
+                                         cls.getPysegEnvActivation(),
+                                         limits,
+                                         program)
+        scratch = cls.getVar(PYSEG_SCRATCH)
+        staging = None
+        if scratch and outDir and keep:
+            from pyseg.staging import ScratchStaging
+            staging = ScratchStaging(scratch, outDir, keep)
+        try:
+            if staging:
+                args = staging.start(args)
+            protocol.runJob(fullProgram, args, env=cls.getEnviron(nThreads=childThreads), cwd=cwd)
+            if staging:
+                staging.copyBack()
+        finally:
+            if cpus:
+                getCpuPlacer().release(cpus)
+            if staging:
+                staging.clean()
+
+    @classmethod
+    def getViewerMaxCells(cls):
+        """ Maximum number of cells of the graphs and filaments displayed at full detail by the vesicle viewer (0 means
+        no limit). """
+        try:
+            return max(int(cls.getVar(PYSEG_VIEWER_MAX_CELLS)), 0)
+        except (TypeError, ValueError):
+            return DEFAULT_VIEWER_MAX_CELLS
+
+    @classmethod
+    def _isCpuPlacementEnabled(cls):
+        return strToBoolean(cls.getVar(PYSEG_CPU_PLACEMENT)) and shutil.which('taskset') is not None
+
+    @staticmethod
+    def getThreadLimits(protocol, nJobs=1):
+        """Number of steps of the protocol that may run at the same time, as done by the Scipion steps executor,
+        and threads available to each of the nJobs processes launched by each step. In parallel mode, the executor
+        runs up to the number of threads minus one steps at the same time, but not more than the steps of the same
+        kind inserted by the protocol, so a sole step is given the whole budget."""
+        nThreads = max(protocol.numberOfThreads.get(), 1)
+        concurrentSteps = 1
+        if protocol.modeParallel() and nThreads > 1:
+            stepCounts = Counter(str(step.funcName) for step in getattr(protocol, '_steps', [])
+                                 if getattr(step, 'funcName', None) is not None)
+            concurrentSteps = min(nThreads - 1, max(stepCounts.values())) if stepCounts else nThreads - 1
+        return concurrentSteps, max(1, nThreads // (concurrentSteps * max(nJobs, 1)))
 
     @staticmethod
     def _getCompilerVer(compiler=None):
@@ -200,6 +306,34 @@ class Plugin(pwem.Plugin):
         result = result.stdout.decode()
         return int(result.strip().split(".")[0])
 
+    @staticmethod
+    def _getCompilerVersions(compilers):
+        """ Get the major version of the given compilers. The result is cached in the EM root, keyed by the
+        location and modification time of the compiler executables, so the compilers are only queried again when they
+        change. """
+        paths = [shutil.which(compiler) for compiler in compilers]
+        if not all(paths):
+            return [Plugin._getCompilerVer(compiler=compiler) for compiler in compilers]
+
+        paths = [realpath(path) for path in paths]
+        key = ';'.join('%s:%s' % (path, getmtime(path)) for path in paths)
+        cacheFile = join(pwem.Config.EM_ROOT, COMPILER_CHECK_CACHE)
+        try:
+            with open(cacheFile) as f:
+                cache = json.load(f)
+            if cache.get('key') == key:
+                return cache['versions']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        versions = [Plugin._getCompilerVer(compiler=compiler) for compiler in compilers]
+        try:
+            with open(cacheFile, 'w') as f:
+                json.dump({'key': key, 'versions': versions}, f)
+        except OSError:
+            pass  # The cache is just an optimization
+        return versions
+
     @staticmethod
     def _checkCompilingDrivers():
         compMsg = ''
@@ -207,8 +341,7 @@ class Plugin(pwem.Plugin):
         GPP = 'g++'
         minVer = 5
         maxVer = 12
-        gccVersion = Plugin._getCompilerVer(compiler=GCC)
-        gppVersion = Plugin._getCompilerVer(compiler=GPP)
+        gccVersion, gppVersion = Plugin._getCompilerVersions([GCC, GPP])
         if gccVersion != gppVersion or (gccVersion == gppVersion and (gccVersion < minVer or gccVersion > maxVer)):
             compMsg = '%s-%i detected. ' \
                       '%s-%i detected. ' \
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Headless batch runner of the pySeg picking chain (preseg membranes, graphs, fils and picking) on many datasets.
+
+Usage::
+
+    scipion3 python -m pyseg.batch manifest.json [-j MAX_CONCURRENT] [--project NAME]
+
+The manifest is a JSON file with the parameter profiles of each protocol of the chain and the datasets to be
+processed, each one referring to a profile::
+
+    {
+        "profiles": {
+            "default": {
+                "preseg": {"spOffVoxels": 22, "sgMembThk": 60, "sgMembNeigh": 330},
+                "graphs": {"vesiclePkgSize": 3, "maxLen": 330},
+                "fils": {"segLabelS": 0, "segLabelT": 2, "gRgEud": "1 30", "gRgLen": "1 60", "gRgSin": "0 2"},
+                "picking": {"side": 2, "cont": 1}
+            }
+        },
+        "datasets": [
+            {"name": "emd_10439", "tomograms": "/data/emd_10439/*.mrc", "samplingRate": 27.36,
+             "tomomasks": "/data/emd_10439/masks/*.mrc", "profile": "default"}
+        ]
+    }
+
+The chains are run in the same project, with at most MAX_CONCURRENT chains at the same time, and the throughput
+(vesicles and picked particles per hour) is reported when all of them are done.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from pyworkflow.project import Manager
+from pyseg.protocols import ProtPySegPreSegParticles, ProtPySegGraphs, ProtPySegFils, ProtPySegPicking
+from pyseg.protocols.protocol_pre_seg import outputObjects as presegOutputs
+from pyseg.protocols.protocol_picking import outputObjects as pickingOutputs
+from tomo.protocols import ProtImportTomograms, ProtImportTomomasks
+from tomo.protocols.protocol_import_tomomasks import importTomoMasksOutputs
+
+logger = logging.getLogger(__name__)
+
+# Manifest sections
+PROFILES = 'profiles'
+DATASETS = 'datasets'
+DATASET_KEYS = ['name', 'tomograms', 'samplingRate', 'tomomasks']
+DEFAULT_PROFILE = 'default'
+
+# Chain stages: name (profile key), protocol class and function returning its input parameters from the previous
+# protocol of the chain
+CHAIN = [
+    ('importTomograms', ProtImportTomograms,
+     lambda dataset, prev: {'filesPath': dataset['tomograms'], 'samplingRate': dataset['samplingRate']}),
+    ('importTomomasks', ProtImportTomomasks,
+     lambda dataset, prev: {'filesPath': dataset['tomomasks'], 'inputTomos': getattr(prev, 'Tomograms')}),
+    ('preseg', ProtPySegPreSegParticles,
+     lambda dataset, prev: {'inTomoMasks': getattr(prev, importTomoMasksOutputs.tomomasks.name)}),
+    ('graphs', ProtPySegGraphs, lambda dataset, prev: {'inSegProt': prev}),
+    ('fils', ProtPySegFils, lambda dataset, prev: {'inGraphsProt': prev}),
+    ('picking', ProtPySegPicking, lambda dataset, prev: {'inFilsProt': prev}),
+]
+
+# Seconds between consecutive checks of the running protocols
+POLL_TIME = 30
+
+
+class Chain:
+    """Protocol chain of a dataset, launched stage by stage as the previous protocol finishes."""
+
+    def __init__(self, project, dataset, profile):
+        self.project = project
+        self.dataset = dataset
+        self.profile = profile
+        self.name = dataset['name']
+        self.stage = -1
+        self.protocol = None
+        self.protocols = {}
+        self.failed = False
+        self.tStart = None
+        self.tEnd = None
+
+    def launchNext(self):
+        """Launch the next stage. Return False, marking the chain as failed, if it could not be launched."""
+        self.stage += 1
+        if self.tStart is None:
+            self.tStart = time.time()
+        stageName, protClass, getInputs = CHAIN[self.stage]
+        try:
+            params = dict(self.profile.get(stageName, {}))
+            params.update(getInputs(self.dataset, self.protocol))
+            self.protocol = self.project.newProtocol(protClass, **params)
+            self.protocol.setObjLabel('%s - %s' % (self.name, stageName))
+            self.project.launchProtocol(self.protocol)
+        except Exception as e:
+            self._fail('%s could not be launched: %s' % (stageName, e))
+            return False
+        self.protocols[stageName] = self.protocol
+        logger.info('%s: %s launched' % (self.name, stageName))
+        return True
+
+    def update(self):
+        """Check the current protocol, launching the next stage if it finished. Return True when the chain is
+        done, either because all its stages finished or because one of them failed."""
+        stageName = CHAIN[self.stage][0]
+        try:
+            self.protocol = self.project.getProtocol(self.protocol.getObjId())
+        except Exception as e:
+            self._fail('%s could not be checked: %s' % (stageName, e))
+            return True
+        self.protocols[stageName] = self.protocol
+        if self.protocol.isFailed() or self.protocol.isAborted():
+            self._fail('%s failed: %s' % (stageName, self.protocol.getErrorMessage()))
+            return True
+        if not self.protocol.isFinished():
+            return False
+        if self.stage < len(CHAIN) - 1:
+            return not self.launchNext()
+        self.tEnd = time.time()
+        return True
+
+    def _fail(self, msg):
+        logger.error('%s: %s' % (self.name, msg))
+        self.failed = True
+        self.tEnd = time.time()
+
+    def getResults(self):
+        """Number of vesicles and picked particles."""
+        vesicles = getattr(self.protocols.get('preseg'), presegOutputs.vesicles.name, None)
+        coordinates = getattr(self.protocols.get('picking'), pickingOutputs.coordinates.name, None)
+        return (vesicles.getSize() if vesicles is not None else 0,
+                coordinates.getSize() if coordinates is not None else 0)
+
+
+def loadManifest(manifestFile):
+    with open(manifestFile) as f:
+        manifest = json.load(f)
+    profiles = manifest.get(PROFILES, {})
+    datasets = manifest.get(DATASETS, [])
+    if not datasets:
+        raise ValueError('No datasets found in the manifest %s' % manifestFile)
+    names = set()
+    for dataset in datasets:
+        missing = [key for key in DATASET_KEYS if key not in dataset]
+        if missing:
+            raise ValueError('Dataset %s of the manifest has no %s' % (dataset.get('name', ''), ', '.join(missing)))
+        if dataset['name'] in names:
+            raise ValueError('Dataset %s is duplicated in the manifest' % dataset['name'])
+        names.add(dataset['name'])
+        profileName = dataset.get('profile', DEFAULT_PROFILE)
+        if profileName not in profiles:
+            raise ValueError('Profile %s of dataset %s not found in the manifest' % (profileName, dataset['name']))
+    return profiles, datasets
+
+
+def runChains(project, profiles, datasets, maxConcurrent=1, pollTime=POLL_TIME):
+    """Run the chain of each dataset, with at most maxConcurrent chains running at the same time. A chain whose
+    protocols can't be launched or checked is marked as failed, without stopping the others. Return the finished
+    chains."""
+    pending = [Chain(project, dataset, profiles[dataset.get('profile', DEFAULT_PROFILE)]) for dataset in datasets]
+    pending.reverse()
+    running, done = [], []
+    while pending or running:
+        while pending and len(running) < maxConcurrent:
+            chain = pending.pop()
+            # A chain whose first stage can't be launched is done, letting the next one take its place
+            (running if chain.launchNext() else done).append(chain)
+        if not running:
+            continue
+        time.sleep(pollTime)
+        project.getRuns(refresh=True)  # Update the protocols from their run databases
+        for chain in list(running):
+            if chain.update():
+                running.remove(chain)
+                done.append(chain)
+    return done
+
+
+def reportThroughput(chains, elapsedTime):
+    """Log the results of each chain and the overall throughput. Return the latter as a dictionary."""
+    totalVesicles = totalPicks = 0
+    for chain in chains:
+        nVesicles, nPicks = chain.getResults()
+        totalVesicles += nVesicles
+        totalPicks += nPicks
+        logger.info('%s: %s, %i vesicles, %i picks in %.1f min' %
+                    (chain.name, 'FAILED' if chain.failed else 'done', nVesicles, nPicks,
+                     (chain.tEnd - chain.tStart) / 60))
+    hours = elapsedTime / 3600
+    report = {'datasets': len(chains),
+              'failed': sum(chain.failed for chain in chains),
+              'hours': hours,
+              'vesicles': totalVesicles,
+              'picks': totalPicks,
+              'vesiclesPerHour': totalVesicles / hours if hours else 0,
+              'picksPerHour': totalPicks / hours if hours else 0}
+    logger.info('%(datasets)i datasets (%(failed)i failed) in %(hours).2f h: %(vesiclesPerHour).1f vesicles/hour, '
+                '%(picksPerHour).1f picks/hour' % report)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the pySeg picking chain on the datasets of a manifest.')
+    parser.add_argument('manifest', help='JSON file with the parameter profiles and the datasets')
+    parser.add_argument('-j', '--maxConcurrent', type=int, default=1,
+                        help='Maximum number of chains running at the same time')
+    parser.add_argument('--project', default='pysegBatch', help='Scipion project, created if it does not exist')
+    parser.add_argument('--pollTime', type=int, default=POLL_TIME,
+                        help='Seconds between consecutive checks of the running protocols')
+    parser.add_argument('--report', help='JSON file where the throughput report is written')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    profiles, datasets = loadManifest(args.manifest)
+    manager = Manager()
+    if manager.hasProject(args.project):
+        project = manager.loadProject(args.project)
+    else:
+        project = manager.createProject(args.project)
+    tStart = time.time()
+    chains = runChains(project, profiles, datasets, maxConcurrent=max(1, args.maxConcurrent),
+                       pollTime=args.pollTime)
+    report = reportThroughput(chains, time.time() - tStart)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Plugin overhead benchmark: it runs every protocol of the plugin on synthetic datasets of increasing number of
+vesicles, calling the pySeg stand-in scripts (see pyseg.standins) instead of pySeg, and reports the time spent in
+each step function (phase) and how it scales with the number of vesicles.
+
+Usage::
+
+    scipion3 python -m pyseg.benchmark [--sizes 10 100 1000 10000] [--project NAME] [--workDir DIR] [-j THREADS]
+                                       [--report FILE]
+    scipion3 python -m pyseg.benchmark --calibrateGraphs PRESEG_RUN_ID --project NAME [--calibrationVesicles N]
+
+For each protocol, the report contains its wall time, the time of its steps, grouped by step function, and the time
+spent in the stand-in scripts, so the difference between the latter two is the plugin overhead (conversions, star
+files splitting and merging, links, output sets creation, process launching...). The scaling exponent is the slope
+of the log-log fit of the time versus the number of vesicles, so 1 means linear scaling.
+
+With --calibrateGraphs, the real pySeg graphs script is profiled instead on the vesicles of a finished preseg run and
+the graphs cost model used by the graphs cost estimation wizard is fitted on the measurements.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+from os.path import join, abspath, dirname
+
+import numpy as np
+
+from pyseg.constants import PYSEG_HOME, PYSEG_ENV_ACTIVATION
+from pyseg.standins import installStandIns, readStandInLog, STANDIN_LOG_VAR
+from pyseg.engines.engine_io import writeVolume, writeStar
+
+logger = logging.getLogger(__name__)
+
+SIZES = [10, 100, 1000, 10000]
+
+# Synthetic data
+SAMPLING_RATE = 13.68
+VESICLES_PER_TOMO = 100
+VESICLE_SPACING = 12  # Voxels between the centers of consecutive vesicles in the tomogram grid
+VESICLE_SIZE = 4  # Voxels of each side of the labelled vesicle in the tomomask
+PARTICLE_BOX = 16
+GRAPHS_PKG_SIZE = 10
+
+# Graphs cost model calibration
+CALIBRATION_VESICLES = 10
+CALIBRATION_SSIGS = [1, 1.5, 2]
+CALIBRATION_VDENS = [0.0035, 0.00175]
+CALIBRATION_VRATIO = 4
+
+TOMOS_DIR = 'tomograms'
+MASKS_DIR = 'tomomasks'
+PARTICLES_DIR = 'particles'
+PARTICLES_STAR = 'particles.star'
+PARTICLE_MASK = 'particleMask.mrc'
+MEMBRANE_MASK = 'membraneMask.mrc'
+PARTICLE_LABELS = ['rlnMicrographName', 'rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ', 'rlnImageName',
+                   'rlnCtfImage', 'rlnMagnification', 'rlnDetectorPixelSize', 'rlnAngleRot', 'rlnAngleTilt',
+                   'rlnAngleTiltPrior', 'rlnAnglePsi', 'rlnAnglePsiPrior']
+
+
+# --------------------------- Synthetic data -----------------------------------
+def genSyntheticData(dataDir, nVesicles, vesiclesPerTomo=VESICLES_PER_TOMO, seed=0):
+    """Generate the tomograms and tomomasks, with the vesicles labelled in a grid, and a particle (subtomogram) per
+    vesicle, with its star file and masks. Return a dictionary with the generated data."""
+    rng = np.random.default_rng(seed)
+    data = {'dir': dataDir, 'nVesicles': nVesicles, 'materials': {}}
+    for subDir in (TOMOS_DIR, MASKS_DIR, PARTICLES_DIR):
+        os.makedirs(join(dataDir, subDir), exist_ok=True)
+    particleRows = []
+    nTomos = math.ceil(nVesicles / vesiclesPerTomo)
+    for tomoInd in range(nTomos):
+        tsId = 'tomo_%03d' % (tomoInd + 1)
+        nTomoVesicles = min(vesiclesPerTomo, nVesicles - tomoInd * vesiclesPerTomo)
+        side = math.ceil(math.sqrt(nTomoVesicles))
+        mask = np.zeros((VESICLE_SPACING, side * VESICLE_SPACING, side * VESICLE_SPACING), dtype=np.float32)
+        z0 = (VESICLE_SPACING - VESICLE_SIZE) // 2
+        for label in range(1, nTomoVesicles + 1):
+            y0, x0 = [ind * VESICLE_SPACING + z0 for ind in divmod(label - 1, side)]
+            mask[z0:z0 + VESICLE_SIZE, y0:y0 + VESICLE_SIZE, x0:x0 + VESICLE_SIZE] = label
+            center = [c + VESICLE_SIZE / 2 for c in (x0, y0, z0)]
+            particleFile = abspath(join(dataDir, PARTICLES_DIR, '%s_%03d.mrc' % (tsId, label)))
+            writeVolume(rng.normal(size=(PARTICLE_BOX,) * 3), particleFile, voxelSize=SAMPLING_RATE)
+            particleRows.append([tsId + '.mrc'] + center + [particleFile, 'None', 10000, SAMPLING_RATE] +
+                                ['%.2f' % angle for angle in rng.uniform(0, 180, 5)])
+        tomoFile = join(dataDir, TOMOS_DIR, tsId + '.mrc')
+        writeVolume(rng.normal(size=mask.shape), tomoFile, voxelSize=SAMPLING_RATE)
+        writeVolume(mask, join(dataDir, MASKS_DIR, tsId + '_materials.mrc'), voxelSize=SAMPLING_RATE)
+        data['materials'][tsId] = list(range(1, nTomoVesicles + 1))
+    data['particlesStar'] = join(dataDir, PARTICLES_STAR)
+    writeStar(data['particlesStar'], PARTICLE_LABELS, particleRows)
+    # Particle mask (sphere) and membrane mask (slab perpendicular to z)
+    coords = np.indices((PARTICLE_BOX,) * 3) - (PARTICLE_BOX - 1) / 2
+    data['particleMask'] = join(dataDir, PARTICLE_MASK)
+    writeVolume(np.sqrt((coords ** 2).sum(axis=0)) < 0.4 * PARTICLE_BOX, data['particleMask'],
+                voxelSize=SAMPLING_RATE)
+    data['membraneMask'] = join(dataDir, MEMBRANE_MASK)
+    writeVolume(np.abs(coords[0]) < 2, data['membraneMask'], voxelSize=SAMPLING_RATE)
+    return data
+
+
+def writeMaterialsFiles(project, protImportTomomasks, data):
+    """Write the annotated materials file expected by preseg next to each imported tomomask, as the membrane
+    annotator does."""
+    from tomo.protocols.protocol_import_tomomasks import importTomoMasksOutputs
+    for tomoMask in getattr(protImportTomomasks, importTomoMasksOutputs.tomomasks.name):
+        materialsFile = os.path.splitext(project.getPath(tomoMask.getFileName()))[0] + '.txt'
+        with open(materialsFile, 'w') as f:
+            f.write(','.join(str(label) for label in data['materials'][tomoMask.getTsId()]) + '\n')
+
+
+# --------------------------- Protocols -----------------------------------
+def getBenchmarkRuns():
+    """Protocols run for each dataset: name, protocol class, function returning its parameters from the data, the
+    previous runs and the number of threads, and optional function called with the project, the protocol and the
+    data once it has finished."""
+    from pwem.protocols import ProtImportMask
+    from reliontomo.protocols import ProtImportSubtomogramsFromStar
+    from reliontomo.protocols.protocol_import_subtomograms_from_star import outputObjects as importSubtomoOutputs
+    from tomo.protocols import ProtImportTomograms, ProtImportTomomasks
+    from tomo.protocols.protocol_import_tomomasks import importTomoMasksOutputs
+    from pyseg.protocols import ProtPySegPreSegParticles, ProtPySegGraphs, ProtPySegFils, ProtPySegPicking, \
+        ProtPySegVesiclePipeline, ProtPySegPostRecParticles, ProtPySegPlaneAlignClassification, \
+        ProtPySegAssignToClasses
+    from pyseg.protocols.protocol_2d_classification import KMEANS
+    from pyseg.protocols.protocol_post_rec_particles import outputObjects as posRecOutputs
+
+    def _subtomos(runs):
+        return getattr(runs['posrec'], posRecOutputs.subtomograms.name)
+
+    return [
+        ('importTomograms', ProtImportTomograms,
+         lambda data, runs, j: {'filesPath': join(data['dir'], TOMOS_DIR), 'filesPattern': '*.mrc',
+                                'samplingRate': SAMPLING_RATE}, None),
+        ('importTomomasks', ProtImportTomomasks,
+         lambda data, runs, j: {'filesPath': join(data['dir'], MASKS_DIR), 'filesPattern': '*.mrc',
+                                'inputTomos': getattr(runs['importTomograms'], 'Tomograms')}, writeMaterialsFiles),
+        ('preseg', ProtPySegPreSegParticles,
+         lambda data, runs, j: {'inTomoMasks': getattr(runs['importTomomasks'],
+                                                       importTomoMasksOutputs.tomomasks.name),
+                                'spOffVoxels': 1, 'sgMembNeigh': 100}, None),
+        ('graphs', ProtPySegGraphs,
+         lambda data, runs, j: {'inSegProt': runs['preseg'], 'vesiclePkgSize': GRAPHS_PKG_SIZE, 'maxLen': 100,
+                                'numberOfThreads': j}, None),
+        ('fils', ProtPySegFils,
+         lambda data, runs, j: {'inGraphsProt': runs['graphs'], 'numberOfThreads': j}, None),
+        ('picking', ProtPySegPicking,
+         lambda data, runs, j: {'inFilsProt': runs['fils'], 'numberOfThreads': j}, None),
+        ('vesiclePipeline', ProtPySegVesiclePipeline,
+         lambda data, runs, j: {'inSegProt': runs['preseg'], 'maxLen': 100, 'numberOfThreads': j}, None),
+        ('importParticleMask', ProtImportMask,
+         lambda data, runs, j: {'maskPath': data['particleMask'], 'samplingRate': SAMPLING_RATE}, None),
+        ('importMembraneMask', ProtImportMask,
+         lambda data, runs, j: {'maskPath': data['membraneMask'], 'samplingRate': SAMPLING_RATE}, None),
+        ('importSubtomograms', ProtImportSubtomogramsFromStar,
+         lambda data, runs, j: {'starFile': data['particlesStar'],
+                                'inTomos': getattr(runs['importTomograms'], 'Tomograms'),
+                                'samplingRate': SAMPLING_RATE, 'boxSize': PARTICLE_BOX}, None),
+        ('posrec', ProtPySegPostRecParticles,
+         lambda data, runs, j: {'inputSubtomos': getattr(runs['importSubtomograms'],
+                                                         importSubtomoOutputs.subtomograms.name),
+                                'inMask': getattr(runs['importParticleMask'], 'outputMask'),
+                                'mbMask': getattr(runs['importMembraneMask'], 'outputMask'),
+                                'numberOfThreads': j}, None),
+        ('classification', ProtPySegPlaneAlignClassification,
+         lambda data, runs, j: {'inputSubtomos': _subtomos(runs),
+                                'inMask': getattr(runs['importParticleMask'], 'outputMask'),
+                                'clusteringAlg': KMEANS, 'aggNClusters': '10', 'numberOfThreads': j}, None),
+        ('assignClasses', ProtPySegAssignToClasses,
+         lambda data, runs, j: {'inputSubtomos': _subtomos(runs), 'classificationProt': runs['classification'],
+                                'numberOfThreads': j}, None),
+    ]
+
+
+def runBenchmark(project, data, nThreads=4, standInLog=None):
+    """Run the benchmark protocols on the given data. Return a dictionary with the timings of each protocol."""
+    runs = {}
+    results = {}
+    nVesicles = data['nVesicles']
+    for name, protClass, getParams, postRun in getBenchmarkRuns():
+        prot = project.newProtocol(protClass, **getParams(data, runs, nThreads))
+        prot.setObjLabel('%s - %i vesicles' % (name, nVesicles))
+        project.launchProtocol(prot, wait=True)
+        if not prot.isFinished():
+            logger.error('%s failed with %i vesicles: %s' % (name, nVesicles, prot.getErrorMessage()))
+            break
+        if postRun:
+            postRun(project, prot, data)
+        runs[name] = prot
+        results[name] = getProtocolTimings(project, prot, standInLog)
+        logger.info('%s (%i vesicles): %.1f s' % (name, nVesicles, results[name]['wall']))
+    return results
+
+
+def getProtocolTimings(project, prot, standInLog=None):
+    """Wall time of a finished protocol, time of its steps grouped by step function and time spent in the stand-in
+    scripts, in seconds."""
+    phases = {}
+    for step in prot.loadSteps():
+        phase = step.funcName.get()
+        phases[phase] = phases.get(phase, 0) + step.getElapsedTime().total_seconds()
+    workingDir = abspath(project.getPath(prot.getWorkingDir()))
+    scripts = sum(elapsed for _, outDir, elapsed in (readStandInLog(standInLog) if standInLog else [])
+                  if outDir.startswith(workingDir + os.sep) or outDir == workingDir)
+    steps = sum(phases.values())
+    return {'wall': prot.getElapsedTime().total_seconds(),
+            'steps': steps,
+            'scripts': scripts,
+            'overhead': steps - scripts,
+            'phases': phases}
+
+
+# --------------------------- Report -----------------------------------
+def getScalingExponent(sizes, times):
+    """Slope of the log-log least squares fit of the times versus the sizes."""
+    points = [(size, t) for size, t in zip(sizes, times) if t > 0]
+    if len(points) < 2:
+        return None
+    x, y = np.log(np.array(points, dtype=float)).T
+    return float(np.polyfit(x, y, 1)[0])
+
+
+def genReport(resultsBySize):
+    """Gather the timings of each size by protocol and phase, adding the scaling exponents."""
+    sizes = sorted(resultsBySize)
+    report = {'sizes': sizes, 'protocols': {}}
+    protNames = []
+    for size in sizes:
+        protNames += [name for name in resultsBySize[size] if name not in protNames]
+    for name in protNames:
+        protSizes = [size for size in sizes if name in resultsBySize[size]]
+        timings = [resultsBySize[size][name] for size in protSizes]
+        protReport = {'sizes': protSizes}
+        for key in ('wall', 'steps', 'scripts', 'overhead'):
+            values = [timing[key] for timing in timings]
+            protReport[key] = values
+            protReport[key + 'Exponent'] = getScalingExponent(protSizes, values)
+        phases = {}
+        for phase in {phase for timing in timings for phase in timing['phases']}:
+            values = [timing['phases'].get(phase, 0) for timing in timings]
+            phases[phase] = {'times': values, 'exponent': getScalingExponent(protSizes, values)}
+        protReport['phases'] = phases
+        report['protocols'][name] = protReport
+    return report
+
+
+def logReport(report):
+    def _fmtExp(exponent):
+        return '%5.2f' % exponent if exponent is not None else '    -'
+
+    for name, protReport in report['protocols'].items():
+        logger.info('%s (vesicles: %s)' % (name, ', '.join(str(size) for size in protReport['sizes'])))
+        for key in ('wall', 'steps', 'scripts', 'overhead'):
+            logger.info('    %-30s exp %s | %s' % (key, _fmtExp(protReport[key + 'Exponent']),
+                                                  ' '.join('%9.2f' % t for t in protReport[key])))
+        for phase, phaseReport in sorted(protReport['phases'].items()):
+            logger.info('    %-30s exp %s | %s' % ('  ' + phase, _fmtExp(phaseReport['exponent']),
+                                                  ' '.join('%9.2f' % t for t in phaseReport['times'])))
+
+
+def setStandInsEnviron(pysegHome, standInLog):
+    """Point the plugin to the stand-ins, run with the current Python, for the protocols launched from now on."""
+    os.environ[PYSEG_HOME] = pysegHome
+    os.environ[PYSEG_ENV_ACTIVATION] = 'export PATH=%s:$PATH' % dirname(sys.executable)
+    os.environ[STANDIN_LOG_VAR] = standInLog
+
+
+# --------------------------- Graphs cost model calibration -----------------------------------
+def calibrateGraphsCost(project, presegProt, workDir, sSigs=CALIBRATION_SSIGS, vDens=CALIBRATION_VDENS,
+                        nVesicles=CALIBRATION_VESICLES, vRatio=CALIBRATION_VRATIO):
+    """Fit the graphs cost model (see pyseg.utils) on real graphs runs. The pySeg graphs script is run with one thread
+    on each of nVesicles vesicles of a finished preseg protocol for each combination of sigma and vertex density,
+    measuring its wall time, its peak memory (including DisPerSE) and the disk used by its outputs and the DisPerSE
+    intermediate files. The fitted coefficients are stored in the EM root together with their provenance."""
+    import platform
+    from datetime import datetime
+    from emtable import Table
+    from pyseg import Plugin
+    from pyseg.constants import GRAPHS_SCRIPT, PYTHON, SEGMENTATION, DEFAULT_VERSION
+    from pyseg.convert.convert import splitPysegStarFile
+    from pyseg.protocols.protocol_pre_seg import outputObjects as presegOutputObjects
+    from pyseg.utils import getVesicleCostFeatures, getVesicleCostTerms, fitGraphsCostModel, getGraphsCostModelFile
+
+    projectDir = project.getPath()
+    presegStar = abspath(project.getPath(presegProt.getPresegOutputFile(presegProt.getVesiclesCenteredStarFile())))
+    pixSize = getattr(presegProt, presegOutputObjects.vesicles.name).getSamplingRate() / 10  # In nm
+    mbNeigh = presegProt.sgMembNeigh.get() / 10  # In nm
+    starDir = join(workDir, 'vesicles')
+    os.makedirs(starDir, exist_ok=True)
+    vesStars = splitPysegStarFile(presegStar, starDir, j=1, prefix='vesicle_')
+    vesStars = [vesStars[ind] for ind in np.unique(np.linspace(0, len(vesStars) - 1,
+                                                               min(nVesicles, len(vesStars))).astype(int))]
+    environ = Plugin.getEnviron(nThreads=1)
+    samples = []
+    for vesStar in vesStars:
+        segFile = Table(fileName=vesStar)[0].get(SEGMENTATION)
+        features = getVesicleCostFeatures(join(projectDir, segFile))
+        for sSig in sSigs:
+            for vDen in vDens:
+                outDir = join(workDir, 'runs', '%s_sSig%s_vDen%s' % (os.path.basename(vesStar)[:-5], sSig, vDen))
+                os.makedirs(outDir, exist_ok=True)
+                cmd = '%s %s && %s %s --inStar %s --outDir %s --pixelSize %s --sSig %s --vDen %s --veRatio %s ' \
+                      '--maxLen %s -j 1' % (Plugin.getCondaActivationCmd(), Plugin.getPysegEnvActivation(), PYTHON,
+                                            Plugin.getHome(GRAPHS_SCRIPT), vesStar, outDir, pixSize, sSig, vDen,
+                                            vRatio, mbNeigh)
+                elapsed, peakMemory = runMeasured(cmd, environ, projectDir, join(outDir, 'run.log'))
+                nVoxels, nCritPoints, nGraphElements = getVesicleCostTerms(*features, pixSize, sSig, vDen, vRatio,
+                                                                           mbNeigh, mbNeigh)
+                disperseDisk = sum(getDirSize(join(outDir, name)) for name in os.listdir(outDir)
+                                   if name.startswith('disperse_'))
+                samples.append({'star': vesStar, 'sSig': sSig, 'vDen': vDen,
+                                'nVoxels': nVoxels, 'nCritPoints': nCritPoints, 'nGraphElements': nGraphElements,
+                                'time': elapsed, 'memory': peakMemory,
+                                'disk': getDirSize(outDir) - disperseDisk, 'disperseDisk': disperseDisk})
+                logger.info('%s, sSig = %s, vDen = %s: %.1f s, %.0f MB' % (vesStar, sSig, vDen, elapsed,
+                                                                             peakMemory / 1024 ** 2))
+
+    coefs, r2 = fitGraphsCostModel(samples)
+    model = {'coefficients': coefs,
+             'provenance': {'date': datetime.now().strftime('%Y-%m-%d'),
+                            'host': platform.node(),
+                            'cpu': platform.processor() or platform.machine(),
+                            'pysegVersion': DEFAULT_VERSION,
+                            'data': presegStar,
+                            'nVesicles': len(vesStars),
+                            'nRuns': len(samples),
+                            'sSigs': list(sSigs),
+                            'vDens': list(vDens),
+                            'r2': r2},
+             'samples': samples}
+    with open(getGraphsCostModelFile(), 'w') as f:
+        json.dump(model, f, indent=2)
+    logger.info('Graphs cost model written in %s: %s (R² %s)' % (getGraphsCostModelFile(), coefs, r2))
+    return model
+
+
+def runMeasured(cmd, environ, cwd, logFile):
+    """Run a shell command, returning its wall time (s) and the peak resident memory (bytes) of the largest of its
+    processes."""
+    import subprocess
+    import time
+    with open(logFile, 'w') as log:
+        t0 = time.perf_counter()
+        process = subprocess.Popen(cmd, shell=True, env=environ, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - t0
+    returnCode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if returnCode != 0:
+        raise subprocess.CalledProcessError(returnCode, cmd)
+    return elapsed, usage.ru_maxrss * 1024  # ru_maxrss is in kB on Linux
+
+
+def getDirSize(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(join(root, name)) for root, _, names in os.walk(path) for name in names
+               if not os.path.islink(join(root, name)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the plugin overhead with the pySeg stand-in scripts.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Numbers of vesicles of the datasets')
+    parser.add_argument('--project', default='pysegBenchmark', help='Scipion project, created if it does not exist')
+    parser.add_argument('--workDir', default='pysegBenchmark',
+                        help='Directory where the stand-ins and the synthetic data are generated')
+    parser.add_argument('-j', '--threads', type=int, default=4, help='Threads of each protocol')
+    parser.add_argument('--report', help='JSON file where the report is written')
+    parser.add_argument('--calibrateGraphs', type=int, metavar='PRESEG_RUN_ID',
+                        help='Instead of the benchmark, fit the graphs cost model on real pySeg graphs runs on the '
+                             'vesicles of this finished preseg run of the project')
+    parser.add_argument('--calibrationVesicles', type=int, default=CALIBRATION_VESICLES,
+                        help='Vesicles used for the calibration')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    workDir = abspath(args.workDir)
+    if args.calibrateGraphs:
+        from pyworkflow.project import Manager
+        project = Manager().loadProject(args.project)
+        calibrateGraphsCost(project, project.getProtocol(args.calibrateGraphs), join(workDir, 'graphsCalibration'),
+                            nVesicles=args.calibrationVesicles)
+        return 0
+
+    standInLog = join(workDir, 'standins.log')
+    setStandInsEnviron(installStandIns(join(workDir, 'pysegHome')), standInLog)
+    from pyworkflow.project import Manager
+    manager = Manager()
+    if manager.hasProject(args.project):
+        project = manager.loadProject(args.project)
+    else:
+        project = manager.createProject(args.project)
+    resultsBySize = {}
+    for size in sorted(args.sizes):
+        logger.info('Generating the synthetic data with %i vesicles' % size)
+        data = genSyntheticData(join(workDir, 'data_%05d' % size), size)
+        resultsBySize[size] = runBenchmark(project, data, nThreads=args.threads, standInLog=standInLog)
+    report = genReport(resultsBySize)
+    logReport(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,7 @@
 from os.path import join
 
 PYSEG = 'pySeg'
+PYTHON = 'python'  # The same as scipion.constants.PYTHON, not imported to keep the plugin loading light
 PYSEG_HOME = 'PYSEG_HOME'
 DEFAULT_VERSION = 'v2.0.5'
 PYSEG_SOURCE_URL = 'https://github.com/anmartinezs/pyseg_system/archive/refs/tags/%s.tar.gz' % DEFAULT_VERSION
@@ -34,6 +35,16 @@ PYSEG_SOURCE_URL = 'https://github.com/anmartinezs/pyseg_system/archive/refs/tag
 PYSEG_ENV_NAME = '%s-%s' % (PYSEG, DEFAULT_VERSION)
 PYSEG_ENV_ACTIVATION = 'PYSEG_ENV_ACTIVATION'
 DEFAULT_ACTIVATION_CMD = 'conda activate %s' % PYSEG_ENV_NAME
+PYSEG_CPU_PLACEMENT = 'PYSEG_CPU_PLACEMENT'  # If true, each running pySeg step is bound to its own CPUs
+PYSEG_SCRATCH = 'PYSEG_SCRATCH'  # Node-local directory where the pySeg scripts are run, if provided
+PYSEG_ARTIFACTS = 'PYSEG_ARTIFACTS'  # Local directory with the installation artifacts, for offline installations
+PYSEG_ENV_SPEC = 'pyseg_env.yml'  # Conda environment specification, in the plugin package
+PYSEG_PACKED_ENV = '%s.tar.gz' % PYSEG_ENV_NAME  # Environment packed with conda-pack, in the artifacts directory
+COMPILER_CHECK_CACHE = '.pyseg_compiler_check.json'  # In the EM root
+GRAPHS_COST_MODEL_FILE = 'pyseg_graphs_cost_model.json'  # Fitted graphs cost model, in the EM root
+PYSEG_VIEWER_MAX_CELLS = 'PYSEG_VIEWER_MAX_CELLS'  # Graphs and filaments with more cells are displayed decimated
+# Thread pools of the numerical libraries used by the pySeg scripts, limited per child process
+THREAD_LIMIT_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
 
 SEE_METHODS_TAB = '\n\n(*) Algorithm parameter information can be checked out in methods tab'
 
@@ -63,11 +74,22 @@ FILS_OUT = 'fils'
 PICKING_OUT = 'picking'
 POST_REC_OUT = 'subtomos_post_rec'
 PLANE_ALIGN_CLASS_OUT = 'plane_align_classification'
+PLANE_ALIGN_CACHE_DIR = 'plane_align_cache'
+PLANE_ALIGN_CACHE_INFO = 'cache_info.json'  # Pre-processing parameters of the pySeg outputs in the cache
+CLASS_ASSIGNMENT_OUT = 'class_assignment'
+CLASS_ASSIGNMENT_FLATTENED = 'flattened_particles'
 FILS_FILES = 'filsFiles'
 
+# Vesicle viewer
+VESICLES_PAGE_SIZE = 100  # Vesicles listed per page
+DEFAULT_VIEWER_MAX_CELLS = 0  # Meshes are not decimated by default
+DECIMATED_SUFFIX = '_lod'  # Decimated (level of detail) copies of the displayed meshes
+
 # Third parties software
 CFITSIO = 'cfitsio'
 DISPERSE = 'DisPerSE'
+DISPERSE_TARBALL = 'master.tar.gz'
+DISPERSE_URL = 'https://github.com/thierry-sousbie/DisPerSE/archive/refs/heads/%s' % DISPERSE_TARBALL
 
 # Data source codification
 FROM_SCIPION = 0
@@ -83,9 +105,45 @@ PRESEG_AREAS_LIST = ['Membrane', 'Inner surroundings', 'Outer surroundings']
 IN_STARS_DIR = 'inStarFiles'
 OUT_STARS_DIR = 'outStarFiles'
 
+# Subtomograms extracted from stacks to be read by pySeg
+STACK_MEMBERS_DIR = 'stackMembers'
+
+# Conversion cache, located in the project Tmp directory
+CONVERSION_CACHE_DIR = 'pyseg_conversion_cache'
+MASKS_CACHE_DIR = 'masks'
+CACHED_STAR = 'particles.star'
+
+# Scratch staging: outputs copied back from the scratch (read by the next protocols and the viewers)
+STAGED_OUTPUTS_FILE = 'stagedOutputs.txt'
+GRAPHS_KEEP = ['*.star', '*.pkl', '*_edges_2.vtp']
+GRAPHS_KEEP_ALL = GRAPHS_KEEP + ['*.vtp', 'disperse_*']  # If the intermediate files are requested
+FILS_KEEP = ['*.star', '*.pkl', '*_net.vtp']
+PICKING_KEEP = ['*_parts.star', '*_peak.vtp', '*_surf.vtp']
+
+# Straggler control
+QUARANTINE_FILE = 'quarantinedVesicles.txt'
+RETRY_SSIG_FACTOR = 1.5  # Sigma for gaussian filtering is multiplied by this factor in each retry
+RETRY_VDEN_FACTOR = 0.5  # Vertex density is multiplied by this factor in each retry
+RETRIED_FILE = 'retriedVesicles.txt'  # Vesicles processed with coarser parameters, with the ones used
+MEMORY_ERROR_EXIT_STATUS = 99  # Exit status of the pySeg runs exceeding the memory limit (see engines/memory_guard.py)
+# Exit statuses of the runs killed for exceeding the limits: SIGKILL sent by timeout --signal=KILL (128 + 9) or to the
+# process itself (-9), and memory limit exceeded
+LIMIT_EXIT_STATUSES = [128 + 9, -9, MEMORY_ERROR_EXIT_STATUS]
+
+# Performance gates of the tests
+PERF_MODE = 'PYSEG_PERF_MODE'  # record: update the baseline, check: fail on regressions, unset: only report
+PERF_RECORD = 'record'
+PERF_CHECK = 'check'
+PERF_BASELINE = 'PYSEG_PERF_BASELINE'  # Baseline file, the one in pyseg/tests by default
+PERF_TOLERANCE = 'PYSEG_PERF_TOLERANCE'  # Allowed relative increase of the time and memory of each stage
+DEFAULT_PERF_TOLERANCE = 0.25
+PERF_MIN_SECONDS = 5  # Time increases below it are not considered regressions (timer and scheduling noise)
+PERF_MIN_MB = 50  # The same for the memory
+
 # Star file fields #####################################################################################################
 NOT_FOUND = 'Not_found'
 GRAPHS_PICKLE_FILE = 'psGhMCFPickle'
+FILS_PICKLE_FILE = 'psFilPickle'
 
 # Preseg_pre_centered
 TOMOGRAM = 'rlnMicrographName'
@@ -23,10 +23,11 @@
 # *
 # **************************************************************************
 from emtable import Table
-from pyseg.convert.convert import PysegStarReader
 
 
 def createPysegReader(starFile, **kwargs):
+    # The reader is based on the Relion tomo plugin one, only loaded when needed
+    from pyseg.convert.reader import PysegStarReader
     dataTable = Table()
     dataTable.read(starFile, tableName=None)
     return PysegStarReader(starFile, dataTable, **kwargs)
@@ -37,7 +38,7 @@ def readPysegCoordinates(starFile, coordSet, precedentsSet):
     return reader.starFile2Coords3D(coordSet, precedentsSet)
 
 
-def readPysegSubtomograms(starFile, inSubtomos, outSubtomos):
-    reader = createPysegReader(starFile)
+def readPysegSubtomograms(starFile, inSubtomos, outSubtomos, **kwargs):
+    reader = createPysegReader(starFile, **kwargs)
     return reader.starFile2Subtomograms(inSubtomos, outSubtomos)
 
@@ -23,93 +23,20 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from os.path import join
+import hashlib
+import os
+from os.path import join, abspath, exists, getmtime
 from emtable import Table
-from pwem.emlib.image import ImageHandler
-from pwem.objects.data import Transform
-from pyseg.constants import NOT_FOUND, GRAPHS_OUT, VESICLE
-from pyseg.utils import manageDims
-from pyworkflow.object import Float
-from pyworkflow.utils import removeBaseExt, createLink
-from reliontomo.constants import TILT_PRIOR, PSI_PRIOR, SUBTOMO_NAME, TOMO_NAME_30
-from reliontomo.convert import RELION_30_TOMO_LABELS
-from reliontomo.convert.convert30_tomo import Reader
-from reliontomo.convert.convertBase import getTransformMatrixFromRow
-from tomo.objects import SubTomogram, TomoAcquisition
-
-
-class PysegStarReader(Reader):
-
-    def __init__(self, starFile, dataTable, **kwargs):
-        super().__init__(starFile, dataTable)
-
-    def starFile2Coords3D(self, coordsSet, precedentsSet, scaleFactor=1):
-        precedentDict = {removeBaseExt(tomo.getFileName()): tomo.clone() for tomo in precedentsSet}
-        for row in self.dataTable:
-            coord3d = self.gen3dCoordFromStarRow(row, precedentDict, scaleFactor)
-            # GroupId stuff
-            vsicleName = row.get(VESICLE, None)
-            if 'tid_' in vsicleName:
-                vesicleId = vsicleName.split('tid_')[1]
-                vesicleId = vesicleId[0]
-                coord3d.setGroupId(vesicleId)
-
-            coordsSet.append(coord3d)
-
-    def starFile2Subtomograms(self, inSubtomos, outputSubtomos):
-        warningMsg = None
-        labels = RELION_30_TOMO_LABELS
-        self.genOutputSubtomograms(inSubtomos, outputSubtomos)
-        if not self.dataTable.hasAllColumns(labels):
-            missingCols = [name for name in labels if name not in self.dataTable.getColumnNames()]
-            warningMsg = 'Columns %s\nwere not found in the star file provided.\nThe corresponding numerical ' \
-                         'values will be considered as 0.' \
-                         % '  '.join(['*' + colName + '*' for colName in missingCols])
-        return warningMsg, self.dataTable
-
-    def genOutputSubtomograms(self, inSubtomos, outputSubtomos):
-        ih = ImageHandler()
-        samplingRate = outputSubtomos.getSamplingRate()
-        for row, inSubtomo in zip(self.dataTable, inSubtomos):
-            subtomo = SubTomogram()
-            transform = Transform()
-            origin = Transform()
-
-            volname = row.get(TOMO_NAME_30, NOT_FOUND)
-            subtomoFn = row.get(SUBTOMO_NAME, NOT_FOUND)
-            transform.setMatrix(getTransformMatrixFromRow(row))
-
-            subtomo.setVolName(managePath4Sqlite(volname))
-            subtomo.setTransform(transform)
-            subtomo.setAcquisition(TomoAcquisition())
-            subtomo.setClassId(row.get('rlnClassNumber', 0))
-            subtomo.setSamplingRate(samplingRate)
-
-            tiltPrior = row.get(TILT_PRIOR, 0)
-            psiPrior = row.get(PSI_PRIOR, 0)
-            subtomo.setCoordinate3D(inSubtomo.getCoordinate3D())
-            subtomo._tiltPriorAngle = Float(tiltPrior)
-            subtomo._psiPriorAngle = Float(psiPrior)
-
-            # Set the origin and the dimensions of the current subtomogram
-            x, y, z, n = ih.getDimensions(subtomoFn)
-            zDim = manageDims(subtomoFn, z, n)
-            origin.setShifts(x / -2. * samplingRate,
-                             y / -2. * samplingRate,
-                             zDim / -2. * samplingRate)
-            subtomo.setOrigin(origin)
-
-            subtomo.setFileName(managePath4Sqlite(subtomoFn))
-            # if subtomo is in a vesicle
-            if 'tid_' in subtomoFn:
-                vesicleId = subtomoFn.split('tid_')[1]
-                vesicleId = vesicleId[0]
-                scoor = subtomo.getCoordinate3D()
-                scoor.setGroupId(vesicleId)
-                subtomo.setCoordinate3D(scoor)
-
-            # Add current subtomogram to the output set
-            outputSubtomos.append(subtomo)
+from pwem.constants import NO_INDEX
+from pyseg.constants import NOT_FOUND, GRAPHS_OUT, CACHED_STAR, STACK_MEMBERS_DIR
+from pyseg.engines.mb_suppression import readVolume, writeVolume
+from pyseg.utils import getConversionCacheDir, linkCachedFile
+from pyworkflow.utils import removeBaseExt, createLink, makePath
+
+
+def getSplitStarFileName(outDir, prefix, fileCounter):
+    """Name of the star file number fileCounter generated by splitPysegStarFile."""
+    return join(outDir, '%s%03d.star' % (prefix, fileCounter))
 
 
 def splitPysegStarFile(inStar, outDir, j=1, prefix=GRAPHS_OUT + '_', fileCounter=1):
@@ -125,18 +52,17 @@ def splitPysegStarFile(inStar, outDir, j=1, prefix=GRAPHS_OUT + '_', fileCounter
         outTable.addRow(*values)
 
     def _writeStarFile():
-        outStarFile = join(outDir, '%s%03d.star' % (prefix, fileCounter))
+        outStarFile = getSplitStarFileName(outDir, prefix, fileCounter)
         outStarFiles.append(outStarFile)
         outTable.write(outStarFile)
         outTable.clearRows()
 
     tomoTable.read(inStar)
     if len(tomoTable) == 1:
-        outStarFile = join(outDir, '%s%03d.star' % (prefix, fileCounter))
+        outStarFile = getSplitStarFileName(outDir, prefix, fileCounter)
         createLink(inStar, outStarFile)
         outStarFiles.append(outStarFile)
     else:
-        nVesicles = tomoTable.size()
         labels = tomoTable.getColumnNames()
         outTable = Table(columns=labels)
         counter = 1
@@ -147,15 +73,100 @@ def splitPysegStarFile(inStar, outDir, j=1, prefix=GRAPHS_OUT + '_', fileCounter
                 fileCounter += 1
             counter += 1
 
-        rem = nVesicles % j
-        if rem > 0:
-            for vesicleRow in tomoTable[-rem:-1]:
-                _addRow()
+        # Remaining rows, if any, were already added to the output table
+        if outTable.size() > 0:
             _writeStarFile()
 
     return outStarFiles
 
 
+def mergeStarFiles(starFiles, outStar):
+    """Merge the given star files, keeping their order, into a single one. All of them are expected to have the same
+    columns."""
+    outTable = None
+    labels = None
+    for starFile in starFiles:
+        inTable = Table()
+        inTable.read(starFile)
+        if outTable is None:
+            labels = inTable.getColumnNames()
+            outTable = Table(columns=labels)
+        for row in inTable:
+            outTable.addRow(*[row.get(label, NOT_FOUND) for label in labels])
+    outTable.write(outStar)
+
+
+def subtomograms2PysegStar(subtomoSet, starFile, extractDir=None):
+    """Write a set of subtomograms into a star file as expected by pySeg. The subtomograms stored in stacks are
+    listed as index@stack.mrc, unless extractDir is provided. In that case, they are extracted there into one file
+    per subtomogram, as the pySeg scripts can only read them that way."""
+    from reliontomo.constants import SUBTOMO_NAME
+    from reliontomo.convert import createWriterTomo
+    writer = createWriterTomo(isPyseg=True)
+    writer.subtomograms2Star(subtomoSet, starFile)
+    locations = [subtomo.getLocation() for subtomo in subtomoSet.iterSubtomos()]
+    if all(index == NO_INDEX for index, _ in locations):
+        return
+    if extractDir:
+        makePath(extractDir)
+    inTable = Table()
+    inTable.read(starFile)
+    labels = inTable.getColumnNames()
+    outTable = Table(columns=labels)
+    for row, (index, fileName) in zip(inTable, locations):
+        values = row._asdict()
+        if index != NO_INDEX:
+            values[SUBTOMO_NAME] = '%06d@%s' % (index, fileName)
+            if extractDir:
+                subtomoFn = getExtractedSubtomoName(extractDir, index, fileName)
+                writeVolume(readVolume(values[SUBTOMO_NAME]), subtomoFn, voxelSize=subtomoSet.getSamplingRate())
+                values[SUBTOMO_NAME] = subtomoFn
+        outTable.addRow(*[values[label] for label in labels])
+    outTable.write(starFile)
+
+
+def cachedSubtomograms2PysegStar(subtomoSet, starFile, extract=False):
+    """Same as subtomograms2PysegStar, but the star file (and the subtomograms extracted from stacks, if extract is
+    True) is generated in the conversion cache and hard linked to starFile, so the runs using the same set of
+    subtomograms reuse it instead of converting the set again. The cache is generated again if any of its files has
+    been removed, e. g. when the project Tmp directory is cleaned."""
+    cacheDir = getSubtomosCacheDir(subtomoSet, extract=extract)
+    cachedStar = join(cacheDir, CACHED_STAR)
+    extractDir = join(cacheDir, STACK_MEMBERS_DIR) if extract else None
+    if not exists(cachedStar) or (extract and not all(map(exists, getStackMembersDict(subtomoSet, extractDir)))):
+        makePath(cacheDir)
+        # Generated with a temporary name, so a concurrent run never links a partially written star file
+        tmpStar = join(cacheDir, '%s_%i.star' % (removeBaseExt(CACHED_STAR), os.getpid()))
+        subtomograms2PysegStar(subtomoSet, tmpStar, extractDir=extractDir)
+        os.replace(tmpStar, cachedStar)
+    linkCachedFile(cachedStar, starFile)
+
+
+def getSubtomosCacheDir(subtomoSet, extract=False):
+    """Conversion cache directory of a set of subtomograms, identified by its sqlite file and modification time."""
+    setFile = abspath(subtomoSet.getFileName())
+    key = hashlib.sha1(('%s_%s_%s' % (setFile, getmtime(setFile), extract)).encode()).hexdigest()
+    return getConversionCacheDir(key)
+
+
+def getExtractedSubtomoName(extractDir, index, stackFile):
+    return join(extractDir, '%s_%06d.mrc' % (removeBaseExt(stackFile), index))
+
+
+def getStackMembersDict(subtomoSet, extractDir=None):
+    """Dictionary of type {extractedFile: (index, stackFile)} for the subtomograms of the given set stored in stacks
+    and extracted into extractDir by subtomograms2PysegStar. If not provided, extractDir will be the one used by
+    cachedSubtomograms2PysegStar."""
+    if not extractDir:
+        extractDir = join(getSubtomosCacheDir(subtomoSet, extract=True), STACK_MEMBERS_DIR)
+    stackMembersDict = {}
+    for subtomo in subtomoSet.iterSubtomos():
+        index, fileName = subtomo.getLocation()
+        if index != NO_INDEX:
+            stackMembersDict[getExtractedSubtomoName(extractDir, index, fileName)] = (index, fileName)
+    return stackMembersDict
+
+
 def managePath4Sqlite(fpath):
     return fpath if fpath != NOT_FOUND else fpath
 
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from pwem.emlib.image import ImageHandler
+from pwem.objects.data import Transform
+from pyseg.constants import NOT_FOUND, VESICLE
+from pyseg.convert.convert import managePath4Sqlite
+from pyseg.engines.mb_suppression import splitLocation
+from pyseg.utils import manageDims
+from pyworkflow.object import Float
+from pyworkflow.utils import removeBaseExt
+from reliontomo.constants import TILT_PRIOR, PSI_PRIOR, SUBTOMO_NAME, TOMO_NAME_30
+from reliontomo.convert import RELION_30_TOMO_LABELS
+from reliontomo.convert.convert30_tomo import Reader
+from reliontomo.convert.convertBase import getTransformMatrixFromRow
+from tomo.objects import SubTomogram, TomoAcquisition
+
+
+class PysegStarReader(Reader):
+
+    def __init__(self, starFile, dataTable, stackMembersDict=None, **kwargs):
+        """Attribute stackMembersDict is used to point the output subtomograms to the stacks they were extracted from
+        to be read by pySeg, see getStackMembersDict."""
+        super().__init__(starFile, dataTable)
+        self._stackMembersDict = stackMembersDict if stackMembersDict else {}
+
+    def starFile2Coords3D(self, coordsSet, precedentsSet, scaleFactor=1):
+        precedentDict = {removeBaseExt(tomo.getFileName()): tomo.clone() for tomo in precedentsSet}
+        for row in self.dataTable:
+            coord3d = self.gen3dCoordFromStarRow(row, precedentDict, scaleFactor)
+            # GroupId stuff
+            vsicleName = row.get(VESICLE, None)
+            if 'tid_' in vsicleName:
+                vesicleId = vsicleName.split('tid_')[1]
+                vesicleId = vesicleId[0]
+                coord3d.setGroupId(vesicleId)
+
+            coordsSet.append(coord3d)
+
+    def starFile2Subtomograms(self, inSubtomos, outputSubtomos):
+        warningMsg = None
+        labels = RELION_30_TOMO_LABELS
+        self.genOutputSubtomograms(inSubtomos, outputSubtomos)
+        if not self.dataTable.hasAllColumns(labels):
+            missingCols = [name for name in labels if name not in self.dataTable.getColumnNames()]
+            warningMsg = 'Columns %s\nwere not found in the star file provided.\nThe corresponding numerical ' \
+                         'values will be considered as 0.' \
+                         % '  '.join(['*' + colName + '*' for colName in missingCols])
+        return warningMsg, self.dataTable
+
+    def genOutputSubtomograms(self, inSubtomos, outputSubtomos):
+        ih = ImageHandler()
+        samplingRate = outputSubtomos.getSamplingRate()
+        dimsDict = {}  # The dimensions are read only once per file, as many subtomograms may share a stack
+        for row, inSubtomo in zip(self.dataTable, inSubtomos):
+            subtomo = SubTomogram()
+            transform = Transform()
+            origin = Transform()
+
+            volname = row.get(TOMO_NAME_30, NOT_FOUND)
+            subtomoFn = row.get(SUBTOMO_NAME, NOT_FOUND)
+            index, subtomoFn = self._stackMembersDict.get(subtomoFn, splitLocation(subtomoFn))
+            transform.setMatrix(getTransformMatrixFromRow(row))
+
+            subtomo.setVolName(managePath4Sqlite(volname))
+            subtomo.setTransform(transform)
+            subtomo.setAcquisition(TomoAcquisition())
+            subtomo.setClassId(row.get('rlnClassNumber', 0))
+            subtomo.setSamplingRate(samplingRate)
+
+            tiltPrior = row.get(TILT_PRIOR, 0)
+            psiPrior = row.get(PSI_PRIOR, 0)
+            subtomo.setCoordinate3D(inSubtomo.getCoordinate3D())
+            subtomo._tiltPriorAngle = Float(tiltPrior)
+            subtomo._psiPriorAngle = Float(psiPrior)
+
+            # Set the origin and the dimensions of the current subtomogram
+            if subtomoFn not in dimsDict:
+                dimsDict[subtomoFn] = ih.getDimensions(subtomoFn)
+            x, y, z, n = dimsDict[subtomoFn]
+            zDim = z if index else manageDims(subtomoFn, z, n)
+            origin.setShifts(x / -2. * samplingRate,
+                             y / -2. * samplingRate,
+                             zDim / -2. * samplingRate)
+            subtomo.setOrigin(origin)
+
+            subtomo.setLocation(index, managePath4Sqlite(subtomoFn))
+            # if subtomo is in a vesicle
+            if 'tid_' in subtomoFn:
+                vesicleId = subtomoFn.split('tid_')[1]
+                vesicleId = vesicleId[0]
+                scoor = subtomo.getCoordinate3D()
+                scoor.setGroupId(vesicleId)
+                subtomo.setCoordinate3D(scoor)
+
+            # Add current subtomogram to the output set
+            outputSubtomos.append(subtomo)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from os.path import join
+
+import numpy as np
+from emtable import Table
+
+from .engine_io import readVolume, readImageStack
+from .plane_align import normalizeImages, PARTICLES_STACK, MASKS_STACK
+
+# Particles whose cross correlation against the references is computed at once
+ASSIGNMENT_BATCH_SIZE = 4096
+
+
+def getReferenceImage(referenceFile, shape):
+    """2D image of a class representative, which must be of the same shape as the flattened particles."""
+    image = readVolume(referenceFile)
+    if image.shape[-2:] != tuple(shape) or image.size != np.prod(shape):
+        raise ValueError('The class representative %s, of size %s, does not correspond to the flattened particles, '
+                         'of size %s' % (referenceFile, image.shape, tuple(shape)))
+    return image.reshape(shape)
+
+
+def assignToClasses(particles, references, mask, batchSize=ASSIGNMENT_BATCH_SIZE):
+    """Index of the best correlating reference of each particle and the corresponding cross correlation. The cross
+    correlation of each batch of particles against all the references is computed as a single matrix product."""
+    refVectors = normalizeImages(np.asarray(references), mask)
+    indices = np.zeros(len(particles), dtype=int)
+    ccs = np.zeros(len(particles), dtype=np.float32)
+    for first in range(0, len(particles), batchSize):
+        ccMatrix = normalizeImages(np.asarray(particles[first:first + batchSize]), mask) @ refVectors.T
+        indices[first:first + batchSize] = np.argmax(ccMatrix, axis=1)
+        ccs[first:first + batchSize] = ccMatrix.max(axis=1)
+    return indices, ccs
+
+
+def runClassAssignment(inStar, outStar, flattenedDir, referencesDict, minCC=-1):
+    """Assign the particles listed in inStar, flattened by pySeg into flattenedDir with the pre-processing of the 2D
+    classification, to the classes whose references (class id: representative file) are provided. The particles are
+    written into outStar, in the same order, with their class number and cross correlation. The class number of those
+    whose cross correlation is lower than minCC is -1."""
+    inTable = Table()
+    inTable.read(inStar)
+    rows = list(inTable)
+    particles = readImageStack(join(flattenedDir, PARTICLES_STACK))
+    if len(particles) != len(rows):
+        raise ValueError('%i particles were flattened in %s, while %s contains %i'
+                         % (len(particles), flattenedDir, inStar, len(rows)))
+    mask = np.asarray(readImageStack(join(flattenedDir, MASKS_STACK))[0]) > 0
+    classIds = sorted(referencesDict)
+    references = np.stack([getReferenceImage(referencesDict[classId], particles.shape[1:]) for classId in classIds])
+    indices, ccs = assignToClasses(particles, references, mask)
+    labels = np.where(ccs >= minCC, np.array(classIds)[indices], -1)
+
+    colNames = [colName for colName in inTable.getColumnNames() if colName != 'rlnClassNumber']
+    outTable = Table(columns=colNames + ['rlnClassNumber', 'rlnMaxValueProbDistribution'])
+    for row, label, cc in zip(rows, labels, ccs):
+        values = row._asdict()
+        outTable.addRow(*[values[colName] for colName in colNames], int(label), float(cc))
+    outTable.write(outStar)
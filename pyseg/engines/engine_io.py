@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+"""Star and MRC/EM file input/output shared by the engines executed in the pySeg environment and the pySeg stand-ins,
+so it only depends on NumPy."""
+import numpy as np
+
+MRC_DTYPES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+EM_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32, 5: np.float32, 9: np.float64}
+MRC_HEADER_SIZE = 1024
+EM_HEADER_SIZE = 512
+
+
+def readStar(starFile):
+    """Read the first data block of a star file, returning its column names and rows (lists of strings)."""
+    labels = []
+    rows = []
+    with open(starFile) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('data_') or line == 'loop_':
+                if rows and line.startswith('data_'):
+                    break
+                continue
+            if line.startswith('_'):
+                labels.append(line.split()[0][1:])
+            else:
+                rows.append(line.split())
+    return labels, rows
+
+
+def writeStar(starFile, labels, rows):
+    with open(starFile, 'w') as f:
+        f.write('\ndata_\n\nloop_\n')
+        for i, label in enumerate(labels):
+            f.write('_%s #%i\n' % (label, i + 1))
+        for row in rows:
+            f.write(' '.join(str(value) for value in row) + '\n')
+
+
+def splitLocation(location):
+    """Split a location of type index@fileName, with the index starting at 1, into (index, fileName). Locations
+    without index are returned with index 0."""
+    if '@' in location:
+        index, fileName = location.split('@', 1)
+        return int(index), fileName
+    return 0, location
+
+
+def readVolume(location):
+    """Read a volume (as float32, indexed as (z, y, x)) from an MRC file, an MRC volume stack (index@fileName) or an
+    EM file."""
+    index, fileName = splitLocation(location)
+    if fileName.endswith('.em'):
+        header = np.fromfile(fileName, dtype=np.int32, count=4)
+        dtype = EM_DTYPES[header[0] >> 24 & 0xff]
+        nx, ny, nz = header[1:4]
+        return _readData(fileName, dtype, (nz, ny, nx), EM_HEADER_SIZE)
+    header = np.fromfile(fileName, dtype=np.int32, count=256)
+    nx, ny, nz, mode = header[:4]
+    dtype = MRC_DTYPES[mode]
+    offset = MRC_HEADER_SIZE + header[23]
+    if index:
+        shape = (header[9], ny, nx)
+        offset += (index - 1) * int(np.prod(shape)) * np.dtype(dtype).itemsize
+    else:
+        shape = (nz, ny, nx)
+    return _readData(fileName, dtype, shape, offset)
+
+
+def _readData(fileName, dtype, shape, offset):
+    with open(fileName, 'rb') as f:
+        f.seek(offset)
+        data = np.fromfile(f, dtype=dtype, count=int(np.prod(shape)))
+    return data.reshape(shape).astype(np.float32)
+
+
+def readImageStack(fileName):
+    """Memory map, of shape (n, y, x), of a stack of n 2D images stored in an MRC file, so stacks larger than the
+    available memory can be read by parts."""
+    header = np.fromfile(fileName, dtype=np.int32, count=256)
+    nx, ny, nz, mode = header[:4]
+    return np.memmap(fileName, dtype=MRC_DTYPES[mode], mode='r', offset=MRC_HEADER_SIZE + int(header[23]),
+                     shape=(int(nz), int(ny), int(nx)))
+
+
+def writeVolume(data, fileName, voxelSize=1):
+    """Write a volume, indexed as (z, y, x), or a 2D image into a float32 MRC file."""
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    nz, ny, nx = data.shape
+    header = np.zeros(256, dtype=np.int32)
+    header[:4] = nx, ny, nz, 2
+    header[7:10] = nx, ny, nz
+    headerF = header.view(np.float32)
+    headerF[10:13] = nx * voxelSize, ny * voxelSize, nz * voxelSize
+    headerF[13:16] = 90
+    header[16:19] = 1, 2, 3
+    headerF[19:22] = data.min(), data.max(), data.mean()
+    header[52] = np.frombuffer(b'MAP ', dtype=np.int32)[0]
+    header[53] = np.frombuffer(bytes([0x44, 0x44, 0, 0]), dtype=np.int32)[0]
+    headerF[54] = data.std()
+    with open(fileName, 'wb') as f:
+        header.tofile(f)
+        data.tofile(f)
+
+
+def getVoxelSize(location):
+    """Voxel size of an MRC file, 1 if it is not set or for other formats."""
+    _, fileName = splitLocation(location)
+    if fileName.endswith('.em'):
+        return 1
+    header = np.fromfile(fileName, dtype=np.int32, count=11)
+    return float(header[10:11].view(np.float32)[0] / header[7]) if header[7] else 1
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import mrcfile
+import numpy as np
+from emtable import Table
+from os.path import join, basename
+from pyworkflow.utils import removeBaseExt
+
+from .engine_io import splitLocation, readVolume
+
+# Maximum number of rotated membrane masks kept in memory
+MAX_CACHED_MASKS = 512
+
+
+def eulerZYZ2Matrix(rot, tilt, psi):
+    """Rotation matrix corresponding to the given Euler angles (degrees) in the Relion ZYZ convention, acting on
+    (x, y, z) coordinates. It maps the reference coordinates into the particle ones."""
+    def _rotZ(angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+    def _rotY(angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+
+    rot, tilt, psi = np.deg2rad([rot, tilt, psi])
+    return _rotZ(psi) @ _rotY(tilt) @ _rotZ(rot)
+
+
+def rotateVolume(vol, matrix, order=1):
+    """Rotate actively around its center a volume indexed as (z, y, x) with a rotation matrix acting on (x, y, z)
+    coordinates."""
+    from scipy.ndimage import affine_transform
+    # Output voxel o takes the value of the input voxel R^T o, expressed in (z, y, x) index order
+    invMatrix = matrix.T[::-1, ::-1]
+    center = (np.array(vol.shape) - 1) / 2
+    return affine_transform(vol, invMatrix, offset=center - invMatrix @ center, order=order, mode='constant', cval=0)
+
+
+def writeVolume(data, fileName, voxelSize=None):
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(data)
+        if voxelSize:
+            mrc.voxel_size = voxelSize
+
+
+def createStack(fileName, nVolumes, shape, voxelSize=None):
+    """Preallocate a float32 MRC volume stack, so the volumes can be written later directly into its memory map."""
+    with mrcfile.new_mmap(fileName, shape=(nVolumes,) + tuple(shape), mrc_mode=2, overwrite=True) as mrc:
+        if voxelSize:
+            mrc.voxel_size = voxelSize
+
+
+def isAxiallySymmetric(vol, nAngles=8, tol=0.1):
+    """Check if a volume indexed as (z, y, x) is symmetric around its z axis, by comparing it with its rotated
+    versions around that axis. The tolerance, relative to the volume sum, absorbs the interpolation of sharp edges."""
+    norm = np.abs(vol).sum()
+    if not norm:
+        return True
+    for angle in np.linspace(0, 360, nAngles, endpoint=False)[1:]:
+        if np.abs(rotateVolume(vol, eulerZYZ2Matrix(angle, 0, 0)) - vol).sum() > tol * norm:
+            return False
+    return True
+
+
+class MbSuppressionWeights:
+    """Voxel weights that apply the particle mask and the membrane suppression to the particles. The membrane
+    suppression mask is defined in the reference frame, with the membrane normal along z, so it is rotated to each
+    particle frame using its rot, tilt and psi angles, quantized to angularStep degrees (0 for no quantization). If
+    the membrane mask is symmetric around the normal, the rot angle is ignored. The particles sharing the quantized
+    angles share the same weights, which are computed once and cached."""
+
+    def __init__(self, mask, mbMask, mbSupFactor, angularStep=5):
+        self._mask = np.asarray(mask, dtype=np.float32)
+        self._mbMask = np.asarray(mbMask, dtype=np.float32)
+        self._mbSupFactor = mbSupFactor
+        self._angularStep = angularStep
+        # Only the membrane mask inside the particle mask is relevant for the symmetry
+        self._useRot = not isAxiallySymmetric(self._mbMask * (self._mask != 0))
+        self._cache = OrderedDict()
+
+    def getKeys(self, rots, tilts, psis):
+        angles = np.stack([np.asarray(rots) if self._useRot else np.zeros(len(tilts)),
+                           np.asarray(tilts), np.asarray(psis)], axis=1).astype(float)
+        if self._angularStep:
+            angles = np.round(angles / self._angularStep) * self._angularStep
+        return angles
+
+    def get(self, keys):
+        """Return an array of shape (len(keys), z, y, x) with the weights of each of the given keys."""
+        uniqueKeys, inverseInds = np.unique(keys, axis=0, return_inverse=True)
+        uniqueWeights = np.stack([self._getWeights(tuple(key)) for key in uniqueKeys])
+        return uniqueWeights[inverseInds.ravel()]
+
+    def _getWeights(self, key):
+        weights = self._cache.get(key, None)
+        if weights is None:
+            rotMbMask = rotateVolume(self._mbMask, eulerZYZ2Matrix(*key))
+            weights = self._mask * (1 - (1 - self._mbSupFactor) * np.clip(rotMbMask, 0, 1))
+            self._cache[key] = weights
+            if len(self._cache) > MAX_CACHED_MASKS:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return weights
+
+
+def suppressMembrane(inFiles, outLocations, rots, tilts, psis, mask, mbMask, mbSupFactor, voxelSize=None,
+                     batchSize=128, nThreads=1, angularStep=5):
+    """Apply the particle mask and the membrane suppression to a set of particles. The particles are loaded in batches
+    into a contiguous float32 array, weighted at once with broadcasting and written in parallel. The output locations
+    can be file names or index@fileName, being the latter written into the memory map of the corresponding stack,
+    which is expected to be preallocated."""
+    weights = MbSuppressionWeights(mask, mbMask, mbSupFactor, angularStep=angularStep)
+    keys = weights.getKeys(rots, tilts, psis)
+    outLocations = [splitLocation(location) for location in outLocations]
+    stacks = {fileName: mrcfile.mmap(fileName, mode='r+') for index, fileName in outLocations if index}
+    nParticles = len(inFiles)
+
+    def _write(batch, i):
+        index, fileName = outLocations[i]
+        if index:
+            stacks[fileName].data[index - 1] = batch[i % batchSize]
+        else:
+            writeVolume(batch[i % batchSize], fileName, voxelSize=voxelSize)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, nThreads)) as pool:
+            for first in range(0, nParticles, batchSize):
+                last = min(first + batchSize, nParticles)
+                batch = np.stack(list(pool.map(readVolume, inFiles[first:last])))
+                batch *= weights.get(keys[first:last])
+                list(pool.map(lambda i: _write(batch, i), range(first, last)))
+    finally:
+        for stack in stacks.values():
+            stack.close()
+
+
+def runMbSuppression(inStar, outStar, outDir, maskFile, mbMaskFile, mbSupFactor, nThreads=1, stackSize=0,
+                     seed=None, angularStep=5):
+    """Plugin side equivalent of the pySeg post-processing script: the particles listed in inStar are masked, their
+    membrane is suppressed and they are written into outDir, while their rot angle is randomized in outStar. If
+    stackSize is greater than 0, the particles are written into MRC stacks of up to that number of particles,
+    addressed in outStar as index@stack.mrc, instead of into one file per particle."""
+    inTable = Table()
+    inTable.read(inStar)
+    rows = list(inTable)
+    inFiles = [row.get('rlnImageName') for row in rows]
+    rots = [row.get('rlnAngleRot', 0) for row in rows]
+    tilts = [row.get('rlnAngleTilt', 0) for row in rows]
+    psis = [row.get('rlnAnglePsi', 0) for row in rows]
+    mask = readVolume(maskFile)
+    with mrcfile.open(splitLocation(inFiles[0])[1], header_only=True, permissive=True) as mrc:
+        voxelSize = mrc.voxel_size.x
+    if stackSize:
+        stackPattern = join(outDir, removeBaseExt(outStar) + '_stack%03d.mrc')
+        outLocations = ['%06d@%s' % (i % stackSize + 1, stackPattern % (i // stackSize + 1))
+                        for i in range(len(inFiles))]
+        for first in range(0, len(inFiles), stackSize):
+            createStack(stackPattern % (first // stackSize + 1), min(stackSize, len(inFiles) - first), mask.shape,
+                        voxelSize=voxelSize)
+    else:
+        outLocations = [join(outDir, _getBaseName(inFile)) for inFile in inFiles]
+    suppressMembrane(inFiles, outLocations, rots, tilts, psis, mask, readVolume(mbMaskFile), mbSupFactor,
+                     voxelSize=voxelSize, nThreads=nThreads, angularStep=angularStep)
+
+    colNames = inTable.getColumnNames()
+    if 'rlnAngleRot' not in colNames:
+        colNames.append('rlnAngleRot')
+    outRots = np.random.default_rng(seed).uniform(0, 360, len(rows))
+    outTable = Table(columns=colNames)
+    for row, outLocation, rot in zip(rows, outLocations, outRots):
+        values = row._asdict()
+        values.update(rlnImageName=outLocation, rlnAngleRot=rot)
+        outTable.addRow(*[values[colName] for colName in colNames])
+    outTable.write(outStar)
+
+
+def _getBaseName(location):
+    index, fileName = splitLocation(location)
+    return '%s_%06d.mrc' % (removeBaseExt(fileName), index) if index else basename(fileName)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Run a program, killing it with all its children and exiting with the given status if the memory they use (RSS)
+exceeds the limit, so the plugin can tell a run exceeding the memory limit from any other failure, for both Python
+scripts and native programs (DisPerSE). Otherwise, it exits with the status of the program (128 + signal number if
+killed by a signal). It is executed in the pySeg environment, so it only depends on the standard library.
+
+Usage: python memory_guard.py EXIT_STATUS MAX_MEMORY_KB PROGRAM [PROGRAM ARGS]
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+SAMPLING_PERIOD = 0.1  # Seconds
+
+
+def getDescendants(pid):
+    """Processes descending from the given one, read from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    # The process name, between parentheses, may contain spaces
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    descendants = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            descendants.append(child)
+            pending.append(child)
+    return descendants
+
+
+def getRss(pid):
+    """Resident memory (kB) of a process, 0 if it does not exist anymore."""
+    try:
+        with open('/proc/%i/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def killAll(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def main():
+    exitStatus = int(sys.argv[1])
+    maxMemory = int(sys.argv[2])
+    process = subprocess.Popen(sys.argv[3:])
+    while process.poll() is None:
+        processes = [process.pid] + getDescendants(process.pid)
+        if sum(getRss(pid) for pid in processes) > maxMemory:
+            killAll(processes)
+            process.wait()
+            sys.stderr.write('%s exceeded the memory limit of %i kB\n' % (sys.argv[3], maxMemory))
+            sys.stderr.flush()
+            sys.exit(exitStatus)
+        time.sleep(SAMPLING_PERIOD)
+    returnCode = process.returncode
+    sys.exit(128 - returnCode if returnCode < 0 else returnCode)
+
+
+if __name__ == '__main__':
+    main()
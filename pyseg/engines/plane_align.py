@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Clustering of membrane bound particles reusing the cross correlation matrix (AP) or the feature vectors (AG and
+K-means) computed by pySeg plane_align_class.py, which is run up to that processing level into a cache directory, so
+several clustering settings can be tried without repeating the particles pre-processing. The clustering and the class
+post-processing follow the steps of pySeg. It is executed as a script in the pySeg environment, so it only depends on
+NumPy, SciPy and scikit-learn."""
+import argparse
+import os
+import sys
+import time
+from os.path import join
+
+import numpy as np
+
+try:
+    from .engine_io import readStar, writeStar, readImageStack, writeVolume, getVoxelSize  # Imported from the plugin
+except ImportError:
+    from engine_io import readStar, writeStar, readImageStack, writeVolume, getVoxelSize  # Executed as a script
+
+# Clustering algorithms
+AP = 'AP'
+AG = 'AG'
+KMEANS = 'Kmeans'
+
+# AP references
+EXEMPLAR = 'exemplar'
+AVERAGE = 'average'
+
+# Output layout, the same as the one generated by pySeg
+OUT_STEM = 'class'
+CLASS_NUMBER = 'rlnClassNumber'
+IMAGE_NAME = 'rlnImageName'
+
+# Outputs of pySeg up to the cross correlation matrix / feature vectors processing level, reused by the clustering:
+# flattened 2D particles and their masks, in the order of the input star file, and the cross correlation matrix (AP)
+# or the feature vectors (AG and K-means)
+PARTICLES_STACK = OUT_STEM + '_particles.mrc'
+MASKS_STACK = OUT_STEM + '_masks.mrc'
+CC_MATRIX = OUT_STEM + '_cc.npy'
+FEATURE_VECTORS = OUT_STEM + '_vectors.npy'
+
+# Parameter sweep outputs
+SWEEP_DIR = 'sweep_%03d'
+SWEEP_STAR = 'sweep_summary.star'
+SWEEP_LABELS = ['sweepValue', 'nClasses', 'silhouetteScore', 'classSizes']
+NO_CLASS_SIZES = '-'  # Written instead of an empty field when all the classes are purged
+
+# Rows of the similarity matrix read at once
+TILE_SIZE = 2048
+
+# Largest number of particles clustered with AP on the dense similarity matrix. Larger sets, or the ones whose dense AP
+# exceeds the memory budget (bytes) or the available memory, use the k nearest neighbours
+DENSE_AP_MAX = 10000
+DENSE_AP_MEMORY = 4 * 2 ** 30
+DEFAULT_AP_KNN = 50
+# Memory of AP per entry of the dense similarity matrix: the float64 similarity, responsibility, availability and
+# temporary matrices
+DENSE_AP_BYTES_PER_ENTRY = 4 * 8
+
+# Largest number of particles clustered with K-means in memory. Larger sets use mini-batch K-means
+IN_MEMORY_MAX = 20000
+DEFAULT_MINI_BATCH = 4096
+MINI_BATCH_EPOCHS = 3
+# Largest number of particles clustered with AG, being the Ward linkage computed in memory from the pairwise distances,
+# quadratic in the number of particles
+AG_MAX = 20000
+
+
+# --------------------------- Processing functions -----------------------------------
+def normalizeImages(images, mask):
+    """Flatten the pixels of the images within the mask, with zero mean and unit norm, so their dot product is the
+    normalized cross-correlation."""
+    vectors = images[:, mask].astype(np.float32)
+    vectors -= vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def getKnnSimilarities(ccMatrix, k, tileSize=TILE_SIZE):
+    """Sparse similarity keeping the k nearest neighbours of each particle, read from the (memory mapped) similarity
+    matrix in tiles of rows. It is symmetrized, so it is returned as the arrays (rows, cols, similarities) of the
+    union of the neighbourhoods, sorted by row."""
+    n = len(ccMatrix)
+    k = min(k, n - 1)
+    rows, cols, sims = [], [], []
+    for i0 in range(0, n, tileSize):
+        i1 = min(i0 + tileSize, n)
+        tile = np.array(ccMatrix[i0:i1], dtype=np.float32)
+        tile[np.arange(i1 - i0), np.arange(i0, i1)] = -np.inf  # Self similarities are the preferences
+        neighbours = np.argpartition(-tile, k - 1, axis=1)[:, :k]
+        rows.append(np.repeat(np.arange(i0, i1), k))
+        cols.append(neighbours.ravel())
+        sims.append(tile[np.arange(i1 - i0)[:, None], neighbours].ravel())
+    rows, cols, sims = np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
+    rows, cols, sims = np.concatenate([rows, cols]), np.concatenate([cols, rows]), np.concatenate([sims, sims])
+    _, unique = np.unique(rows.astype(np.int64) * n + cols, return_index=True)  # Sorted by row and column
+    return rows[unique], cols[unique], sims[unique]
+
+
+def sparseAffinityPropagation(rows, cols, sims, n, preference, damping=0.5, maxIter=2000, convIter=40):
+    """Affinity propagation passing messages only along the given edges (rows, cols, similarities), sorted by row.
+    Return the exemplar indices."""
+    rows = np.concatenate([rows, np.arange(n)])
+    cols = np.concatenate([cols, np.arange(n)])
+    sims = np.concatenate([sims, np.full(n, preference, dtype=np.float32)]).astype(np.float64)
+    order = np.lexsort((cols, rows))
+    rows, cols, sims = rows[order], cols[order], sims[order]
+    # Remove degeneracies, as done by scikit-learn
+    sims += (np.finfo(np.float64).eps * sims + np.finfo(np.float64).tiny * 100) * \
+        np.random.RandomState(0).randn(len(sims))
+    rowStarts = np.searchsorted(rows, np.arange(n))
+    isSelf = rows == cols
+    selfInds = np.where(isSelf)[0]
+    resp = np.zeros_like(sims)
+    avail = np.zeros_like(sims)
+    exemplars = np.zeros(n, dtype=bool)
+    nStable = 0
+    for it in range(maxIter):
+        # Responsibilities
+        aS = avail + sims
+        max1 = np.maximum.reduceat(aS, rowStarts)
+        isMax = aS == max1[rows]
+        maxInds = np.where(isMax)[0]
+        maxInds = maxInds[np.unique(rows[maxInds], return_index=True)[1]]  # First maximum of each row
+        aS[maxInds] = -np.inf
+        max2 = np.maximum.reduceat(aS, rowStarts)
+        newResp = sims - max1[rows]
+        newResp[maxInds] = sims[maxInds] - max2[rows[maxInds]]
+        resp = damping * resp + (1 - damping) * newResp
+        # Availabilities
+        respPos = np.maximum(resp, 0)
+        respPos[selfInds] = resp[selfInds]
+        colSums = np.bincount(cols, weights=respPos, minlength=n)
+        newAvail = colSums[cols] - respPos
+        newAvail[~isSelf] = np.minimum(newAvail[~isSelf], 0)
+        avail = damping * avail + (1 - damping) * newAvail
+        # Convergence
+        newExemplars = np.zeros(n, dtype=bool)
+        newExemplars[cols[selfInds]] = (avail[selfInds] + resp[selfInds]) > 0
+        nStable = nStable + 1 if np.array_equal(newExemplars, exemplars) else 0
+        exemplars = newExemplars
+        if nStable >= convIter and exemplars.any():
+            break
+    return np.where(exemplars)[0]
+
+
+def assignToExemplars(ccMatrix, exemplars, tileSize=TILE_SIZE):
+    """Label of each particle, being the index of the most similar exemplar."""
+    labels = np.zeros(len(ccMatrix), dtype=int)
+    for i0 in range(0, len(ccMatrix), tileSize):
+        labels[i0:i0 + tileSize] = np.argmax(np.asarray(ccMatrix[i0:i0 + tileSize])[:, exemplars], axis=1)
+    labels[exemplars] = np.arange(len(exemplars))
+    return labels
+
+
+def getChunks(n, chunkSize, minSize=1):
+    """Ranges of chunks of chunkSize elements. The last one is merged with the previous one if it is smaller than
+    minSize."""
+    bounds = list(range(0, n, chunkSize)) + [n]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < minSize:
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def miniBatchKMeans(data, nClusters, batchSize=TILE_SIZE, nEpochs=MINI_BATCH_EPOCHS):
+    """K-means fitted with mini-batches read in chunks from the (memory mapped) feature vectors, so the memory is
+    bounded by the batch size and the time grows linearly with the number of particles."""
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    randomState = np.random.RandomState(0)
+    chunks = getChunks(len(data), max(batchSize, nClusters), minSize=nClusters)
+    # The particles are usually sorted (e.g. by tomogram), so the centers are initialized with a random sample of them
+    # and the chunks are visited in random order
+    nSamples = min(len(data), max(3 * batchSize, nClusters))
+    samples = np.sort(randomState.choice(len(data), nSamples, replace=False))
+    initCenters = KMeans(n_clusters=nClusters, n_init=1, random_state=0).fit(np.asarray(data[samples])).cluster_centers_
+    # Centers missing from a chunk (particles sorted) must not be reassigned
+    kmeans = MiniBatchKMeans(n_clusters=nClusters, init=initCenters, n_init=1, reassignment_ratio=0, random_state=0)
+    for _ in range(nEpochs):
+        for chunk in randomState.permutation(len(chunks)):
+            first, last = chunks[chunk]
+            kmeans.partial_fit(np.asarray(data[first:last]))
+    labels = np.zeros(len(data), dtype=int)
+    for first, last in chunks:
+        labels[first:last] = kmeans.predict(np.asarray(data[first:last]))
+    return labels
+
+
+def cluster(alg, data, nClusters=None, apPref=None, apDumping=0.5, apMaxIter=2000, apConvIter=40, apKnn=0,
+            miniBatchSize=0):
+    """Return the labels and, for AP, the exemplar indices. If apKnn is greater than 0, AP is carried out with the
+    similarities to the apKnn nearest neighbours of each particle, instead of with the dense similarity matrix. If
+    miniBatchSize is greater than 0, K-means is fitted with mini-batches of that size."""
+    if alg == AP and apKnn:
+        rows, cols, sims = getKnnSimilarities(data, apKnn)
+        if apPref is None:
+            apPref = float(np.median(sims))
+        exemplars = sparseAffinityPropagation(rows, cols, sims, len(data), apPref, damping=apDumping,
+                                              maxIter=apMaxIter, convIter=apConvIter)
+        if not len(exemplars):
+            return np.full(len(data), -1), exemplars
+        return assignToExemplars(data, exemplars), exemplars
+    elif alg == AP:
+        from sklearn.cluster import AffinityPropagation
+        # The float64 conversion already copies the similarity matrix, so scikit-learn can modify it in place
+        ap = AffinityPropagation(affinity='precomputed', preference=apPref, damping=apDumping, max_iter=apMaxIter,
+                                 convergence_iter=apConvIter, copy=False)
+        labels = ap.fit_predict(np.array(data, dtype=np.float64))
+        return labels, ap.cluster_centers_indices_
+    elif alg == AG:
+        from sklearn.cluster import AgglomerativeClustering
+        return AgglomerativeClustering(n_clusters=nClusters, linkage='ward').fit_predict(data), None
+    elif miniBatchSize:
+        return miniBatchKMeans(data, nClusters, batchSize=miniBatchSize), None
+    else:
+        from sklearn.cluster import KMeans
+        return KMeans(n_clusters=nClusters, random_state=0).fit_predict(data), None
+
+
+def getClassReferences(particles, labels, exemplars=None):
+    """Reference image of each class, being the exemplar if provided or the class average otherwise."""
+    references = {}
+    for label in np.unique(labels[labels >= 0]):
+        if exemplars is not None:
+            references[label] = np.asarray(particles[exemplars[label]], dtype=np.float32)
+        else:
+            references[label] = np.asarray(particles[labels == label], dtype=np.float32).mean(axis=0)
+    return references
+
+
+def purgeClasses(labels, particles, mask, minSize=0, minCCRef=0, exemplars=None):
+    """Purge (label -1) the classes with less than minSize particles or whose mean cross correlation against their
+    reference is lower than minCCRef. The remaining classes are renumbered consecutively from 0."""
+    labels = np.array(labels)
+    if minSize:
+        sizes = np.bincount(labels[labels >= 0])
+        labels[np.isin(labels, np.where(sizes < minSize)[0])] = -1
+    if minCCRef:
+        references = getClassReferences(particles, labels, exemplars)
+        for label, reference in references.items():
+            members = np.where(labels == label)[0]
+            refVector = normalizeImages(reference[None], mask)[0]
+            ccs = normalizeImages(np.asarray(particles[members]), mask) @ refVector
+            if ccs.mean() < minCCRef:
+                labels[members] = -1
+    newLabels = np.full_like(labels, -1)
+    for newLabel, label in enumerate(np.unique(labels[labels >= 0])):
+        newLabels[labels == label] = newLabel
+    return newLabels
+
+
+def writeResults(outDir, labels, rows, starLabels, particles, voxelSize, exemplars=None):
+    """Write the classification results with the same layout as pySeg: star files with all the classified particles
+    and with the particles of each class, and the class references."""
+    hasClassCol = CLASS_NUMBER in starLabels
+    outLabels = starLabels if hasClassCol else starLabels + [CLASS_NUMBER]
+    classCol = outLabels.index(CLASS_NUMBER)
+
+    def _getRow(i):
+        row = list(rows[i]) if hasClassCol else list(rows[i]) + [0]
+        row[classCol] = labels[i]
+        return row
+
+    classIds = np.unique(labels[labels >= 0])
+    writeStar(join(outDir, '%s_gather.star' % OUT_STEM), outLabels,
+              [_getRow(i) for i in np.where(labels >= 0)[0]])
+    refsDir = join(outDir, '%s_%s' % (OUT_STEM, 'exemplars' if exemplars is not None else 'averages'))
+    os.makedirs(refsDir, exist_ok=True)
+    if exemplars is not None:
+        # Exemplar of each of the new labels
+        exemplars = [[i for i in exemplars if labels[i] == label][0] for label in classIds]
+    references = getClassReferences(particles, labels, exemplars)
+    for label in classIds:
+        members = np.where(labels == label)[0]
+        writeStar(join(outDir, '%s_k%i_split.star' % (OUT_STEM, label)), outLabels, [_getRow(i) for i in members])
+        writeVolume(references[label], join(refsDir, 'class_k%i.mrc' % label), voxelSize=voxelSize)
+
+
+# --------------------------- Main -----------------------------------
+def getSimilarityFile(cacheDir, clusteringAlg):
+    """File of the pySeg outputs used by the clustering algorithm: the CC matrix (AP) or the feature vectors."""
+    return join(cacheDir, CC_MATRIX if clusteringAlg == AP else FEATURE_VECTORS)
+
+
+def getClusteringScore(data, labels, precomputed=False, maxSamples=5000):
+    """Silhouette score of the clustering, estimated with a random subset of particles for large sets. The
+    similarities are converted into distances if precomputed."""
+    from sklearn.metrics import silhouette_score
+    samples = np.where(labels >= 0)[0]
+    if len(samples) > maxSamples:
+        samples = np.sort(np.random.RandomState(0).choice(samples, maxSamples, replace=False))
+    sampleLabels = labels[samples]
+    nLabels = len(np.unique(sampleLabels))
+    if nLabels < 2 or nLabels >= len(samples):
+        return float('nan')
+    if precomputed:
+        # Read by blocks of rows, as the similarity matrix may be a memory map larger than the available memory
+        similarities = np.concatenate([np.asarray(data[samples[first:first + TILE_SIZE]])[:, samples]
+                                       for first in range(0, len(samples), TILE_SIZE)]).astype(np.float64)
+        distances = similarities.max() - similarities
+        np.fill_diagonal(distances, 0)
+        return float(silhouette_score(distances, sampleLabels, metric='precomputed'))
+    return float(silhouette_score(np.asarray(data[samples]), sampleLabels))
+
+
+def getApKnn(apKnn, nParticles, nWorkers=1):
+    """Number of neighbours used by AP, being 0 (dense similarity matrix) if it is automatic (negative), the particle
+    set is small enough and the dense AP of the nWorkers running in parallel fits in the memory budget. The dense
+    matrix requested explicitly (0) is only used if it fits in the available memory."""
+    denseMemory = nWorkers * nParticles ** 2 * DENSE_AP_BYTES_PER_ENTRY
+    availableMemory = getAvailableMemory()
+    fitsInMemory = availableMemory is None or denseMemory <= availableMemory
+    if apKnn < 0:
+        return 0 if nParticles <= DENSE_AP_MAX and denseMemory <= DENSE_AP_MEMORY and fitsInMemory else DEFAULT_AP_KNN
+    if apKnn == 0 and not fitsInMemory:
+        print('AP on the dense similarity matrix requires %.1f GB, more than the available memory, so the %i nearest '
+              'neighbours are used instead' % (denseMemory / 2 ** 30, DEFAULT_AP_KNN))
+        return DEFAULT_AP_KNN
+    return apKnn
+
+
+def getAvailableMemory():
+    """Available memory in bytes, or None if it can't be read."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def getMiniBatchSize(miniBatchSize, nParticles):
+    """Size of the chunks used by the incremental PCA and mini-batch K-means, being 0 (in memory) if it is automatic
+    (negative) and the particle set is small enough."""
+    if miniBatchSize < 0:
+        return 0 if nParticles <= IN_MEMORY_MAX else DEFAULT_MINI_BATCH
+    return miniBatchSize
+
+
+def runClusteringSetting(args, value, outDir, rows, starLabels, voxelSize):
+    """Cluster the particles with a value of the swept parameter (AP preference or number of clusters), post-process
+    the classes and write the results. It can be executed in a worker process, as the pySeg outputs are read from
+    their memory maps."""
+    data = np.load(getSimilarityFile(args.cacheDir, args.clusteringAlg), mmap_mode='r')
+    particles = readImageStack(join(args.cacheDir, PARTICLES_STACK))
+    mask = np.asarray(readImageStack(join(args.cacheDir, MASKS_STACK))[0]) > 0
+    tStart = time.time()
+    isAP = args.clusteringAlg == AP
+    labels, exemplars = cluster(args.clusteringAlg, data, nClusters=None if isAP else int(value),
+                                apPref=value if isAP else None,
+                                apDumping=args.apDumping, apMaxIter=args.apMaxIter, apConvIter=args.apConvIter,
+                                apKnn=args.apKnn,
+                                miniBatchSize=getMiniBatchSize(args.miniBatchSize, len(data)))
+    score = getClusteringScore(data, labels, precomputed=isAP)
+    if exemplars is not None and args.apReference == AVERAGE:
+        exemplars = None
+    labels = purgeClasses(labels, particles, mask, minSize=args.apPartSizeFilter,
+                          minCCRef=args.apCCRefFilter if isAP else 0, exemplars=exemplars)
+    os.makedirs(outDir, exist_ok=True)
+    writeResults(outDir, labels, rows, starLabels, particles, voxelSize, exemplars=exemplars)
+    sizes = np.bincount(labels[labels >= 0]) if (labels >= 0).any() else np.zeros(0, dtype=int)
+    print('Clustering with %s done in %.1f s: %i classes' % (value, time.time() - tStart, len(sizes)))
+    return len(sizes), score, sizes.tolist()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--inStar', required=True)
+    parser.add_argument('--cacheDir', required=True,
+                        help='Output directory of pySeg plane_align_class.py run up to the cross correlation matrix / '
+                             'feature vectors processing level')
+    parser.add_argument('--outDir', required=True)
+    parser.add_argument('--clusteringAlg', choices=[AP, AG, KMEANS], default=AP)
+    parser.add_argument('--nClusters', type=int, nargs='+', default=[50],
+                        help='Several values will be swept, writing the results of each one in a sub-directory')
+    parser.add_argument('--apPref', type=float, nargs='+', default=[None],
+                        help='Several values will be swept, writing the results of each one in a sub-directory')
+    parser.add_argument('--apDumping', type=float, default=0.5)
+    parser.add_argument('--apMaxIter', type=int, default=2000)
+    parser.add_argument('--apConvIter', type=int, default=40)
+    parser.add_argument('--apReference', choices=[EXEMPLAR, AVERAGE], default=AVERAGE)
+    parser.add_argument('--apCCRefFilter', type=float, default=0)
+    parser.add_argument('--apPartSizeFilter', type=int, default=0)
+    parser.add_argument('--apKnn', type=int, default=-1,
+                        help='Nearest neighbours of each particle used by AP. 0 uses the dense similarity matrix and a '
+                             'negative value chooses automatically depending on the number of particles')
+    parser.add_argument('--miniBatchSize', type=int, default=-1,
+                        help='Batch size of the mini-batch K-means. 0 computes it in memory and a negative value '
+                             'chooses automatically depending on the number of particles')
+    parser.add_argument('-j', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    starLabels, rows = readStar(args.inStar)
+    nParticles = len(np.load(getSimilarityFile(args.cacheDir, args.clusteringAlg), mmap_mode='r'))
+    if nParticles != len(rows):
+        raise ValueError('The pySeg outputs in %s correspond to %i particles, while %s contains %i'
+                         % (args.cacheDir, nParticles, args.inStar, len(rows)))
+    if args.clusteringAlg == AG and nParticles > AG_MAX:
+        raise ValueError('AG is computed in memory with a cost quadratic in the number of particles, so it is limited '
+                         'to %i particles (%i given). Use K-means instead.' % (AG_MAX, nParticles))
+    voxelSize = getVoxelSize(rows[0][starLabels.index(IMAGE_NAME)])
+
+    values = args.apPref if args.clusteringAlg == AP else args.nClusters
+    nWorkers = max(1, min(args.j, len(values)))
+    if args.clusteringAlg == AP:
+        args.apKnn = getApKnn(args.apKnn, len(rows), nWorkers=nWorkers)
+    if len(values) == 1:
+        runClusteringSetting(args, values[0], args.outDir, rows, starLabels, voxelSize)
+        return
+    # Parameter sweep: each value is clustered in parallel
+    from concurrent.futures import ProcessPoolExecutor
+    outDirs = [join(args.outDir, SWEEP_DIR % (i + 1)) for i in range(len(values))]
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        futures = [pool.submit(runClusteringSetting, args, value, outDir, rows, starLabels, voxelSize)
+                   for value, outDir in zip(values, outDirs)]
+        results = [future.result() for future in futures]
+    writeStar(join(args.outDir, SWEEP_STAR), SWEEP_LABELS,
+              [[value, nClasses, score, ','.join(str(size) for size in sizes) or NO_CLASS_SIZES]
+               for value, (nClasses, score, sizes) in zip(values, results)])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""CPU placement of the pySeg processes: each running step gets a disjoint set of CPUs, taken from a single NUMA node
+when possible, so the concurrent steps do not compete for the same cores and memory bandwidth. The CPUs are allocated
+in a file shared by all the processes of the user in the node, so the steps of concurrent protocols are placed on
+different CPUs too."""
+import fcntl
+import glob
+import json
+import os
+import re
+import socket
+import threading
+from contextlib import contextmanager
+from os.path import join, isdir
+
+NUMA_NODES_DIR = '/sys/devices/system/node'
+SHM_DIR = '/dev/shm'
+ALLOCATION_FILE = 'pyseg_cpu_allocation_%i.json'  # One per user
+
+
+class CpuPlacer:
+    """Allocator of the CPUs available to the current process among the steps run in parallel by the processes of the
+    node. The allocations are stored in allocationFile, locked while being updated, and the ones of processes that
+    are no longer running are discarded."""
+
+    def __init__(self, cpus=None, numaNodes=None, allocationFile=None):
+        self.cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+        cpuSet = set(self.cpus)
+        # Only the available CPUs of each NUMA node are considered
+        nodes = [sorted(cpuSet.intersection(node)) for node in (numaNodes or getNumaNodes())]
+        self.nodes = [node for node in nodes if node] or [self.cpus]
+        self.allocationFile = allocationFile or getAllocationFile()
+        self._host = socket.gethostname()
+
+    def acquire(self, nCpus):
+        """Reserve nCpus CPUs, from the NUMA node that better fits them or spread over the nodes with more free CPUs
+        if none of them has enough. Return the list of reserved CPUs or None if there are not enough free CPUs."""
+        with self._allocations() as allocations:
+            used = {cpu for allocation in allocations for cpu in allocation['cpus']}
+            freeNodes = [[cpu for cpu in node if cpu not in used] for node in self.nodes]
+            if sum(len(node) for node in freeNodes) < nCpus:
+                return None
+            fittingNodes = [node for node in freeNodes if len(node) >= nCpus]
+            if fittingNodes:
+                cpus = min(fittingNodes, key=len)[:nCpus]
+            else:
+                cpus = []
+                for node in sorted(freeNodes, key=len, reverse=True):
+                    cpus += node[:nCpus - len(cpus)]
+            allocations.append({'host': self._host, 'pid': os.getpid(), 'cpus': cpus})
+            return cpus
+
+    def release(self, cpus):
+        with self._allocations() as allocations:
+            allocation = {'host': self._host, 'pid': os.getpid(), 'cpus': list(cpus)}
+            if allocation in allocations:
+                allocations.remove(allocation)
+
+    @contextmanager
+    def _allocations(self):
+        """Exclusive access to the list of allocations of the running processes, written back on exit."""
+        with open(self.allocationFile, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    allocations = json.loads(f.read() or '[]')
+                except ValueError:  # Corrupted, e.g. by a node crash while writing it
+                    allocations = []
+                allocations = [allocation for allocation in allocations
+                               if allocation['host'] != self._host or isRunning(allocation['pid'])]
+                yield allocations
+                f.seek(0)
+                f.truncate()
+                json.dump(allocations, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_placer = None
+_placerLock = threading.Lock()
+
+
+def getCpuPlacer():
+    """CPU placer shared by all the steps of the current process."""
+    global _placer
+    with _placerLock:
+        if _placer is None:
+            _placer = CpuPlacer()
+        return _placer
+
+
+# ---- UTIL functions ----
+def getNumaNodes(nodesDir=NUMA_NODES_DIR):
+    """List of the CPUs of each NUMA node, or an empty list if the system does not provide them."""
+    nodes = []
+    for cpuListFile in sorted(glob.glob(join(nodesDir, 'node*', 'cpulist'))):
+        with open(cpuListFile) as f:
+            nodes.append(parseCpuList(f.read()))
+    return nodes
+
+
+def getAllocationFile():
+    """File of the CPU allocations, in shared memory if available or in the EM root otherwise."""
+    if isdir(SHM_DIR):
+        directory = SHM_DIR
+    else:
+        import pwem
+        directory = pwem.Config.EM_ROOT
+    return join(directory, ALLOCATION_FILE % os.getuid())
+
+
+def isRunning(pid):
+    """Check if a process of the current node is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Running, but owned by another user
+        return True
+    return True
+
+
+def parseCpuList(cpuList):
+    """CPUs contained in a list in the kernel format, e.g. 0-3,8-11."""
+    cpus = []
+    for item in re.split(r'[,\s]+', cpuList.strip()):
+        if item:
+            first, _, last = item.partition('-')
+            cpus += list(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def formatCpuList(cpus):
+    """Inverse of parseCpuList, as expected by taskset -c."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join('%i-%i' % (first, last) if last > first else str(first) for first, last in ranges)
@@ -24,9 +24,31 @@
 # *
 # **************************************************************************
 
-from .protocol_post_rec_particles import ProtPySegPostRecParticles
-from .protocol_graphs import ProtPySegGraphs
-from .protocol_fils import ProtPySegFils
-from .protocol_picking import ProtPySegPicking
-from .protocol_pre_seg import ProtPySegPreSegParticles
-from .protocol_2d_classification import ProtPySegPlaneAlignClassification
+import importlib
+
+# Lightweight registry of the protocols: each module, with its dependencies, is only imported when its protocol is
+# requested, e.g. by the Scipion protocols discovery, and not when the plugin is loaded
+_PROTOCOL_MODULES = {
+    'ProtPySegPostRecParticles': 'protocol_post_rec_particles',
+    'ProtPySegGraphs': 'protocol_graphs',
+    'ProtPySegFils': 'protocol_fils',
+    'ProtPySegPicking': 'protocol_picking',
+    'ProtPySegPreSegParticles': 'protocol_pre_seg',
+    'ProtPySegPlaneAlignClassification': 'protocol_2d_classification',
+    'ProtPySegAssignToClasses': 'protocol_assign_classes',
+    'ProtPySegVesiclePipeline': 'protocol_vesicle_pipeline',
+}
+__all__ = list(_PROTOCOL_MODULES)
+
+
+def __getattr__(name):
+    if name in _PROTOCOL_MODULES:
+        protocol = getattr(importlib.import_module('.' + _PROTOCOL_MODULES[name], __name__), name)
+        globals()[name] = protocol
+        return protocol
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    # Listed by the protocols discovery, which then gets them
+    return sorted(set(globals()).union(__all__))
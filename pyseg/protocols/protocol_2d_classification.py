@@ -24,22 +24,27 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import json
 from enum import Enum
-from os.path import abspath, join, exists
+from os.path import abspath, join, exists, basename
 import glob
 from emtable import Table
 from pwem.protocols import EMProtocol, PointerParam
 from pyseg.convert import readPysegSubtomograms
-from pyseg.utils import checkMaskFormat, getFinalMaskFileName
+from pyseg.convert.convert import cachedSubtomograms2PysegStar, getStackMembersDict
+from pyseg.utils import checkMaskFormat, getFinalMaskFileName, getPosRecMask, getFileHash
 from pyworkflow.object import String
-from pyworkflow.protocol import EnumParam, IntParam, LEVEL_ADVANCED, FloatParam, GE, LT, BooleanParam
-from pyworkflow.utils import Message, makePath
-from reliontomo.convert import createWriterTomo
-from scipion.constants import PYTHON
+from pyworkflow.protocol import EnumParam, IntParam, LEVEL_ADVANCED, FloatParam, GE, LT, BooleanParam, \
+    NumericListParam
+from pyworkflow.utils import Message, makePath, createLink, cleanPath, getListFromValues, removeBaseExt
 from tomo.objects import SetOfSubTomograms, SetOfClassesSubTomograms
 from tomo.protocols import ProtTomoBase
 from pyseg import Plugin
-from pyseg.constants import PLANE_ALIGN_CLASS_OUT, PLANE_ALIGN_CLASS_SCRIPT, SEE_METHODS_TAB
+from pyseg.constants import PLANE_ALIGN_CLASS_OUT, PLANE_ALIGN_CLASS_SCRIPT, SEE_METHODS_TAB, PLANE_ALIGN_CACHE_DIR, \
+    PYTHON, PLANE_ALIGN_CACHE_INFO
+from pyseg.engines import PLANE_ALIGN_ENGINE
+from pyseg.engines.plane_align import SWEEP_DIR, SWEEP_STAR, NO_CLASS_SIZES, DENSE_AP_MAX, DENSE_AP_MEMORY, \
+    DEFAULT_AP_KNN, IN_MEMORY_MAX, DEFAULT_MINI_BATCH, AG_MAX
 
 
 # Processing level choices
@@ -61,14 +66,25 @@ AFFINITY_PROP = 0           # Affinity propagation
 AGGLOMERATIVE = 1           # Agglomerative clustering
 KMEANS = 2                  # K-means
 
-# Affinity propagation condition
+# Clustering algorithm conditions
 AP_CONDITION = 'clusteringAlg == %s' % AFFINITY_PROP
 NOT_AP_CONDITION = 'clusteringAlg != %s' % AFFINITY_PROP
+KMEANS_CONDITION = 'clusteringAlg == %s' % KMEANS
 
 # Affinity Propagation reference choices
 EXEMPLAR = 0
 AVERAGE = 1
 
+# Parameter sweep
+SWEEP_HELP = ('Several values can be introduced to sweep them with the plugin engine. The cross correlation matrix '
+              'or the feature vectors are computed only once and the clustering with each value is carried out in '
+              'parallel, generating a set of classes for each one of them.')
+
+# Classification engines
+CLASS_PYSEG = 0
+CLASS_PLUGIN = 1
+PLUGIN_ENGINE_CONDITION = 'classEngine == %i' % CLASS_PLUGIN
+
 
 class outputObjects(Enum):
     subtomograms = SetOfSubTomograms
@@ -82,6 +98,8 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
     inStarName = 'input_particles.star'
     _dataTable = Table()
     _outDir = None
+    _resultsDir = None
+    _representativesDict = {}
     _warningMsg = String()
     _distanceMetric = None
 
@@ -102,8 +120,30 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
                       pointerClass='VolumeMask',
                       label='Mask',
                       important=True,
-                      allowsNull=False,
-                      help='Mask used for the post processing')
+                      allowsNull=True,
+                      help='Mask used for the classification. If empty, the one recorded in the input subtomograms '
+                           'by the posrec protocol when randomizing the rot angle only in the metadata is used, as '
+                           'the particles were not multiplied by it.')
+        form.addParam('classEngine', EnumParam,
+                      label='Classification engine',
+                      choices=['PySeg script', 'PySeg pre-processing + plugin clustering'],
+                      default=CLASS_PYSEG,
+                      display=EnumParam.DISPLAY_HLIST,
+                      help='*PySeg script*: all the processing is carried out by pySeg in each run.\n'
+                           '*PySeg pre-processing + plugin clustering*: pySeg is run only up to the cross correlation '
+                           'matrix (AP) or the feature vectors (AG and K-means), which are kept and clustered by the '
+                           'plugin with the same algorithms. Thus, the pre-processing can be reused by other runs that '
+                           'only change the clustering parameters, several values of them can be swept in a single '
+                           'run and large sets can be clustered with bounded memory.')
+        form.addParam('prevClassProt', PointerParam,
+                      pointerClass='ProtPySegPlaneAlignClassification',
+                      allowsNull=True,
+                      condition=PLUGIN_ENGINE_CONDITION,
+                      label='Reuse intermediate results of (opt.)',
+                      help='Previous 2D classification run, executed with the plugin clustering on the same '
+                           'subtomograms, whose pySeg cross correlation matrix or feature vectors will be reused if '
+                           'they were computed with the same pre-processing parameters. Thus, only the clustering '
+                           'will be carried out when sweeping the clustering parameters.')
         form.addParam('clusteringAlg', EnumParam,
                       label='Clustering algorithm',
                       choices=['Affinity propagation', 'Agglomerative clustering', 'K-means'],
@@ -146,18 +186,34 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
                        condition=NOT_AP_CONDITION,
                        help='Number of components (moments) after the reductions.\nIf 0 or None, '
                             'then they will be automatically estimated considering the size ob the input subtomograms.')
+        group.addParam('miniBatchSize', IntParam,
+                       label='Particles per mini-batch',
+                       default=-1,
+                       validators=[GE(-1)],
+                       expertLevel=LEVEL_ADVANCED,
+                       condition='%s and %s' % (KMEANS_CONDITION, PLUGIN_ENGINE_CONDITION),
+                       help='K-means is fitted with mini-batches of this size, reading the pySeg feature vectors '
+                            'from disk in chunks, so the memory of the clustering depends on the mini-batch size '
+                            'instead of on the number of particles. If 0, it is computed in memory. If -1, it is '
+                            'chosen automatically, using the memory up to %i particles and mini-batches of %i '
+                            'particles for larger sets.\nIt does not apply to the agglomerative clustering, which is '
+                            'always computed in memory with a cost quadratic in the number of particles, so it is '
+                            'limited to %i particles with the plugin clustering.'
+                            % (IN_MEMORY_MAX, DEFAULT_MINI_BATCH, AG_MAX))
 
         group = form.addGroup('Parameters of chosen classification algorithm')
-        group.addParam('aggNClusters', IntParam,
+        group.addParam('aggNClusters', NumericListParam,
                        label='Number of clusters to find',
-                       default=50,
-                       condition=NOT_AP_CONDITION)
-        group.addParam('apPref', FloatParam,
+                       default='50',
+                       condition=NOT_AP_CONDITION,
+                       help='%s' % SWEEP_HELP)
+        group.addParam('apPref', NumericListParam,
                        label='Affinity propagation preference (-inf, inf)',
-                       default=-6,
+                       default='-6',
                        condition=AP_CONDITION,
                        help='Preference parameter (-inf, inf).\nThe smaller value the higher number of '
-                            'potential classes.\nIf None, the median of the affinity class is considered.')
+                            'potential classes.\nIf None, the median of the affinity class is considered.\n%s'
+                            % SWEEP_HELP)
         group.addParam('apDumping', FloatParam,
                        label='Dumping [0.5, 1)',
                        default=0.5,
@@ -181,6 +237,18 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
                        default=AVERAGE,
                        condition=AP_CONDITION,
                        expertLevel=LEVEL_ADVANCED)
+        group.addParam('apKnn', IntParam,
+                       label='Nearest neighbours per particle',
+                       default=-1,
+                       validators=[GE(-1)],
+                       condition='%s and %s' % (AP_CONDITION, PLUGIN_ENGINE_CONDITION),
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Number of most similar particles considered by AP for each particle. Using only them '
+                            'makes the memory and time of AP grow linearly with the number of particles instead of '
+                            'quadratically. If 0, the dense similarity matrix is used, unless it does not fit in '
+                            'the available memory. If -1, it is chosen automatically, using the dense matrix up to %i '
+                            'particles, if it requires less than %i GB, and %i neighbours otherwise.'
+                            % (DENSE_AP_MAX, DENSE_AP_MEMORY // 2 ** 30, DEFAULT_AP_KNN))
 
         group = form.addGroup('Classification post-processing', expertLevel=LEVEL_ADVANCED)
         group.addParam('apPartSizeFilter', IntParam,
@@ -211,41 +279,74 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
         """
         subtomoSet = self.inputSubtomos.get()
         subTomoStar = self._getExtraPath(self.inStarName)
-        writer = createWriterTomo(isPyseg=True)
-        writer.subtomograms2Star(subtomoSet, subTomoStar)
+        cachedSubtomograms2PysegStar(subtomoSet, subTomoStar)
         # Convert the mask format if necessary
-        checkMaskFormat(self.inMask.get())
+        if self.inMask.get():
+            checkMaskFormat(self.inMask.get())
 
     def pysegPlaneAlignClassification(self):
-        # Script called
-        Plugin.runPySeg(self, PYTHON, self. _getCommand())
+        if self.classEngine.get() == CLASS_PLUGIN:
+            self._runPysegPreprocessing()
+            Plugin.runPySeg(self, PYTHON, self._getEngineCommand(), nJobs=self.numberOfThreads.get())
+        else:
+            # Script called
+            Plugin.runPySeg(self, PYTHON, self.getPysegCommand(), nJobs=self.numberOfThreads.get())
 
     def createOutputStep(self):
-        # Read generated star file and create the output objects:
+        # Read generated star file and create the output objects, a set of subtomograms and a set of classes for each
+        # one of the swept clustering parameter values, if more than one
+        inSubtomoSet = self.inputSubtomos.get()
+        resultsDirs = self._getResultsDirs()
+        outputs = {}
+        for i, resultsDir in enumerate(resultsDirs):
+            suffix = '_%i' % (i + 1) if len(resultsDirs) > 1 else ''
+            outSubtomoSet, classesSet = self._createOutputSets(resultsDir, suffix)
+            outputs[outputObjects.subtomograms.name + suffix] = outSubtomoSet
+            outputs[outputObjects.classes.name + suffix] = classesSet
+
+        self._defineOutputs(**outputs)
+        for outSet in outputs.values():
+            self._defineSourceRelation(inSubtomoSet, outSet)
+
+    def _createOutputSets(self, resultsDir, suffix=''):
         # 1) Set of subtomograms
         inSubtomoSet = self.inputSubtomos.get()
-        outSubtomoSet = SetOfSubTomograms.create(self._getPath(), template='setOfSubTomograms%s.sqlite')
+        outSubtomoSet = SetOfSubTomograms.create(self._getPath(), template='setOfSubTomograms%s.sqlite',
+                                                 suffix=suffix[1:])
         outSubtomoSet.copyInfo(self.inputSubtomos.get())
-        warningMsg, self._dataTable = readPysegSubtomograms(self._getGatheredStarFile(),
+        # The particles extracted from stacks to be classified are referred to their stacks again
+        warningMsg, self._dataTable = readPysegSubtomograms(self._getGatheredStarFile(resultsDir),
                                                             inSubtomoSet,
-                                                            outSubtomoSet)
+                                                            outSubtomoSet,
+                                                            stackMembersDict=getStackMembersDict(inSubtomoSet))
         if warningMsg:
             self._warningMsg.set(warningMsg)
             self._store()
 
         # 2) Set of classes subtomograms
-        classesSet = SetOfClassesSubTomograms.create(self._getPath(), template='setOfClasses%s.sqlite')
+        classesSet = SetOfClassesSubTomograms.create(self._getPath(), template='setOfClasses%s.sqlite',
+                                                     suffix=suffix[1:])
         classesSet.setImages(outSubtomoSet)
+        self._resultsDir = resultsDir
         self._fillClasses(classesSet)
-
-        self._defineOutputs(**{outputObjects.subtomograms.name: outSubtomoSet,
-                               outputObjects.classes.name: classesSet})
-        self._defineSourceRelation(inSubtomoSet, outSubtomoSet)
-        self._defineSourceRelation(inSubtomoSet, classesSet)
+        return outSubtomoSet, classesSet
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
-        return [SEE_METHODS_TAB]
+        summary = [SEE_METHODS_TAB]
+        sweepStar = join(self._getExtraPath(PLANE_ALIGN_CLASS_OUT), SWEEP_STAR)
+        if self.isFinished() and exists(sweepStar):
+            msg = '*Parameter sweep* (output suffix, %s, number of classes, silhouette score, class sizes):\n' % \
+                  ('preference' if self.clusteringAlg.get() == AFFINITY_PROP else 'number of clusters')
+            for i, row in enumerate(Table(fileName=sweepStar)):
+                classSizes = '' if str(row.classSizes) == NO_CLASS_SIZES else row.classSizes
+                msg += '\t- _%i: %s, %s, %.3f, [%s]\n' % (i + 1, row.sweepValue, row.nClasses,
+                                                        float(row.silhouetteScore), classSizes)
+            summary.append(msg)
+        prevClassProt = self.prevClassProt.get()
+        if self.classEngine.get() == CLASS_PLUGIN and prevClassProt:
+            summary.append('pySeg pre-processing reused, if compatible, from *%s*' % prevClassProt.getObjLabel())
+        return summary
 
     def _methods(self):
         summary = []
@@ -287,25 +388,58 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
         tol = 1e-3
         inMask = self.inMask.get()
         inSubtomos = self.inputSubtomos.get()
-        maskRes = inMask.getSamplingRate()
-        subTomosRes = inSubtomos.getSamplingRate()
         nSubtomos = inSubtomos.getSize()
-        xs, ys, zs = inSubtomos.getDimensions()
-        xm, ym, zm = inMask.getDimensions()
-        if abs(maskRes - subTomosRes) > tol:
-            errors.append('Sampling rate of the input subtomograms and the input mask should be the same\n'
-                          '%2.3f != %2.3f' % (subTomosRes, maskRes))
-        if (xs, ys, zs) != (xm, ym, zm):
-            errors.append('The dimensions of the subtomograms and the mask introduced must be the same:\n'
-                          '\t- Subtomograms: (x, y, z) = (%i, %i, %i)\n'
-                          '\t- Mask: (x, y, z) = (%i, %i, %i)\n' % (xs, ys, zs, xm, ym, zm))
+        if inMask:
+            maskRes = inMask.getSamplingRate()
+            subTomosRes = inSubtomos.getSamplingRate()
+            xs, ys, zs = inSubtomos.getDimensions()
+            xm, ym, zm = inMask.getDimensions()
+            if abs(maskRes - subTomosRes) > tol:
+                errors.append('Sampling rate of the input subtomograms and the input mask should be the same\n'
+                              '%2.3f != %2.3f' % (subTomosRes, maskRes))
+            if (xs, ys, zs) != (xm, ym, zm):
+                errors.append('The dimensions of the subtomograms and the mask introduced must be the same:\n'
+                              '\t- Subtomograms: (x, y, z) = (%i, %i, %i)\n'
+                              '\t- Mask: (x, y, z) = (%i, %i, %i)\n' % (xs, ys, zs, xm, ym, zm))
+        else:
+            posRecMask = getPosRecMask(inSubtomos)
+            if not posRecMask:
+                errors.append('A mask is required, as the input subtomograms have no mask recorded by the posrec '
+                              'protocol.')
+            elif not exists(posRecMask):
+                errors.append('The mask recorded in the input subtomograms by the posrec protocol does not exist:\n'
+                              '%s' % posRecMask)
         if self.clusteringAlg.get() != AFFINITY_PROP:
-            if self.aggNClusters.get() <= 0 or self.aggNClusters.get() > nSubtomos:
+            if any(nClusters <= 0 or nClusters > nSubtomos for nClusters in self._getSweepValues()):
                 errors.append('Number of clusters to find must be in range (0, nParticles).')
             if self.pcaComps.get() > nSubtomos:
                 errors.append('Number of PCA components must be between 0 and min(n_samples, n_features).')
+        if self.classEngine.get() == CLASS_PLUGIN and self.clusteringAlg.get() == AGGLOMERATIVE and \
+                nSubtomos > AG_MAX:
+            errors.append('The agglomerative clustering is computed in memory with a cost quadratic in the number of '
+                          'particles, so it is limited to %i particles with the plugin clustering (%i given). Use '
+                          'K-means instead.' % (AG_MAX, nSubtomos))
+        if self.classEngine.get() == CLASS_PYSEG and len(self._getSweepValues()) > 1:
+            errors.append('Several values of the clustering parameters can only be swept with the plugin engine.')
+        prevClassProt = self.prevClassProt.get()
+        if self.classEngine.get() == CLASS_PLUGIN and prevClassProt:
+            if prevClassProt.classEngine.get() != CLASS_PLUGIN:
+                errors.append('The previous 2D classification run has no pySeg pre-processing to reuse, as it was '
+                              'not executed with the plugin clustering.')
+            elif prevClassProt.inputSubtomos.get().getFileName() != inSubtomos.getFileName():
+                errors.append('The previous 2D classification run was executed on different subtomograms.')
         return errors
 
+    def _warnings(self):
+        warnings = []
+        inMask = self.inMask.get()
+        posRecMask = getPosRecMask(self.inputSubtomos.get())
+        if inMask and posRecMask and getFinalMaskFileName(inMask) != posRecMask:
+            warnings.append('The rot angle of the input subtomograms was randomized only in the metadata, so they '
+                            'were not multiplied by the posrec mask (%s), and the mask introduced is a different '
+                            'one. Leave it empty to use the posrec mask.' % posRecMask)
+        return warnings
+
     # --------------------------- UTIL functions -----------------------------------
 
     def _initialize(self):
@@ -313,22 +447,42 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
         # Generate output subtomo dir
         makePath(self._outDir)
 
-    def _getGatheredStarFile(self):
-        return glob.glob(join(self._outDir, '*_gather.star'))[0]
+    def getMaskFileName(self):
+        """pySeg readable file of the classification mask: the one introduced or, if empty, the one recorded in the
+        input subtomograms by the posrec protocol."""
+        inMask = self.inMask.get()
+        return getFinalMaskFileName(inMask) if inMask else getPosRecMask(self.inputSubtomos.get())
+
+    def _getGatheredStarFile(self, resultsDir=None):
+        return glob.glob(join(resultsDir if resultsDir else self._outDir, '*_gather.star'))[0]
 
-    def _getNumberOfClasses(self):
-        return len(glob.glob(join(self._outDir, '*_split.star')))
+    def _getNumberOfClasses(self, resultsDir=None):
+        return len(glob.glob(join(resultsDir if resultsDir else self._outDir, '*_split.star')))
 
-    def _getCommand(self):
+    def _getSweepValues(self):
+        if self.clusteringAlg.get() == AFFINITY_PROP:
+            return getListFromValues(self.apPref.get(), caster=float)
+        return getListFromValues(self.aggNClusters.get(), caster=int)
+
+    def _getResultsDirs(self):
+        """Directories containing the classification results, one per swept clustering parameter value."""
+        nValues = len(self._getSweepValues())
+        if nValues == 1:
+            return [self._outDir]
+        return [join(self._outDir, SWEEP_DIR % (i + 1)) for i in range(nValues)]
+
+    def getPysegCommand(self, outDir=None, procLevel=FULL_CLASSIFICATION, inStar=None, nThreads=None):
+        """Command of pySeg plane_align_class.py, executed up to the given processing level. It is used too by the
+        assignment to classes to pre-process new particles as the classified ones."""
         alg = self.clusteringAlg.get()
         classCmd = ' '
         classCmd += '%s ' % Plugin.getHome(PLANE_ALIGN_CLASS_SCRIPT)
         classCmd += '--inRootDir scipion '
-        classCmd += '--inStar %s ' % self._getExtraPath(self.inStarName)
-        classCmd += '--inMask %s ' % getFinalMaskFileName(self.inMask.get())
-        classCmd += '--outDir %s ' % self._outDir
+        classCmd += '--inStar %s ' % (inStar if inStar else self._getExtraPath(self.inStarName))
+        classCmd += '--inMask %s ' % self.getMaskFileName()
+        classCmd += '--outDir %s ' % (outDir if outDir else self._outDir)
         classCmd += '--filterSize %s ' % self.filterSize.get()
-        classCmd += '--procLevel %s ' % (FULL_CLASSIFICATION + 1)  # Numbered from 1 in pyseg
+        classCmd += '--procLevel %s ' % (procLevel + 1)  # Numbered from 1 in pyseg
         classCmd += '--doCC3d %s ' % self.doCC3d.get()
         classCmd += '--ccMetric %s ' % self._decodeCCMetric()
         classCmd += '--clusteringAlg %s ' % self._decodeClusteringAlg()
@@ -347,10 +501,78 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
                 classCmd += '--kmeansNClusters %s ' % self.aggNClusters.get()
 
         classCmd += '--apPartSizeFilter %s ' % self.apPartSizeFilter.get()
-        classCmd += '-j %s ' % self.numberOfThreads.get()
+        classCmd += '-j %s ' % (nThreads if nThreads else self.numberOfThreads.get())
 
         return classCmd
 
+    def _getEngineCommand(self):
+        alg = self.clusteringAlg.get()
+        classCmd = ' '
+        classCmd += '%s ' % PLANE_ALIGN_ENGINE
+        classCmd += '--inStar %s ' % self._getExtraPath(self.inStarName)
+        classCmd += '--cacheDir %s ' % self._getExtraPath(PLANE_ALIGN_CACHE_DIR)
+        classCmd += '--outDir %s ' % self._outDir
+        classCmd += '--clusteringAlg %s ' % self._decodeClusteringAlg()
+        if alg == AFFINITY_PROP:
+            classCmd += '--apPref %s ' % ' '.join(str(value) for value in self._getSweepValues())
+            classCmd += '--apDumping %s ' % self.apDumping.get()
+            classCmd += '--apMaxIter %s ' % self.apMaxIter.get()
+            classCmd += '--apConvIter %s ' % self.apConvIter.get()
+            classCmd += '--apReference %s ' % ('exemplar' if self.apReference.get() == EXEMPLAR else 'average')
+            classCmd += '--apKnn %s ' % self.apKnn.get()
+            classCmd += '--apCCRefFilter %s ' % self.apCCRefFilter.get()
+        else:
+            if alg == KMEANS:
+                classCmd += '--miniBatchSize %s ' % self.miniBatchSize.get()
+            classCmd += '--nClusters %s ' % ' '.join(str(value) for value in self._getSweepValues())
+        classCmd += '--apPartSizeFilter %s ' % self.apPartSizeFilter.get()
+        classCmd += '-j %s ' % self.numberOfThreads.get()
+        return classCmd
+
+    def _runPysegPreprocessing(self):
+        """Run pySeg up to the cross correlation matrix / feature vectors level into the cache directory, unless its
+        outputs or the ones of the previous run were computed with the same pre-processing parameters, being linked
+        in the latter case."""
+        cacheDir = self._getExtraPath(PLANE_ALIGN_CACHE_DIR)
+        key = self._getPreprocessingKey()
+        if self._readCacheKey(cacheDir) == key:
+            return
+        cleanPath(cacheDir)
+        makePath(cacheDir)
+        prevClassProt = self.prevClassProt.get()
+        prevCacheDir = prevClassProt._getExtraPath(PLANE_ALIGN_CACHE_DIR) if prevClassProt else None
+        if prevCacheDir and self._readCacheKey(prevCacheDir) == key:
+            self.info('Reusing the pySeg pre-processing of %s' % prevClassProt.getObjLabel())
+            for fileName in glob.glob(join(prevCacheDir, '*')):
+                if basename(fileName) != PLANE_ALIGN_CACHE_INFO:
+                    createLink(fileName, join(cacheDir, basename(fileName)))
+        else:
+            Plugin.runPySeg(self, PYTHON, self.getPysegCommand(outDir=cacheDir, procLevel=CC_MATRIX_FEAT_VECTORS),
+                            nJobs=self.numberOfThreads.get())
+        with open(join(cacheDir, PLANE_ALIGN_CACHE_INFO), 'w') as f:
+            json.dump(key, f, indent=2)
+
+    def _getPreprocessingKey(self):
+        """Inputs and parameters determining the pySeg outputs up to the cross correlation matrix / feature vectors."""
+        key = {'particles': getFileHash(self._getExtraPath(self.inStarName)),
+               'mask': getFileHash(self.getMaskFileName()),
+               'filterSize': self.filterSize.get(),
+               'doCC3d': self.doCC3d.get(),
+               'distanceMetric': self._decodeDistanceMetric()}
+        if self.clusteringAlg.get() == AFFINITY_PROP:
+            key['ccMetric'] = self._decodeCCMetric()
+        else:
+            key['pcaComps'] = self._estimatePCAComps()
+        return key
+
+    @staticmethod
+    def _readCacheKey(cacheDir):
+        infoFile = join(cacheDir, PLANE_ALIGN_CACHE_INFO)
+        if not exists(infoFile):
+            return None
+        with open(infoFile) as f:
+            return json.load(f)
+
     def _decodeCCMetric(self):
         res = None
         ccMetric = self.ccMetric.get()
@@ -386,13 +608,10 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
         return res
 
     def _fillClasses(self, classesSet):
-        classesSet.classifyItems(updateItemCallback=self._updateParticle,
-                                 updateClassCallback=self._updateClass,
-                                 itemDataIterator=self._dataTable.__iter__())
-
-    @staticmethod
-    def _updateParticle(item, row):
-        item.setClassId(int(row.rlnClassNumber))
+        # The class id of each subtomogram was already read from the gathered star file, so the classes are filled
+        # directly from the output subtomograms, with the class representatives indexed only once
+        self._representativesDict = self._getRepresentativesDict(self._resultsDir)
+        classesSet.classifyItems(updateClassCallback=self._updateClass)
 
     def _updateClass(self, item):
         classId = item.getObjId()
@@ -401,18 +620,25 @@ class ProtPySegPlaneAlignClassification(EMProtocol, ProtTomoBase):
         item.getRepresentative().setLocation(fn + ':mrc')
 
     def _getReferenceImage(self, classId):
-        # Search in exemplars directory. If file does not exist, search in averages directory
+        return self._representativesDict[classId]
+
+    @staticmethod
+    def _getRepresentativesDict(resultsDir):
+        """Class id: representative file. Exemplars are used if they exist, averages otherwise."""
         representativesLocation = None
-        exemplarssLocation = glob.glob(join(self._outDir, '*_exemplars'))
-        averagesLocation = glob.glob(join(self._outDir, '*_averages'))
-        if exemplarssLocation:
-            if exists(abspath(exemplarssLocation[0])):
-                representativesLocation = exemplarssLocation[0]
+        exemplarsLocation = glob.glob(join(resultsDir, '*_exemplars'))
+        averagesLocation = glob.glob(join(resultsDir, '*_averages'))
+        if exemplarsLocation:
+            if exists(abspath(exemplarsLocation[0])):
+                representativesLocation = exemplarsLocation[0]
         else:
             if exists(abspath(averagesLocation[0])):
                 representativesLocation = averagesLocation[0]
 
-        return glob.glob(join(representativesLocation, 'class_k%i.mrc' % classId))[0]
+        representativesDict = {}
+        for fn in glob.glob(join(representativesLocation, 'class_k*.mrc')):
+            representativesDict[int(removeBaseExt(fn).replace('class_k', ''))] = fn
+        return representativesDict
 
     def _estimatePCAComps(self):
         pcaComps = self.pcaComps.get()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from enum import Enum
+
+from emtable import Table
+from pwem.protocols import EMProtocol, PointerParam
+from pyseg.convert.convert import cachedSubtomograms2PysegStar
+from pyseg.engines import runClassAssignment
+from pyseg.protocols.protocol_2d_classification import outputObjects as cl2dOutputs, PARTICLE_FLATENNING
+from pyseg.utils import checkMaskFormat
+from pyworkflow.object import Float
+from pyworkflow.protocol import FloatParam, IntParam, GE, LE, LEVEL_ADVANCED
+from pyworkflow.utils import Message, makePath
+from tomo.objects import SetOfSubTomograms, SetOfClassesSubTomograms
+from tomo.protocols import ProtTomoBase
+from pyseg import Plugin
+from pyseg.constants import CLASS_ASSIGNMENT_OUT, CLASS_ASSIGNMENT_FLATTENED, PYTHON
+
+
+class outputObjects(Enum):
+    subtomograms = SetOfSubTomograms
+    classes = SetOfClassesSubTomograms
+
+
+class ProtPySegAssignToClasses(EMProtocol, ProtTomoBase):
+    """Assign new membrane-bound particles to the classes of a previous 2D classification, without classifying again
+    the whole dataset"""
+
+    _label = 'assign to 2D classes'
+    inStarName = 'input_particles.star'
+    outStarName = 'assigned_particles.star'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSubtomos', PointerParam,
+                      pointerClass='SetOfSubTomograms',
+                      important=True,
+                      label="Input subtomograms",
+                      help='New subtomograms to be assigned to the existing classes.')
+        form.addParam('classificationProt', PointerParam,
+                      pointerClass='ProtPySegPlaneAlignClassification',
+                      important=True,
+                      label='2D classification',
+                      help='Previous 2D classification whose class representatives (exemplars or averages) are used '
+                           'as references. The particles are flattened by pySeg with its mask, low pass filter and '
+                           'radial compensation.')
+        form.addParam('sweepOutput', IntParam,
+                      label='Swept set of classes',
+                      default=1,
+                      validators=[GE(1)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If several clustering parameter values were swept in the 2D classification, set of '
+                           'classes used, corresponding to the output suffix.')
+        form.addParam('minCC', FloatParam,
+                      label='Minimum cross correlation',
+                      default=-1,
+                      validators=[GE(-1), LE(1)],
+                      help='The particles whose cross correlation against their best reference is lower than this '
+                           'value are not assigned to any class. If -1, all the particles are assigned.')
+        form.addParallelSection(threads=4, mpi=0)
+
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.convertInputStep)
+        self._insertFunctionStep(self.flattenStep)
+        self._insertFunctionStep(self.assignStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    def convertInputStep(self):
+        makePath(self._getExtraPath(CLASS_ASSIGNMENT_OUT))
+        cachedSubtomograms2PysegStar(self.inputSubtomos.get(), self._getExtraPath(self.inStarName))
+        inMask = self.classificationProt.get().inMask.get()
+        if inMask:
+            checkMaskFormat(inMask)
+
+    def flattenStep(self):
+        # Pre-processed by pySeg as the classified particles
+        outDir = self._getExtraPath(CLASS_ASSIGNMENT_OUT, CLASS_ASSIGNMENT_FLATTENED)
+        makePath(outDir)
+        Plugin.runPySeg(self, PYTHON,
+                        self.classificationProt.get().getPysegCommand(outDir=outDir,
+                                                                      procLevel=PARTICLE_FLATENNING,
+                                                                      inStar=self._getExtraPath(self.inStarName),
+                                                                      nThreads=self.numberOfThreads.get()),
+                        nJobs=self.numberOfThreads.get())
+
+    def assignStep(self):
+        referencesDict = {cls.getObjId(): self._getRepresentativeFile(cls) for cls in self._getInputClasses()}
+        runClassAssignment(self._getExtraPath(self.inStarName),
+                           self._getExtraPath(CLASS_ASSIGNMENT_OUT, self.outStarName),
+                           self._getExtraPath(CLASS_ASSIGNMENT_OUT, CLASS_ASSIGNMENT_FLATTENED),
+                           referencesDict,
+                           minCC=self.minCC.get())
+
+    def createOutputStep(self):
+        inSubtomoSet = self.inputSubtomos.get()
+        inClasses = self._getInputClasses()
+        outSubtomoSet = SetOfSubTomograms.create(self._getPath(), template='setOfSubTomograms%s.sqlite')
+        outSubtomoSet.copyInfo(inSubtomoSet)
+        # The assignment star file keeps the order of the input subtomograms
+        outTable = Table(fileName=self._getExtraPath(CLASS_ASSIGNMENT_OUT, self.outStarName))
+        for subtomo, row in zip(inSubtomoSet, outTable):
+            classId = int(row.rlnClassNumber)
+            if classId >= 0:
+                subtomo.setClassId(classId)
+                subtomo._pysegClassCC = Float(row.rlnMaxValueProbDistribution)
+                outSubtomoSet.append(subtomo)
+
+        classesSet = SetOfClassesSubTomograms.create(self._getPath(), template='setOfClasses%s.sqlite')
+        classesSet.setImages(outSubtomoSet)
+        representativesDict = {cls.getObjId(): cls.getRepresentative().getLocation() for cls in inClasses}
+
+        def _updateClass(item):
+            item.setAlignment3D()
+            item.getRepresentative().setLocation(representativesDict[item.getObjId()])
+
+        classesSet.classifyItems(updateClassCallback=_updateClass)
+        self._defineOutputs(**{outputObjects.subtomograms.name: outSubtomoSet,
+                               outputObjects.classes.name: classesSet})
+        self._defineSourceRelation(inSubtomoSet, outSubtomoSet)
+        self._defineSourceRelation(inSubtomoSet, classesSet)
+        self._defineSourceRelation(inClasses, classesSet)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        if self.isFinished():
+            outSubtomos = getattr(self, outputObjects.subtomograms.name, None)
+            if outSubtomos is not None:
+                summary.append('%i of %i particles assigned to the classes of *%s*' %
+                               (outSubtomos.getSize(), self.inputSubtomos.get().getSize(),
+                                self.classificationProt.get().getObjLabel()))
+        return summary
+
+    def _methods(self):
+        methods = []
+        if self.isFinished():
+            msg = 'Each particle was assigned to the class whose representative correlates best with its 2D image, ' \
+                  'flattened by pySeg with the pre-processing of the classification'
+            if self.minCC.get() > -1:
+                msg += ', if the cross correlation was at least %.2f' % self.minCC.get()
+            methods.append(msg + '.')
+        return methods
+
+    def _validate(self):
+        errors = []
+        tol = 1e-3
+        classProt = self.classificationProt.get()
+        if not classProt.isFinished():
+            errors.append('The 2D classification has not finished.')
+            return errors
+        if self._getInputClasses() is None:
+            errors.append('The 2D classification has no set of classes with suffix _%i.' % self.sweepOutput.get())
+        inSubtomos = self.inputSubtomos.get()
+        classSubtomos = classProt.inputSubtomos.get()
+        if abs(inSubtomos.getSamplingRate() - classSubtomos.getSamplingRate()) > tol:
+            errors.append('Sampling rate of the input subtomograms and the classified ones should be the same\n'
+                          '%2.3f != %2.3f' % (inSubtomos.getSamplingRate(), classSubtomos.getSamplingRate()))
+        if inSubtomos.getDimensions() != classSubtomos.getDimensions():
+            errors.append('The dimensions of the input subtomograms and the classified ones must be the same.')
+        return errors
+
+    # --------------------------- UTIL functions -----------------------------------
+    def _getInputClasses(self):
+        classProt = self.classificationProt.get()
+        classes = getattr(classProt, cl2dOutputs.classes.name, None)
+        if classes is None:
+            classes = getattr(classProt, '%s_%i' % (cl2dOutputs.classes.name, self.sweepOutput.get()), None)
+        return classes
+
+    @staticmethod
+    def _getRepresentativeFile(cls):
+        return cls.getRepresentative().getFileName().replace(':mrc', '')
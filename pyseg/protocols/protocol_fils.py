@@ -34,14 +34,16 @@ from pwem.protocols import EMProtocol
 from pyseg.convert.convert import splitPysegStarFile
 from pyworkflow.protocol import FloatParam, NumericListParam, EnumParam, PointerParam, LEVEL_ADVANCED, STEPS_PARALLEL
 from pyworkflow.utils import Message, removeBaseExt, copyFile, moveFile
-from scipion.constants import PYTHON
 from tomo.protocols import ProtTomoBase
 from tomo.protocols.protocol_base import ProtTomoImportAcquisition
 
 from pyseg import Plugin
 from pyseg.constants import FILS_SCRIPT, FILS_SOURCES, FILS_TARGETS, MEMBRANE, \
-    MEMBRANE_OUTER_SURROUNDINGS, PRESEG_AREAS_LIST, IN_STARS_DIR, OUT_STARS_DIR, FILS_OUT, GRAPHS_OUT, FILS_FILES
-from pyseg.utils import encodePresegArea, createStarDirectories, genOutSplitStarFileName, getPrevPysegProtOutStarFiles
+    MEMBRANE_OUTER_SURROUNDINGS, PRESEG_AREAS_LIST, IN_STARS_DIR, OUT_STARS_DIR, FILS_OUT, GRAPHS_OUT, FILS_FILES, \
+    QUARANTINE_FILE, FILS_KEEP, PYTHON
+from pyseg.utils import encodePresegArea, createStarDirectories, genOutSplitStarFileName, \
+    getPrevPysegProtOutStarFiles, addStragglerControlParams, isStragglerControlEnabled, getStragglerLimits, \
+    quarantineVesicles, getQuarantinedVesicles, sortStarFilesByCost, isLimitExceeded
 
 TH_MODE_IN = 0
 TH_MODE_OUT = 1
@@ -112,6 +114,13 @@ class ProtPySegFils(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
         self._defineFilsXMLParams(form, self._getXMLTargetsDefaultVals(), isSources=False)
 
         form.addSection(label='Refinement')
+        self._defineRefinementParams(form)
+        addStragglerControlParams(form)
+
+        form.addParallelSection(threads=3, mpi=1)
+
+    @staticmethod
+    def _defineRefinementParams(form):
         group = form.addGroup('Graph thresholding')
         group.addParam('thMode', EnumParam,
                        default=TH_MODE_IN,
@@ -133,8 +142,6 @@ class ProtPySegFils(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
                        default='0 1000',
                        allowsNull=False)
 
-        form.addParallelSection(threads=3, mpi=1)
-
     @staticmethod
     def _defineFilsXMLParams(form, d, isSources=True):
         """d is a disctionary with the default values"""
@@ -211,8 +218,9 @@ class ProtPySegFils(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
 
     def _insertAllSteps(self):
         inStarDict = self._initialize()
-        for starFile, outDir in inStarDict.items():
-            self._insertFunctionStep(self.pysegFils, starFile, outDir, prerequisites=[])
+        # Largest vesicles first to reduce the total execution time
+        for starFile in sortStarFilesByCost(list(inStarDict.keys())):
+            self._insertFunctionStep(self.pysegFils, starFile, inStarDict[starFile], prerequisites=[])
 
     def _initialize(self):
         outDir = self._getExtraPath()
@@ -243,7 +251,18 @@ class ProtPySegFils(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
 
     def pysegFils(self, starFile, outDir):
         # Script called
-        Plugin.runPySeg(self, PYTHON, self._getFilsCommand(outDir, starFile))
+        if isStragglerControlEnabled(self):
+            try:
+                Plugin.runPySeg(self, PYTHON, self._getFilsCommand(outDir, starFile), **getStragglerLimits(self),
+                                outDir=outDir, keep=FILS_KEEP)
+            except Exception as e:
+                if not isLimitExceeded(e):
+                    raise
+                self.info('Vesicle from %s exceeded the execution limits and was quarantined.' % starFile)
+                quarantineVesicles(starFile, self._getExtraPath(QUARANTINE_FILE))
+                return
+        else:
+            Plugin.runPySeg(self, PYTHON, self._getFilsCommand(outDir, starFile), outDir=outDir, keep=FILS_KEEP)
         # Fils returns the same star file name, so it will be renamed to avoid overwriting
         moveFile(join(outDir, 'fil_mb_sources_to_no_mb_targets_net.star'),
                  genOutSplitStarFileName(self._outStarDir, starFile.replace(GRAPHS_OUT, FILS_OUT)))
@@ -255,6 +274,10 @@ class ProtPySegFils(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
         if self.isFinished():
             summary.append('*Filaments calculation*:\n\t- Source = %s\n\t- Target = %s\n' %
                            (PRESEG_AREAS_LIST[int(self.segLabelS.get())], PRESEG_AREAS_LIST[int(self.segLabelT.get())]))
+            quarantined = getQuarantinedVesicles(self._getExtraPath(QUARANTINE_FILE))
+            if quarantined:
+                summary.append('*%i vesicles were quarantined* because they exceeded the execution limits:\n\t- %s'
+                               % (len(quarantined), '\n\t- '.join(quarantined)))
 
         return summary
 
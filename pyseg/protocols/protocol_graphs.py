@@ -27,19 +27,22 @@
 import shutil
 from glob import glob
 from os.path import basename
+from emtable import Table
 from pwem.protocols import EMProtocol
 from pyseg.convert.convert import splitPysegStarFile
 from pyseg.protocols.protocol_pre_seg import outputObjects as presegOutputObjects
 
-from pyseg.utils import createStarDirectories, genOutSplitStarFileName
+from pyseg.utils import createStarDirectories, genOutSplitStarFileName, addStragglerControlParams, \
+    isStragglerControlEnabled, getStragglerLimits, quarantineVesicles, getQuarantinedVesicles, isLimitExceeded, \
+    registerRetriedVesicles, getRetriedVesicles
 from pyworkflow.protocol import FloatParam, PointerParam, LEVEL_ADVANCED, BooleanParam, IntParam
-from pyworkflow.utils import Message, moveFile
-from scipion.constants import PYTHON
+from pyworkflow.utils import Message, moveFile, removeBaseExt
 from tomo.protocols import ProtTomoBase
 from tomo.protocols.protocol_base import ProtTomoImportAcquisition
 
 from pyseg import Plugin
-from pyseg.constants import GRAPHS_SCRIPT
+from pyseg.constants import GRAPHS_SCRIPT, QUARANTINE_FILE, RETRY_SSIG_FACTOR, RETRY_VDEN_FACTOR, GRAPHS_KEEP, \
+    GRAPHS_KEEP_ALL, PYTHON, RETRIED_FILE
 
 
 class ProtPySegGraphs(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
@@ -81,6 +84,12 @@ class ProtPySegGraphs(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
                       help='If set to No, all the intermediate Disperse program resulting directories '
                            'will be kept in the extra folder.')
 
+        self._defineGraphsParams(form)
+        addStragglerControlParams(form, withRetries=True)
+        form.addParallelSection(threads=4, mpi=0)
+
+    @staticmethod
+    def _defineGraphsParams(form):
         group = form.addGroup('Graphs parameters')
         group.addParam('sSig', FloatParam,
                        label='Sigma for gaussian filtering',
@@ -107,7 +116,6 @@ class ProtPySegGraphs(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
                        label='Maximum distance to membrane (Å)',
                        allowsNull=False,
                        help='Maximum euclidean distance to membrane in Å.')
-        form.addParallelSection(threads=4, mpi=0)
 
     def _insertAllSteps(self):
         self._initialize()
@@ -122,11 +130,13 @@ class ProtPySegGraphs(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
         self.starFileList = splitPysegStarFile(self._getPreSegStarFile(), self._inStarDir, j=self.vesiclePkgSize.get())
 
     def pysegGraphs(self, starFile):
-        # Script called
-        Plugin.runPySeg(self, PYTHON, self._getGraphsCommand(starFile))
-        # Fils returns the same star file name, so it will be renamed to avoid overwriting
-        moveFile(self._getExtraPath(basename(starFile)).replace('.star', '_mb_graph.star'),
-                 genOutSplitStarFileName(self._outStarDir, starFile))
+        if isStragglerControlEnabled(self):
+            self._runGraphsWithLimits(starFile)
+        else:
+            # Script called
+            Plugin.runPySeg(self, PYTHON, self._getGraphsCommand(starFile), nJobs=self.numberOfThreads.get(),
+                            **self._getGraphsStaging())
+            self._moveGraphsOutStar(starFile)
 
     def removeUnusedFilesStep(self):
         # Remove Disperse program intermediate result directories if requested
@@ -139,21 +149,83 @@ class ProtPySegGraphs(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
         summaryMsg = []
         if self.isFinished():
             summaryMsg.append('Graphs were correctly generated.')
+            quarantined = getQuarantinedVesicles(self._getExtraPath(QUARANTINE_FILE))
+            if quarantined:
+                summaryMsg.append('*%i vesicles were quarantined* because they exceeded the execution limits:\n\t- %s'
+                                  % (len(quarantined), '\n\t- '.join(quarantined)))
+            retried = getRetriedVesicles(self._getExtraPath(RETRIED_FILE))
+            if retried:
+                summaryMsg.append('*%i vesicles were processed with coarser parameters* because they exceeded the '
+                                  'execution limits, so their graphs are not comparable with the rest:\n\t- %s'
+                                  % (len(retried), '\n\t- '.join('%s (sSig = %s, vDen = %s)' % vesicle
+                                                                  for vesicle in retried)))
+        return summaryMsg
 
     # --------------------------- UTIL functions -----------------------------------
-    def _getGraphsCommand(self, starFile):
+    def _runGraphsWithLimits(self, starFile):
+        nVesicles = Table(fileName=starFile).size()
+        nThreads = self.numberOfThreads.get()
+        if nVesicles == 1:
+            self._runVesicleGraphsWithRetries(starFile)
+            return
+        try:
+            Plugin.runPySeg(self, PYTHON, self._getGraphsCommand(starFile),
+                            nJobs=nThreads, **getStragglerLimits(self, nVesicles=nVesicles, nThreads=nThreads),
+                            **self._getGraphsStaging())
+            self._moveGraphsOutStar(starFile)
+        except Exception as e:
+            if not isLimitExceeded(e):
+                raise
+            # Process the vesicles of the package one by one to isolate the stragglers
+            self.info('Package %s exceeded the execution limits. Processing its vesicles one by one.' % starFile)
+            vesStarFiles = splitPysegStarFile(starFile, self._inStarDir, j=1, prefix=removeBaseExt(starFile) + '_ves_')
+            for vesStarFile in vesStarFiles:
+                self._runVesicleGraphsWithRetries(vesStarFile)
+
+    def _runVesicleGraphsWithRetries(self, starFile):
+        """Process a star file of one vesicle, making it coarser (higher sigma and lower vertex density) in each retry
+        and quarantining it if it still exceeds the execution limits after the last retry."""
+        for attempt in range(self.nRetries.get() + 1):
+            sSig = self.sSig.get() * RETRY_SSIG_FACTOR ** attempt
+            vDen = self.vDen.get() * RETRY_VDEN_FACTOR ** attempt
+            try:
+                Plugin.runPySeg(self, PYTHON, self._getGraphsCommand(starFile, sSig=sSig, vDen=vDen, nThreads=1),
+                                **getStragglerLimits(self), **self._getGraphsStaging())
+                self._moveGraphsOutStar(starFile)
+                if attempt > 0:
+                    registerRetriedVesicles(starFile, self._getExtraPath(RETRIED_FILE), sSig, vDen)
+                return
+            except Exception as e:
+                if not isLimitExceeded(e):
+                    raise
+                self.info('Vesicle from %s exceeded the execution limits with sSig = %s and vDen = %s.' %
+                          (starFile, sSig, vDen))
+        self.info('Vesicle from %s quarantined.' % starFile)
+        quarantineVesicles(starFile, self._getExtraPath(QUARANTINE_FILE))
+
+    def _moveGraphsOutStar(self, starFile):
+        # Fils returns the same star file name, so it will be renamed to avoid overwriting
+        moveFile(self._getExtraPath(basename(starFile)).replace('.star', '_mb_graph.star'),
+                 genOutSplitStarFileName(self._outStarDir, starFile))
+
+    def _getGraphsCommand(self, starFile, sSig=None, vDen=None, nThreads=None):
         graphsCmd = ' '
         graphsCmd += '%s ' % Plugin.getHome(GRAPHS_SCRIPT)
         graphsCmd += '--inStar %s ' % starFile
         graphsCmd += '--outDir %s ' % self._getExtraPath()
         graphsCmd += '--pixelSize %s ' % (self._getSamplingRate()/10)  # PySeg requires it in nm
-        graphsCmd += '--sSig %s ' % self.sSig.get()
-        graphsCmd += '--vDen %s ' % self.vDen.get()
+        graphsCmd += '--sSig %s ' % (sSig if sSig else self.sSig.get())
+        graphsCmd += '--vDen %s ' % (vDen if vDen else self.vDen.get())
         graphsCmd += '--veRatio %s ' % self.vRatio.get()
         graphsCmd += '--maxLen %s ' % (self.maxLen.get()/10)  # PySeg requires it in nm
-        graphsCmd += '-j %s ' % self.numberOfThreads.get()
+        graphsCmd += '-j %s ' % (nThreads if nThreads else self.numberOfThreads.get())
         return graphsCmd
 
+    def _getGraphsStaging(self):
+        """Output directory and outputs to keep if the graphs script is run in the scratch."""
+        return {'outDir': self._getExtraPath(),
+                'keep': GRAPHS_KEEP if self.keepOnlyReqFiles.get() else GRAPHS_KEEP_ALL}
+
     def _getPreSegStarFile(self):
         return self.inSegProt.get().getPresegOutputFile(self.inSegProt.get().getVesiclesCenteredStarFile())
 
@@ -32,16 +32,15 @@ from pwem.protocols import EMProtocol
 from pyseg.convert import readPysegCoordinates
 from pyworkflow.protocol import FloatParam, EnumParam, PointerParam, IntParam, LEVEL_ADVANCED, STEPS_PARALLEL
 from pyworkflow.utils import Message, removeBaseExt, copyFile, moveFile
-from scipion.constants import PYTHON
 from tomo.objects import SetOfCoordinates3D, SetOfTomograms
 from tomo.protocols import ProtTomoBase
 from tomo.protocols.protocol_base import ProtTomoImportAcquisition
 from pyseg import Plugin
 from pyseg.constants import FILS_SOURCES, FILS_TARGETS, PICKING_SCRIPT, PICKING_SLICES, PRESEG_AREAS_LIST, MEMBRANE, \
-    OUT_STARS_DIR, IN_STARS_DIR, FILS_OUT, PICKING_OUT
+    OUT_STARS_DIR, IN_STARS_DIR, FILS_OUT, PICKING_OUT, PICKING_KEEP, PYTHON
 
 # Fils slices xml fields
-from pyseg.utils import encodePresegArea, getPrevPysegProtOutStarFiles, createStarDirectories
+from pyseg.utils import encodePresegArea, getPrevPysegProtOutStarFiles, createStarDirectories, sortStarFilesByCost
 from tomo.utils import getObjFromRelation
 
 SIDE = 'side'
@@ -108,6 +107,12 @@ class ProtPySegPicking(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
         self._defineFilsXMLParams(form, self._getSlicesXMLDefaultVals())
 
         form.addSection(label='Refinement')
+        self._definePeaksCleaningParams(form)
+
+        form.addParallelSection(threads=3, mpi=1)
+
+    @staticmethod
+    def _definePeaksCleaningParams(form):
         group = form.addGroup('Peaks cleaning')
         group.addParam('peakTh', FloatParam,
                        label='Percentile of points to discard by their density level.',
@@ -119,8 +124,6 @@ class ProtPySegPicking(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
                        allowsNull=False,
                        help='Scale suppression in nm, two selected points cannot be closer than this distance.')
 
-        form.addParallelSection(threads=3, mpi=1)
-
     @staticmethod
     def _defineFilsXMLParams(form, d):
         """d is a disctionary with the default values"""
@@ -151,7 +154,8 @@ class ProtPySegPicking(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
     def _insertAllSteps(self):
         allOutputId = []
         starFileList = self._convertInputStep()
-        for starFile in starFileList:
+        # Largest vesicles first to reduce the total execution time
+        for starFile in sortStarFilesByCost(starFileList):
             pId = self._insertFunctionStep(self.pysegPicking, starFile, prerequisites=[])
             allOutputId.append(pId)
         self._insertFunctionStep(self.createOutputStep, prerequisites=allOutputId)
@@ -168,7 +172,8 @@ class ProtPySegPicking(EMProtocol, ProtTomoBase, ProtTomoImportAcquisition):
 
     def pysegPicking(self, starFile):
         # Script called
-        Plugin.runPySeg(self, PYTHON, self._getPickingCommand(starFile))
+        Plugin.runPySeg(self, PYTHON, self._getPickingCommand(starFile), outDir=self._getExtraPath(),
+                        keep=PICKING_KEEP)
         # Move output files to the corresponding directory
         outFile = self._getExtraPath(removeBaseExt(starFile) + '_parts.star')
         newFileName = join(self._outStarDir, basename(outFile).replace(FILS_OUT, PICKING_OUT))
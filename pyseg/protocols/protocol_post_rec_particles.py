@@ -25,19 +25,30 @@
 # *
 # **************************************************************************
 from enum import Enum
+from os.path import basename, join
 
+import numpy as np
+from pwem.objects import Transform
 from pwem.protocols import EMProtocol, PointerParam
 from pyseg.convert import readPysegSubtomograms
-from pyseg.utils import getFinalMaskFileName, checkMaskFormat
-from pyworkflow.protocol import String, FloatParam, LE, GE
-from pyworkflow.utils import Message, makePath
-from reliontomo.convert import createWriterTomo
-from scipion.constants import PYTHON
+from pyseg.convert.convert import splitPysegStarFile, mergeStarFiles, cachedSubtomograms2PysegStar, \
+    getSplitStarFileName
+from pyseg.engines import runMbSuppression
+from pyseg.utils import getFinalMaskFileName, checkMaskFormat, randomizeRotAngles, createStarDirectories, \
+    setPosRecMask
+from pyworkflow.protocol import String, FloatParam, LE, GE, BooleanParam, IntParam, LEVEL_ADVANCED, STEPS_PARALLEL, \
+    EnumParam, STEPS_SERIAL
+from pyworkflow.utils import Message, makePath, removeBaseExt
 from tomo.objects import SetOfSubTomograms
 from tomo.protocols import ProtTomoBase
 
 from pyseg import Plugin
-from pyseg.constants import POST_REC_OUT, POST_REC_SCRIPT_MEMB_ATT, SEE_METHODS_TAB
+from pyseg.constants import POST_REC_OUT, POST_REC_SCRIPT_MEMB_ATT, SEE_METHODS_TAB, IN_STARS_DIR, OUT_STARS_DIR, PYTHON
+
+
+# Membrane suppression engines
+MB_SUP_PYSEG = 0
+MB_SUP_PLUGIN = 1
 
 
 class outputObjects(Enum):
@@ -52,6 +63,15 @@ class ProtPySegPostRecParticles(EMProtocol, ProtTomoBase):
     warningMsg = None
     subtomoSet = None
 
+    @property
+    def stepsExecutionMode(self):
+        # The steps are executed in parallel only when the input particles are split into chunks
+        return STEPS_PARALLEL if self.chunkSize.get() and not self._isRotRandOnlyMetadata() else STEPS_SERIAL
+
+    @stepsExecutionMode.setter
+    def stepsExecutionMode(self, value):
+        pass  # Given by the chunk size
+
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
         """ Define the input parameters that will be used.
@@ -84,13 +104,67 @@ class ProtPySegPostRecParticles(EMProtocol, ProtTomoBase):
                        condition='mbMask',
                        help='Value 0 suppress the area corresponding to the suppression mask, while higher values '
                             'up to 1 attenuate it.')
+        group.addParam('mbSupEngine', EnumParam,
+                       label='Membrane suppression engine',
+                       choices=['PySeg script', 'Plugin (NumPy)'],
+                       default=MB_SUP_PYSEG,
+                       display=EnumParam.DISPLAY_HLIST,
+                       condition='mbMask',
+                       expertLevel=LEVEL_ADVANCED,
+                       help='*PySeg script*: each particle is processed independently, rotating the membrane '
+                            'suppression mask for each one of them.\n'
+                            '*Plugin (NumPy)*: the particles are processed in batches, rotating the membrane '
+                            'suppression mask only once per orientation (angles rounded to 5 degrees, being the rot '
+                            'angle ignored if the mask is symmetric around the membrane normal) and applying it to '
+                            'the whole batch at once.')
+        group.addParam('stackSize', IntParam,
+                       label='Particles per output stack',
+                       default=0,
+                       validators=[GE(0)],
+                       condition='mbMask and mbSupEngine == %i' % MB_SUP_PLUGIN,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='If greater than 0, the processed particles will be written into MRC stacks of up to '
+                            'this number of particles, which will be referred to as index@stack.mrc. It avoids '
+                            'generating a file per particle, which is heavy for the file system when processing '
+                            'a large number of particles. If 0, one file per particle will be generated.')
+        form.addParam('rotRandOnlyMetadata', BooleanParam,
+                      label='Randomize the rot angle only in the metadata?',
+                      default=False,
+                      condition='not mbMask',
+                      help='If there is no membrane suppression, the rot angle can be randomized directly in the '
+                           'particles metadata, generating the output subtomograms without rewriting their files, '
+                           'which is much faster. The particles are not multiplied by the mask in this mode, so it is '
+                           'recorded in the output subtomograms and used by default as the 2D classification mask.')
+        form.addParam('chunkSize', IntParam,
+                      label='Particles per chunk',
+                      default=0,
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If greater than 0, the input particles will be split into chunks of this size, which will '
+                           'be processed in parallel as independent steps (one thread each), so the protocol can be '
+                           'continued from the last finished chunk in case of failure. If 0, all the particles are '
+                           'processed in a single step using all the threads.')
         form.addParallelSection(threads=4, mpi=0)
 
     def _insertAllSteps(self):
+        if self._isRotRandOnlyMetadata():
+            self._insertFunctionStep(self.randomizeRotStep)
+            return
         outStar = self._getExtraPath(POST_REC_OUT + '.star')
-        self._insertFunctionStep(self.convertInputStep)
-        self._insertFunctionStep(self.pysegPostRec, outStar)
-        self._insertFunctionStep(self.createOutputStep, outStar)
+        convertId = self._insertFunctionStep(self.convertInputStep, prerequisites=[])
+        if self.chunkSize.get():
+            chunkIds = []
+            chunkOutStars = []
+            for chunkStar in self._getChunkStarFiles():
+                chunkOutStar = self._getExtraPath(OUT_STARS_DIR, basename(chunkStar))
+                chunkOutStars.append(chunkOutStar)
+                chunkIds.append(self._insertFunctionStep(self.pysegPostRec, chunkOutStar, chunkStar, 1,
+                                                         prerequisites=[convertId]))
+            mergeId = self._insertFunctionStep(self.mergeChunksStep, chunkOutStars, outStar, prerequisites=chunkIds)
+            self._insertFunctionStep(self.createOutputStep, outStar, prerequisites=[mergeId])
+        else:
+            postRecId = self._insertFunctionStep(self.pysegPostRec, outStar, prerequisites=[convertId])
+            self._insertFunctionStep(self.createOutputStep, outStar, prerequisites=[postRecId])
 
     def convertInputStep(self):
         """ Create the input file in STAR format as expected by Relion.
@@ -99,21 +173,39 @@ class ProtPySegPostRecParticles(EMProtocol, ProtTomoBase):
         checkMaskFormat(self.inMask.get())  # Subtomogram mask
         if self.mbMask.get():
             checkMaskFormat(self.mbMask.get())  # Membrane mask for attenuation (optional)
-        # Write star from set of subtomograms
-        subtomoSet = self.inputSubtomos.get()
+        # Write star from set of subtomograms. The plugin engine can read the particles stored in stacks, while
+        # they have to be extracted for the pySeg script
         subTomoStar = self._getExtraPath(self.inStarName)
-        writer = createWriterTomo(isPyseg=True)
-        writer.subtomograms2Star(subtomoSet, subTomoStar)
-        # Convert the mask format if necessary
-        checkMaskFormat(self.inMask.get())
+        cachedSubtomograms2PysegStar(self.inputSubtomos.get(), subTomoStar, extract=not self._isPluginEngine())
+        # Split it into chunks if requested
+        if self.chunkSize.get():
+            _, inStarDir = createStarDirectories(self._getExtraPath())
+            splitPysegStarFile(subTomoStar, inStarDir, j=self.chunkSize.get(), prefix=self._getChunkPrefix())
 
-    def pysegPostRec(self, outStar):
-        # Generate output subtomo dir
+    def pysegPostRec(self, outStar, inStar=None, nThreads=None):
+        # Generate output subtomo dir, a subdirectory for each chunk
         outDir = self._getExtraPath(POST_REC_OUT)
+        if inStar:
+            outDir = join(outDir, removeBaseExt(inStar))
         makePath(outDir)
 
-        # Script called
-        Plugin.runPySeg(self, PYTHON, self._getCommand(outDir, outStar))
+        if self._isPluginEngine():
+            runMbSuppression(inStar if inStar else self._getExtraPath(self.inStarName),
+                             outStar,
+                             outDir,
+                             getFinalMaskFileName(self.inMask.get()),
+                             getFinalMaskFileName(self.mbMask.get()),
+                             self.mbSupFactor.get(),
+                             nThreads=nThreads if nThreads else self.numberOfThreads.get(),
+                             stackSize=self.stackSize.get())
+        else:
+            # Script called
+            Plugin.runPySeg(self, PYTHON, self._getCommand(outDir, outStar, inStar=inStar, nThreads=nThreads),
+                            nJobs=nThreads if nThreads else self.numberOfThreads.get())
+
+    def mergeChunksStep(self, chunkOutStars, outStar):
+        # Keep the order of the input set, as expected when creating the outputs
+        mergeStarFiles(chunkOutStars, outStar)
 
     def createOutputStep(self, outStar):
         self.subtomoSet = SetOfSubTomograms.create(self._getPath(), template='setOfSubTomograms%s.sqlite')
@@ -129,10 +221,37 @@ class ProtPySegPostRecParticles(EMProtocol, ProtTomoBase):
         self._defineOutputs(**{outputObjects.subtomograms.name: self.subtomoSet})
         self._defineSourceRelation(self.inputSubtomos.get(), self.subtomoSet)
 
+    def randomizeRotStep(self):
+        # Equivalent to the angle randomization of pySeg, but only modifying the metadata of the whole set at once
+        inSubtomos = self.inputSubtomos.get()
+        matrices = np.array([self._getMatrix(subtomo) for subtomo in inSubtomos])
+        matrices = randomizeRotAngles(matrices)
+
+        self.subtomoSet = SetOfSubTomograms.create(self._getPath(), template='setOfSubTomograms%s.sqlite')
+        self.subtomoSet.copyInfo(inSubtomos)
+        self.subtomoSet.setAlignment3D()
+        # The mask can not be applied without rewriting the files, so it is recorded in the output metadata to be used
+        # by default by the 2D classification
+        setPosRecMask(self.subtomoSet, self.inMask.get())
+        for subtomo, matrix in zip(inSubtomos, matrices):
+            outSubtomo = subtomo.clone()
+            transform = Transform()
+            transform.setMatrix(matrix)
+            outSubtomo.setTransform(transform)
+            self.subtomoSet.append(outSubtomo)
+
+        self._defineOutputs(**{outputObjects.subtomograms.name: self.subtomoSet})
+        self._defineSourceRelation(inSubtomos, self.subtomoSet)
+
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
-        if self.isFinished():
+        if self.isFinished() and self._isRotRandOnlyMetadata():
+            summary.append('*Rot angle randomized in the metadata*. The subtomogram files were not modified, so the '
+                           'mask was not applied to them. It is recorded in the output subtomograms (%s) and used '
+                           'by default as the 2D classification mask.'
+                           % getFinalMaskFileName(self.inMask.get()))
+        elif self.isFinished():
             summary.append('*Generated files location*:\n'
                            '\t- Subtomograms files directory: %s\n'
                            '\t- Star file: %s\n'
@@ -149,8 +268,10 @@ class ProtPySegPostRecParticles(EMProtocol, ProtTomoBase):
             if mbMask:
                 methods.append('*Membrane suppression applied with*\n'
                                '\t- MembraneMask = %s\n'
-                               '\t- SuppressionFactor = %1.2f\n' %
-                               (mbMask.getFileName(), self.mbSupFactor.get()))
+                               '\t- SuppressionFactor = %1.2f\n'
+                               '\t- Engine = %s\n' %
+                               (mbMask.getFileName(), self.mbSupFactor.get(),
+                                self.getEnumText('mbSupEngine')))
             if self.doGaussLowPassFilter.get():
                 methods.append('*Gaussian low pass filter applied with*\n'
                                '\t- CutOffResolution[nm] = %2.1f\n'
@@ -179,17 +300,37 @@ class ProtPySegPostRecParticles(EMProtocol, ProtTomoBase):
         return validationMsg
 
     # --------------------------- UTIL functions -----------------------------------
+    def _isPluginEngine(self):
+        return bool(self.mbMask.get()) and self.mbSupEngine.get() == MB_SUP_PLUGIN
+
+    def _isRotRandOnlyMetadata(self):
+        return self.rotRandOnlyMetadata.get() and not self.mbMask.get()
+
+    @staticmethod
+    def _getMatrix(subtomo):
+        transform = subtomo.getTransform()
+        return transform.getMatrix() if transform else np.eye(4)
+
+    def _getChunkStarFiles(self):
+        """Names of the star files generated when splitting the input star file into chunks."""
+        nChunks = -(-self.inputSubtomos.get().getSize() // self.chunkSize.get())
+        return [getSplitStarFileName(self._getExtraPath(IN_STARS_DIR), self._getChunkPrefix(), i + 1)
+                for i in range(nChunks)]
+
+    @staticmethod
+    def _getChunkPrefix():
+        return POST_REC_OUT + '_'
 
-    def _getCommand(self, outDir, outStar):
+    def _getCommand(self, outDir, outStar, inStar=None, nThreads=None):
         posRecCmd = ' '
         posRecCmd += '%s ' % Plugin.getHome(POST_REC_SCRIPT_MEMB_ATT)
-        posRecCmd += '--inStar %s ' % self._getExtraPath(self.inStarName)
+        posRecCmd += '--inStar %s ' % (inStar if inStar else self._getExtraPath(self.inStarName))
         posRecCmd += '--inMask %s ' % getFinalMaskFileName(self.inMask.get())
         posRecCmd += '--inMaskMbSup %s ' % (getFinalMaskFileName(self.mbMask.get()) if self.mbMask.get() else 'None')
         posRecCmd += '--mbSupFactor %s ' % (self.mbSupFactor.get() if self.mbSupFactor.get() else '0')
         posRecCmd += '--doGaussLowPass %s ' % False
         posRecCmd += '--outDir %s ' % outDir
         posRecCmd += '--outStar %s ' % outStar
-        posRecCmd += '-j %s ' % self.numberOfThreads.get()
+        posRecCmd += '-j %s ' % (nThreads if nThreads else self.numberOfThreads.get())
         return posRecCmd
 
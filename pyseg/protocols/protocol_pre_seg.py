@@ -30,16 +30,16 @@ from os.path import abspath
 from pwem.convert.headers import fixVolume
 from pwem.emlib.image import ImageHandler
 from pwem.protocols import EMProtocol
-from pyseg.convert.convert import getVesicleIdFromSubtomoName
-from pyworkflow.protocol import NumericListParam, IntParam, FloatParam, GT, LEVEL_ADVANCED, PointerParam
+from pyseg.convert.convert import getVesicleIdFromSubtomoName, mergeStarFiles
+from pyworkflow.protocol import NumericListParam, IntParam, FloatParam, GT, LEVEL_ADVANCED, PointerParam, \
+    STATUS_NEW
 from pyworkflow.utils import Message, removeBaseExt, removeExt
-from scipion.constants import PYTHON
 from tomo.objects import SetOfTomoMasks, TomoMask, SetOfSubTomograms, SubTomogram, SetOfTomograms, Tomogram
 from pyseg import Plugin
 from pyseg.constants import PRESEG_SCRIPT, TOMOGRAM, PYSEG_LABEL, VESICLE, NOT_FOUND, \
     PYSEG_OFFSET_X, PYSEG_OFFSET_Y, PYSEG_OFFSET_Z, SEGMENTATION, RLN_ORIGIN_X, RLN_ORIGIN_Y, \
-    RLN_ORIGIN_Z
-from relion.convert import Table
+    RLN_ORIGIN_Z, PYTHON
+from emtable import Table
 import numpy as np
 
 from tomo.utils import getObjFromRelation
@@ -54,7 +54,6 @@ class ProtPySegPreSegParticles(EMProtocol):
     """Segment membranes into membranes, inner surroundings and outer surroundings"""
 
     _label = 'preseg membranes'
-    _starFile = None
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -103,19 +102,51 @@ class ProtPySegPreSegParticles(EMProtocol):
                             'desired to be included in the analysis.')
 
     def _insertAllSteps(self):
-        self._starFile = self._getExtraPath('inStar.star')
-        self._insertFunctionStep(self.convertInputStep)
-        self._insertFunctionStep(self.pysegPreSegStep)
-        self._insertFunctionStep(self.getMembraneCenterStep)
-        self._insertFunctionStep(self.pysegPreSegCenteredStep)
-        self._insertFunctionStep(self.createOutputStep)
-
-    def convertInputStep(self):
+        self._insertedIds = set()
+        self._batchCounter = 0
+        inTomoMasks, streamClosed = self._loadInputTomoMasks()
+        outputDeps = self._insertNewMasksSteps(inTomoMasks)
+        # If the input set is still open (streaming), the output sets will be closed once the input set is closed
+        # and all the tomomasks have been processed
+        self._insertFunctionStep(self.closeOutputStep, prerequisites=outputDeps, wait=not streamClosed)
+
+    def _insertNewMasksSteps(self, tomoMasks):
+        """Insert the steps to process the tomomasks not processed yet as a new batch, so they can be processed while
+        the annotation of the remaining tomograms goes on. Returns a list with the id of the batch output step."""
+        tomoMaskIds = [tomoMaskId for tomoMaskId in tomoMasks if tomoMaskId not in self._insertedIds]
+        if not tomoMaskIds:
+            return []
+        self._insertedIds.update(tomoMaskIds)
+        self._batchCounter += 1
+        batchId = self._batchCounter
+        cId = self._insertFunctionStep(self.convertInputStep, batchId, tomoMaskIds)
+        psId = self._insertFunctionStep(self.pysegPreSegStep, batchId, prerequisites=[cId])
+        mcId = self._insertFunctionStep(self.getMembraneCenterStep, batchId, prerequisites=[psId])
+        pscId = self._insertFunctionStep(self.pysegPreSegCenteredStep, batchId, prerequisites=[mcId])
+        outId = self._insertFunctionStep(self.createOutputStep, batchId, prerequisites=[pscId])
+        return [outId]
+
+    def _stepsCheck(self):
+        closeStep = self._getCloseOutputStep()
+        if closeStep is None or not closeStep.isWaiting():
+            return
+        inTomoMasks, streamClosed = self._loadInputTomoMasks()
+        outputDeps = self._insertNewMasksSteps(inTomoMasks)
+        if outputDeps:
+            closeStep.addPrerequisites(*outputDeps)
+            self.updateSteps()
+        if streamClosed:
+            # All the tomomasks have been already scheduled, so the outputs can be closed after processing them
+            closeStep.setStatus(STATUS_NEW)
+
+    def convertInputStep(self, batchId, tomoMaskIds):
         from pwem import Domain
         xmipp3 = Domain.importFromPlugin('xmipp3')
         # Generate the star file with the vesicles centered for the second pre_seg execution
         outputTable = self._createTable(isConvertingInput=True)
-        for tomoMask in self.inTomoMasks.get():
+        inTomoMasks, _ = self._loadInputTomoMasks()
+        for tomoMaskId in tomoMaskIds:
+            tomoMask = inTomoMasks[tomoMaskId]
             # Convert to MRC the tomograms to which the tomomasks are referred to if they are not, because it's
             # the format searched by pyseg
             tomoFile = tomoMask.getVolName()
@@ -135,30 +166,39 @@ class ProtPySegPreSegParticles(EMProtocol):
                                        vesicle,
                                        int(materialIndex),
                                        vesicle)
-        outputTable.write(self._starFile)
+        outputTable.write(self._getInStarFile(batchId))
 
-    def pysegPreSegStep(self):
+    def pysegPreSegStep(self, batchId):
         outDir = self._getExtraPath()
         # Script called
-        Plugin.runPySeg(self, PYTHON, self._getPreSegCmd(self._starFile, outDir))
+        Plugin.runPySeg(self, PYTHON, self._getPreSegCmd(self._getInStarFile(batchId), outDir))
 
-    def getMembraneCenterStep(self):
-        inStar = self.getPresegOutputFile(self._starFile)
-        self._findVesicleCenter(self._starFile, inStar)
+    def getMembraneCenterStep(self, batchId):
+        inStar = self._getInStarFile(batchId)
+        self._findVesicleCenter(inStar, self.getPresegOutputFile(inStar), self.getVesiclesCenteredStarFile(batchId))
 
-    def pysegPreSegCenteredStep(self):
-        inStar = abspath(self.getVesiclesCenteredStarFile())
+    def pysegPreSegCenteredStep(self, batchId):
+        inStar = abspath(self.getVesiclesCenteredStarFile(batchId))
         outDir = self._getExtraPath()
         # Script called
         Plugin.runPySeg(self, PYTHON, self._getPreSegCmd(inStar, outDir))
 
-    def createOutputStep(self):
-        segVesSet, vesSet = self._genOutputSetOfTomoMasks()
-        self._defineOutputs(**{outputObjects.vesicles.name: vesSet,
-                               outputObjects.segmentations.name: segVesSet})
+    def createOutputStep(self, batchId):
+        # Update the star file read by the graphs protocol with the vesicles processed until now
+        batchStarFiles = [self.getPresegOutputFile(self.getVesiclesCenteredStarFile(i)) for i in range(1, batchId + 1)]
+        mergeStarFiles(batchStarFiles, self.getPresegOutputFile(self.getVesiclesCenteredStarFile()))
 
-        self._defineSourceRelation(self.inTomoMasks.get(), vesSet)
-        self._defineSourceRelation(self.inTomoMasks.get(), segVesSet)
+        firstTime = not hasattr(self, outputObjects.vesicles.name)
+        segVesSet, vesSet = self._getOutputSets()
+        self._genOutputSetOfTomoMasks(segVesSet, vesSet)
+        self._updateOutputSet(outputObjects.vesicles.name, vesSet)
+        self._updateOutputSet(outputObjects.segmentations.name, segVesSet)
+        if firstTime:
+            self._defineSourceRelation(self.inTomoMasks.get(), vesSet)
+            self._defineSourceRelation(self.inTomoMasks.get(), segVesSet)
+
+    def closeOutputStep(self):
+        self._closeOutputSet()
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
@@ -195,7 +235,26 @@ class ProtPySegPreSegParticles(EMProtocol):
         # by part)
         return set(materialsList.replace('\n', '').split(','))
 
-    def _findVesicleCenter(self, starFileInit, starFilePreseg1):
+    def _loadInputTomoMasks(self):
+        """Load the input set of tomomasks from its sqlite file, so the new tomomasks are considered if it's being
+        fed in streaming. Returns a dict of the tomomasks by id and if the input stream is closed."""
+        inTomoMasks = SetOfTomoMasks(filename=self.inTomoMasks.get().getFileName())
+        inTomoMasks.loadAllProperties()
+        tomoMasksDict = {tomoMask.getObjId(): tomoMask.clone() for tomoMask in inTomoMasks}
+        streamClosed = inTomoMasks.isStreamClosed()
+        inTomoMasks.close()
+        return tomoMasksDict, streamClosed
+
+    def _getCloseOutputStep(self):
+        for step in self._steps:
+            if step.funcName == self.closeOutputStep.__name__:
+                return step
+        return None
+
+    def _getInStarFile(self, batchId):
+        return self._getExtraPath('inStar_%03d.star' % batchId)
+
+    def _findVesicleCenter(self, starFileInit, starFilePreseg1, outStar):
         ih = ImageHandler()
         outputTable = self._createTable()
         # Read preseg (vesicles not centered) table
@@ -231,13 +290,17 @@ class ProtPySegPreSegParticles(EMProtocol):
                                zdimCorner + z / 2,
                                )
 
-        outputTable.write(self.getVesiclesCenteredStarFile())
+        outputTable.write(outStar)
 
     def getPresegOutputFile(self, inStar):
         return self._getExtraPath(removeBaseExt(inStar) + '_pre.star')
 
-    def getVesiclesCenteredStarFile(self):
-        return self._getExtraPath('presegVesiclesCentered.star')
+    def getVesiclesCenteredStarFile(self, batchId=None):
+        """The star file with the vesicles centered of the given batch of tomomasks. If no batch is provided, the one
+        resulting of merging all the processed batches is returned."""
+        if batchId is None:
+            return self._getExtraPath('presegVesiclesCentered.star')
+        return self._getExtraPath('presegVesiclesCentered_%03d.star' % batchId)
 
     @ staticmethod
     def _createTable(isConvertingInput=False):
@@ -262,7 +325,23 @@ class ProtPySegPreSegParticles(EMProtocol):
     def _checkValue4PySeg(value):
         return value if value == -1 else value/10
 
-    def _genOutputSetOfTomoMasks(self):
+    def _getOutputSets(self):
+        """Get the output sets ready to append the new vesicles, creating them if they do not exist yet."""
+        segVesSet = getattr(self, outputObjects.segmentations.name, None)
+        vesSet = getattr(self, outputObjects.vesicles.name, None)
+        if segVesSet is None:
+            inTomoMaskSet = self.inTomoMasks.get()
+            segVesSet = SetOfTomoMasks.create(self._getPath(), template='tomomasks%s.sqlite', suffix='segVesicles')
+            vesSet = SetOfSubTomograms.create(self._getPath(), template='subtomograms%s.sqlite', suffix='vesicles')
+            segVesSet.copyInfo(inTomoMaskSet)
+            vesSet.copyInfo(inTomoMaskSet)
+        else:
+            segVesSet.enableAppend()
+            vesSet.enableAppend()
+        return segVesSet, vesSet
+
+    def _genOutputSetOfTomoMasks(self, tomoMaskSet, subTomoSet):
+        """Append to the given sets the vesicles generated by PySeg that are not contained in them yet."""
         # TODO: check why sometimes the suffix is _mb and sometimes it is _seg
         suffix = '_seg'
         MRC = '.mrc'
@@ -270,17 +349,15 @@ class ProtPySegPreSegParticles(EMProtocol):
         if not tomoMaskList:
             suffix = '_mb'
             tomoMaskList = glob.glob(self._getExtraPath('segs', '*' + suffix + MRC))
+        presentFiles = {subtomo.getFileName() for subtomo in subTomoSet}
+        tomoMaskList = [tomoMask for tomoMask in tomoMaskList
+                        if tomoMask.replace(suffix + MRC, MRC) not in presentFiles]
         vesicleSubtomoList = [tomoMask.replace(suffix + MRC, MRC) for tomoMask in tomoMaskList]
         indSorting = np.argsort([removeBaseExt(vesicleName) for vesicleName in vesicleSubtomoList])
         vesicleIds = [int(getVesicleIdFromSubtomoName(vesicleName)) for vesicleName in vesicleSubtomoList]
-        tomoMaskSet = SetOfTomoMasks.create(self._getPath(), template='tomomasks%s.sqlite', suffix='segVesicles')
-        subTomoSet = SetOfSubTomograms.create(self._getPath(), template='subtomograms%s.sqlite', suffix='vesicles')
         sRate = self._getSamplingRate()
-        inTomoMaskSet = self.inTomoMasks.get()
-        tomoMaskSet.copyInfo(inTomoMaskSet)
-        subTomoSet.copyInfo(inTomoMaskSet)
 
-        counter = 1
+        counter = tomoMaskSet.getSize() + 1
         tomoBaseNamesDict = {removeBaseExt(tomo.getFileName()): tomo.getFileName() for tomo in self._getTomoFromRelations()}
         for i in indSorting:
             # Fill the set of tomomasks
@@ -303,8 +380,6 @@ class ProtPySegPreSegParticles(EMProtocol):
             subTomoSet.append(subtomo)
             counter += 1
 
-        return tomoMaskSet, subTomoSet
-
     def _getSamplingRate(self):
         return self.inTomoMasks.get().getFirstItem().getSamplingRate()
 
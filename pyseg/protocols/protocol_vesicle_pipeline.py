@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+from os.path import exists, join
+
+from pyseg.convert.convert import splitPysegStarFile
+from pyseg.protocols.protocol_fils import ProtPySegFils
+from pyseg.protocols.protocol_graphs import ProtPySegGraphs
+from pyseg.convert import readPysegCoordinates
+from pyseg.protocols.protocol_picking import ProtPySegPicking, outputObjects
+from pyseg.protocols.protocol_pre_seg import outputObjects as presegOutputObjects
+from pyseg.utils import createStarDirectories, genOutSplitStarFileName, addStragglerControlParams, \
+    isStragglerControlEnabled, getQuarantinedVesicles
+from pyworkflow.protocol import PointerParam, IntParam, BooleanParam, LEVEL_ADVANCED, STEPS_PARALLEL
+from pyworkflow.utils import Message, makePath
+from tomo.objects import SetOfTomograms, SetOfCoordinates3D
+from tomo.utils import getObjFromRelation
+
+from pyseg import Plugin
+from pyseg.constants import FILS_SOURCES, FILS_TARGETS, PICKING_SLICES, GRAPHS_OUT, FILS_OUT, PICKING_OUT, \
+    FILS_FILES, QUARANTINE_FILE, PRESEG_AREAS_LIST, PYTHON
+
+
+class ProtPySegVesiclePipeline(ProtPySegGraphs, ProtPySegFils, ProtPySegPicking):
+    """graphs, fils and picking of each vesicle pipelined, so each vesicle goes to the next stage as soon as it is
+    done with the previous one"""
+
+    _label = 'vesicle pipeline'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inSegProt', PointerParam,
+                      pointerClass='ProtPySegPreSegParticles',
+                      label='Pre segmentation',
+                      important=True,
+                      allowsNull=False,
+                      help='Pointer to preseg protocol.')
+        form.addParam('inTomoSet', PointerParam,
+                      pointerClass='SetOfTomograms',
+                      label='Tomograms to refer the coordinates',
+                      allowsNull=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Tomograms to which the coordinates should be referred to. If empty, it is assumed that '
+                           'the tomograms are the same from were the vesicles were segmented (pre-seg).')
+        form.addParam('boxSize', IntParam,
+                      label='Box size (pixels)',
+                      default=20,
+                      important=True,
+                      allowsNull=False,
+                      expertLevel=LEVEL_ADVANCED)
+        form.addParam('keepOnlyReqFiles', BooleanParam,
+                      label='Keep only required files?',
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If set to No, all the intermediate Disperse program resulting directories '
+                           'will be kept in the extra folder.')
+
+        form.addSection(label='Graphs')
+        ProtPySegGraphs._defineGraphsParams(form)
+
+        form.addSection(label='Fils sources')
+        ProtPySegFils._defineFilsXMLParams(form, ProtPySegFils._getXMLSourcesDefaultVals())
+
+        form.addSection(label='Fils targets')
+        ProtPySegFils._defineFilsXMLParams(form, ProtPySegFils._getXMLTargetsDefaultVals(), isSources=False)
+
+        form.addSection(label='Fils refinement')
+        ProtPySegFils._defineRefinementParams(form)
+
+        form.addSection(label='Picking')
+        ProtPySegPicking._defineFilsXMLParams(form, ProtPySegPicking._getSlicesXMLDefaultVals())
+        ProtPySegPicking._definePeaksCleaningParams(form)
+        addStragglerControlParams(form, withRetries=True)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # -------------------------- INSERT steps functions -----------------------
+    def _insertAllSteps(self):
+        # Each vesicle has its own graphs -> fils -> picking chain of steps, so all the stages share the threads and
+        # a vesicle is not held by the slowest vesicle of the previous stage
+        pickingIds = []
+        for graphsInStar, filsOutDir in self._initialize().items():
+            graphsOutStar = genOutSplitStarFileName(self._outStarDir, graphsInStar)
+            filsOutStar = genOutSplitStarFileName(self._outStarDir, graphsOutStar.replace(GRAPHS_OUT, FILS_OUT))
+            graphsId = self._insertFunctionStep(self.graphsStep, graphsInStar, prerequisites=[])
+            filsId = self._insertFunctionStep(self.filsStep, graphsOutStar, filsOutDir, prerequisites=[graphsId])
+            pickingIds.append(self._insertFunctionStep(self.pickingStep, filsOutStar, prerequisites=[filsId]))
+        cleanId = self._insertFunctionStep(self.removeUnusedFilesStep, prerequisites=pickingIds)
+        self._insertFunctionStep(self.createOutputStep, prerequisites=[cleanId])
+
+    def _initialize(self):
+        outDir = self._getExtraPath()
+        self._outStarDir, self._inStarDir = createStarDirectories(outDir)
+        self._createFilsXmlFile(Plugin.getHome(FILS_SOURCES), outDir)
+        self._createFilsXmlFile(Plugin.getHome(FILS_TARGETS), outDir, isSource=False)
+        self._createPickingXmlFile(Plugin.getHome(PICKING_SLICES), outDir)
+        # One star file per vesicle, with its own fils output directory, as fils always generates the same file name
+        inStarFiles = splitPysegStarFile(self._getPreSegStarFile(), self._inStarDir, j=1)
+        inStarDict = {}
+        for i, starFile in enumerate(inStarFiles):
+            inStarDict[starFile] = self._getExtraPath(FILS_FILES, 'outDir_%03d' % i)
+            makePath(inStarDict[starFile])
+        return inStarDict
+
+    def graphsStep(self, starFile):
+        if isStragglerControlEnabled(self):
+            self._runVesicleGraphsWithRetries(starFile)
+        else:
+            Plugin.runPySeg(self, PYTHON, self._getGraphsCommand(starFile, nThreads=1), **self._getGraphsStaging())
+            self._moveGraphsOutStar(starFile)
+
+    def filsStep(self, starFile, outDir):
+        # Vesicles quarantined in a previous stage have no input
+        if exists(starFile):
+            self.pysegFils(starFile, outDir)
+
+    def pickingStep(self, starFile):
+        if exists(starFile):
+            self.pysegPicking(starFile)
+
+    def createOutputStep(self):
+        tomoSet = self._getTomoSet()
+        coordsSet = self._createSetOfCoordinates3D(tomoSet, self._getOutputSuffix(SetOfCoordinates3D))
+        coordsSet.setSamplingRate(tomoSet.getFirstItem().getSamplingRate())
+        coordsSet.setBoxSize(self.boxSize.get())
+        for outStar in sorted(glob.glob(join(self._outStarDir, '%s_*_parts.star' % PICKING_OUT))):
+            readPysegCoordinates(outStar, coordsSet, tomoSet)
+
+        if not coordsSet:
+            raise Exception('ERROR! No coordinates were picked.')
+        self._defineOutputs(**{outputObjects.coordinates.name: coordsSet})
+        self._defineSourceRelation(tomoSet, coordsSet)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        if self.isFinished():
+            outputCoords = getattr(self, outputObjects.coordinates.name, None)
+            if outputCoords is not None:
+                summary.append('*Picking*:\n\t- Picking area = %s\n\t- Particles picked = %i\n' %
+                               (PRESEG_AREAS_LIST[int(self.side.get())], outputCoords.getSize()))
+            quarantined = getQuarantinedVesicles(self._getExtraPath(QUARANTINE_FILE))
+            if quarantined:
+                summary.append('*%i vesicles were quarantined* because they exceeded the execution limits:\n\t- %s'
+                               % (len(quarantined), '\n\t- '.join(quarantined)))
+        return summary
+
+    # --------------------------- UTIL functions -----------------------------------
+    def _getSamplingRate(self):
+        # Used by the graphs command, so it is the sampling rate of the vesicles
+        inVesicles = getattr(self.inSegProt.get(), presegOutputObjects.vesicles.name)
+        return inVesicles.getSamplingRate()
+
+    def _getTomoFromRelations(self):
+        presegProt = self.inSegProt.get()
+        return getObjFromRelation(presegProt.inTomoMasks.get(), self, SetOfTomograms)
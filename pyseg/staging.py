@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Node-local scratch staging of the pySeg scripts: the input star files and the files they refer to that are read by
+the scripts (vesicles, segmentations and pickles, not the tomograms) are linked (or copied if the scratch is in a
+different filesystem) into a scratch directory, where the script writes its outputs, and only the outputs listed in a
+manifest of glob patterns are copied back to the protocol directory, discarding the intermediate files without writing
+them to the shared storage."""
+import glob
+import os
+import shutil
+import tempfile
+from os.path import join, basename, abspath, isfile, isdir, relpath, realpath
+
+from emtable import Table
+from pyworkflow.utils import makePath
+
+from pyseg.constants import NOT_FOUND, STAGED_OUTPUTS_FILE, VESICLE, SEGMENTATION, GRAPHS_PICKLE_FILE, FILS_PICKLE_FILE
+
+SCRATCH_IN = 'in'
+SCRATCH_OUT = 'out'
+# Star file fields of the files read by the scripts. The others, like the tomograms, are left in place
+STAGED_FIELDS = [VESICLE, SEGMENTATION, GRAPHS_PICKLE_FILE, FILS_PICKLE_FILE]
+
+
+class ScratchStaging:
+    """Staging of a pySeg script execution, which writes its outputs into outDir, in a private directory of the
+    scratch. Usage: args = staging.start(args), run the script, staging.copyBack() and always staging.clean()."""
+
+    def __init__(self, scratchRoot, outDir, keep):
+        self.scratchRoot = abspath(scratchRoot)
+        self.outDir = outDir
+        self.keep = keep
+        self.scratchDir = None
+        self._staged = {}  # Original path: staged path
+
+    @property
+    def scratchIn(self):
+        return join(self.scratchDir, SCRATCH_IN)
+
+    @property
+    def scratchOut(self):
+        return join(self.scratchDir, SCRATCH_OUT)
+
+    def start(self, args):
+        """Create the scratch directory and stage the inputs. Return the arguments with the output directory and
+        the input star files replaced by their staged versions."""
+        makePath(self.scratchRoot)
+        self.scratchDir = tempfile.mkdtemp(prefix='pyseg_', dir=self.scratchRoot)
+        makePath(self.scratchIn, self.scratchOut)
+        tokens = args.split(' ')
+        for i, token in enumerate(tokens):
+            if token == self.outDir:
+                tokens[i] = self.scratchOut
+            elif token.endswith('.star') and isfile(token):
+                tokens[i] = self.stageStarFile(token)
+        return ' '.join(tokens)
+
+    def stageStarFile(self, starFile):
+        """Write a copy of the star file into the scratch with the files read by the scripts replaced by staged
+        links. The files of the other fields are referred to in place."""
+        inTable = Table()
+        inTable.read(starFile)
+        labels = inTable.getColumnNames()
+        outTable = Table(columns=labels)
+        for row in inTable:
+            values = [row.get(label, NOT_FOUND) for label in labels]
+            outTable.addRow(*[self._stageFile(value) if label in STAGED_FIELDS and isinstance(value, str) and
+                              isfile(value) else value for label, value in zip(labels, values)])
+        stagedStar = self._getStagedName(starFile)
+        outTable.write(stagedStar)
+        return stagedStar
+
+    def copyBack(self):
+        """Copy the outputs matching the manifest to the output directory, with the staged paths in the star files
+        replaced by the original ones, and register them in the staged outputs file of the output directory."""
+        # Longest first, so no path is partially replaced by a shorter one contained in it
+        pathsMap = sorted([(staged, original) for original, staged in self._staged.items()] +
+                          [(self.scratchOut, self.outDir)], key=lambda item: len(item[0]), reverse=True)
+        copied = []
+        for pattern in self.keep:
+            for stagedFile in sorted(glob.glob(join(self.scratchOut, pattern))):
+                outFile = join(self.outDir, relpath(stagedFile, self.scratchOut))
+                if isdir(stagedFile):
+                    shutil.copytree(stagedFile, outFile, dirs_exist_ok=True)
+                elif stagedFile.endswith('.star'):
+                    with open(stagedFile) as f:
+                        content = f.read()
+                    for stagedPath, originalPath in pathsMap:
+                        content = content.replace(stagedPath, originalPath)
+                    with open(outFile, 'w') as f:
+                        f.write(content)
+                else:
+                    shutil.copyfile(stagedFile, outFile)
+                copied.append(outFile)
+        with open(join(self.outDir, STAGED_OUTPUTS_FILE), 'a') as f:
+            f.write(''.join('%s\n' % outFile for outFile in copied))
+        return copied
+
+    def clean(self):
+        if self.scratchDir:
+            shutil.rmtree(self.scratchDir, ignore_errors=True)
+
+    def _stageFile(self, fileName):
+        if fileName not in self._staged:
+            stagedFile = self._getStagedName(fileName)
+            try:
+                os.link(realpath(fileName), stagedFile)
+            except OSError:  # Different filesystems
+                shutil.copyfile(fileName, stagedFile)
+            self._staged[fileName] = stagedFile
+        return self._staged[fileName]
+
+    def _getStagedName(self, fileName):
+        # Numbered, as files from different directories may have the same name
+        stagedDir = join(self.scratchIn, '%03d' % len(os.listdir(self.scratchIn)))
+        makePath(stagedDir)
+        return join(stagedDir, basename(fileName))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Lightweight stand-ins of the pySeg scripts called by the plugin. They accept the same command line and generate
+the same output files (names, star columns and MRC volumes) on small synthetic volumes, in a fraction of the time,
+so the protocols can be run offline, without pySeg and DisPerSE installed, e.g. to measure the plugin overhead (see
+pyseg.benchmark). They are installed with the same layout as pySeg, so it is enough to point PYSEG_HOME to it."""
+import os
+import shutil
+from os.path import join, dirname, basename
+
+from pyseg.constants import PRESEG_SCRIPT, GRAPHS_SCRIPT, FILS_SCRIPT, PICKING_SCRIPT, POST_REC_SCRIPT_ANGLE_RND, \
+    POST_REC_SCRIPT_MEMB_ATT, PLANE_ALIGN_CLASS_SCRIPT, FILS_SOURCES, FILS_TARGETS, PICKING_SLICES
+from .standin_common import STANDIN_LOG_VAR
+from ..engines import engine_io
+
+STANDINS_DIR = dirname(__file__)
+STANDIN_COMMON = 'standin_common.py'
+
+# Location of each pySeg script in its installation: stand-in script
+STANDIN_SCRIPTS = {
+    PRESEG_SCRIPT: 'pre_tomos_seg.py',
+    GRAPHS_SCRIPT: 'mb_graph_mp.py',
+    FILS_SCRIPT: 'mb_fils_network.py',
+    PICKING_SCRIPT: 'mbo_picking.py',
+    POST_REC_SCRIPT_ANGLE_RND: 'post_rec_particles.py',
+    POST_REC_SCRIPT_MEMB_ATT: 'post_rec_particles.py',
+    PLANE_ALIGN_CLASS_SCRIPT: 'plane_align_class.py',
+}
+
+FILS_XML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<mb_slices>
+  <mb_slice>
+    <name>%s</name>
+    <side>1</side>
+    <eu_dst id="low">0</eu_dst>
+    <eu_dst id="high">15</eu_dst>
+    <eu_dst id="sign">+</eu_dst>
+    <geo_dst id="low">0</geo_dst>
+    <geo_dst id="high">inf</geo_dst>
+    <geo_dst id="sign">+</geo_dst>
+    <geo_len id="low">0</geo_len>
+    <geo_len id="high">45</geo_len>
+    <geo_len id="sign">+</geo_len>
+    <sin id="low">0</sin>
+    <sin id="high">3</sin>
+    <sin id="sign">+</sin>
+  </mb_slice>
+</mb_slices>
+"""
+
+PICKING_XML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<mb_slices>
+  <mb_slice>
+    <name>mb_ext</name>
+    <side>1</side>
+    <cont>+</cont>
+  </mb_slice>
+</mb_slices>
+"""
+
+
+def installStandIns(pysegHome):
+    """Install the stand-in scripts and the xml templates read by the protocols in pysegHome, with the same layout
+    as pySeg."""
+    for scriptLocation, standIn in STANDIN_SCRIPTS.items():
+        scriptDir = dirname(join(pysegHome, scriptLocation))
+        os.makedirs(scriptDir, exist_ok=True)
+        shutil.copyfile(join(STANDINS_DIR, standIn), join(pysegHome, scriptLocation))
+        shutil.copyfile(join(STANDINS_DIR, STANDIN_COMMON), join(scriptDir, STANDIN_COMMON))
+        shutil.copyfile(engine_io.__file__, join(scriptDir, basename(engine_io.__file__)))
+    templates = {FILS_SOURCES: FILS_XML_TEMPLATE % 'mb_sources',
+                 FILS_TARGETS: FILS_XML_TEMPLATE % 'no_mb_targets',
+                 PICKING_SLICES: PICKING_XML_TEMPLATE}
+    for xmlLocation, content in templates.items():
+        os.makedirs(dirname(join(pysegHome, xmlLocation)), exist_ok=True)
+        with open(join(pysegHome, xmlLocation), 'w') as f:
+            f.write(content)
+    return pysegHome
+
+
+def readStandInLog(logFile):
+    """Read the log written by the stand-ins when PYSEG_STANDIN_LOG is defined, returning a list of (script, output
+    directory, elapsed seconds)."""
+    executions = []
+    if os.path.exists(logFile):
+        with open(logFile) as f:
+            for line in f:
+                script, outDir, elapsed = line.rstrip('\n').split('\t')
+                executions.append((script, outDir, float(elapsed)))
+    return executions
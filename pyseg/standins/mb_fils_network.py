@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in of pySeg mb_fils_network.py: for each vesicle of the input star file, it pickles a synthetic filament
+network with a subset of the edges of its graph and writes the output star file, with the same name and columns as
+pySeg."""
+import pickle
+import time
+from os.path import join
+
+from standin_common import parseArgs, readStar, writeStar, removeBaseExt, logElapsedTime
+
+GRAPHS_PICKLE_FILE = 'psGhMCFPickle'
+FILS_PICKLE_FILE = 'psFilPickle'
+
+# One of each FILS_STEP graph edges is kept as filament
+FILS_STEP = 10
+
+
+def main():
+    tStart = time.time()
+    args = parseArgs(__doc__, ['--inStar', '--outDir', '--inSources', '--inTargets', '--thMode', '--gRgLen',
+                               '--gRgSin', '--gRgEud'])
+    labels, rows = readStar(args.inStar)
+    graphCol = labels.index(GRAPHS_PICKLE_FILE)
+    outRows = []
+    for row in rows:
+        with open(row[graphCol], 'rb') as f:
+            graph = pickle.load(f)
+        pickleFile = join(args.outDir, removeBaseExt(row[graphCol]).replace('_mb_graph', '') + '_net.pkl')
+        with open(pickleFile, 'wb') as f:
+            pickle.dump({'vertices': graph['vertices'], 'edges': graph['edges'][::FILS_STEP]}, f)
+        outRows.append(row + [pickleFile])
+    outStar = 'fil_%s_to_%s_net.star' % (removeBaseExt(args.inSources), removeBaseExt(args.inTargets))
+    writeStar(join(args.outDir, outStar), labels + [FILS_PICKLE_FILE], outRows)
+    logElapsedTime('mb_fils_network.py', tStart, args.outDir)
+
+
+if __name__ == '__main__':
+    main()
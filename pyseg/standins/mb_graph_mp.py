@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in of pySeg mb_graph_mp.py: for each vesicle of the input star file, it pickles a synthetic graph with a
+vertex per membrane voxel of its segmentation and writes the output star file, with the same name and columns as
+pySeg."""
+import pickle
+import time
+from os.path import join
+
+import numpy as np
+
+from standin_common import parseArgs, readStar, writeStar, removeBaseExt, readVolume, logElapsedTime
+
+GRAPHS_PICKLE_FILE = 'psGhMCFPickle'
+
+
+def genGraph(segFile, seed):
+    """Vertices at the membrane voxels of the segmentation, each one connected to a random one."""
+    vertices = np.argwhere(readVolume(segFile) == 1)[:, ::-1].astype(np.float32)
+    rng = np.random.default_rng(seed)
+    edges = np.stack([np.arange(len(vertices)), rng.integers(0, max(1, len(vertices)), len(vertices))], axis=1)
+    return {'vertices': vertices, 'edges': edges}
+
+
+def main():
+    tStart = time.time()
+    args = parseArgs(__doc__, ['--inStar', '--outDir', '--pixelSize', '--sSig', '--vDen', '--veRatio', '--maxLen',
+                               '-j'])
+    labels, rows = readStar(args.inStar)
+    segCol = labels.index('psSegImage')
+    outRows = []
+    for i, row in enumerate(rows):
+        pickleFile = join(args.outDir, removeBaseExt(row[segCol]) + '_mb_graph.pkl')
+        with open(pickleFile, 'wb') as f:
+            pickle.dump(genGraph(row[segCol], i), f)
+        outRows.append(row + [pickleFile])
+    writeStar(join(args.outDir, removeBaseExt(args.inStar) + '_mb_graph.star'), labels + [GRAPHS_PICKLE_FILE],
+              outRows)
+    logElapsedTime('mb_graph_mp.py', tStart, args.outDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in of pySeg mbo_picking.py: for each vesicle of the input star file, it picks the first vertices of its
+filament network, in tomogram coordinates, and writes the output star file, with the same name and columns as
+pySeg."""
+import pickle
+import time
+from os.path import join
+
+import numpy as np
+
+from standin_common import parseArgs, readStar, writeStar, removeBaseExt, logElapsedTime
+
+FILS_PICKLE_FILE = 'psFilPickle'
+OUT_LABELS = ['rlnMicrographName', 'rlnImageName', 'rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ',
+              'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi']
+
+# Maximum number of particles picked per vesicle
+PICKS_PER_VESICLE = 5
+
+
+def main():
+    tStart = time.time()
+    args = parseArgs(__doc__, ['--inStar', '--outDir', '--slicesFile', '--peakTh', '--peakNs'])
+    labels, rows = readStar(args.inStar)
+    outRows = []
+    for row in rows:
+        values = dict(zip(labels, row))
+        with open(values[FILS_PICKLE_FILE], 'rb') as f:
+            net = pickle.load(f)
+        offsets = np.array([float(values[label]) for label in ('psSegOffX', 'psSegOffY', 'psSegOffZ')])
+        vertices = net['vertices'][np.unique(net['edges'][:, 0])[:PICKS_PER_VESICLE]]
+        for coords in vertices + offsets:
+            outRows.append([values['rlnMicrographName'], values['rlnImageName']] + ['%.2f' % c for c in coords] +
+                           [0, 90, 0])
+    writeStar(join(args.outDir, removeBaseExt(args.inStar) + '_parts.star'), OUT_LABELS, outRows)
+    logElapsedTime('mbo_picking.py', tStart, args.outDir)
+
+
+if __name__ == '__main__':
+    main()
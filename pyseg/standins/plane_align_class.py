@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in of pySeg plane_align_class.py. Up to the processing level requested (numbered from 1), it flattens the
+particles (central slice along y) into a 2D stack along with their masks, computes the cross correlation matrix (AP)
+or the feature vectors (AG and K-means), and assigns the particles to the classes in turn, writing the gathered and
+per class star files and the class references, with the same layout as pySeg. For AP, the number of classes is the
+number of particles divided by AP_CLASS_SIZE."""
+import os
+import time
+from os.path import join
+
+import numpy as np
+
+from standin_common import parseArgs, readStar, writeStar, readVolume, writeVolume, logElapsedTime
+
+OUT_STEM = 'class'
+CLASS_NUMBER = 'rlnClassNumber'
+AP_CLASS_SIZE = 20
+
+# Processing levels
+PARTICLE_FLATTENING = 1
+CC_MATRIX_FEAT_VECTORS = 2
+FULL_CLASSIFICATION = 3
+
+# Outputs of each processing level
+PARTICLES_STACK = OUT_STEM + '_particles.mrc'
+MASKS_STACK = OUT_STEM + '_masks.mrc'
+CC_MATRIX = OUT_STEM + '_cc.npy'
+FEATURE_VECTORS = OUT_STEM + '_vectors.npy'
+
+
+def flatten(vol):
+    return vol[:, vol.shape[1] // 2]
+
+
+def main():
+    tStart = time.time()
+    args = parseArgs(__doc__, ['--inRootDir', '--inStar', '--inMask', '--outDir', '--filterSize', '--procLevel',
+                               '--doCC3d', '--ccMetric', '--clusteringAlg', '--distanceMetric', '--apPref',
+                               '--apDumping', '--apMaxIter', '--apConvIter', '--apCCRefFilter', '--pcaComps',
+                               '--aggNClusters', '--kmeansNClusters', '--apPartSizeFilter', '-j'])
+    os.makedirs(args.outDir, exist_ok=True)
+    procLevel = int(args.procLevel) if args.procLevel else FULL_CLASSIFICATION
+    labels, rows = readStar(args.inStar)
+    imageCol = labels.index('rlnImageName')
+    isAP = args.clusteringAlg == 'AP'
+
+    mask = flatten(readVolume(args.inMask))
+    particles = np.stack([flatten(readVolume(row[imageCol])) * mask for row in rows])
+    writeVolume(particles, join(args.outDir, PARTICLES_STACK))
+    writeVolume(np.repeat(mask[np.newaxis], len(rows), axis=0), join(args.outDir, MASKS_STACK))
+    if procLevel >= CC_MATRIX_FEAT_VECTORS:
+        vectors = particles[:, mask > 0]
+        vectors -= vectors.mean(axis=1, keepdims=True)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+        if isAP:
+            np.save(join(args.outDir, CC_MATRIX), vectors @ vectors.T)
+        else:
+            pcaComps = int(args.pcaComps) if args.pcaComps else 0
+            np.save(join(args.outDir, FEATURE_VECTORS), vectors[:, :pcaComps] if pcaComps else vectors)
+
+    if procLevel >= FULL_CLASSIFICATION:
+        nClusters = args.kmeansNClusters if args.kmeansNClusters else args.aggNClusters
+        nClasses = max(1, min(len(rows), len(rows) // AP_CLASS_SIZE if isAP else int(nClusters)))
+        if CLASS_NUMBER not in labels:
+            labels = labels + [CLASS_NUMBER]
+            rows = [row + [0] for row in rows]
+        classCol = labels.index(CLASS_NUMBER)
+        classIds = np.arange(len(rows)) % nClasses
+        for row, classId in zip(rows, classIds):
+            row[classCol] = classId
+        writeStar(join(args.outDir, '%s_gather.star' % OUT_STEM), labels, rows)
+        refsDir = join(args.outDir, '%s_%s' % (OUT_STEM, 'exemplars' if isAP else 'averages'))
+        os.makedirs(refsDir, exist_ok=True)
+        for classId in range(nClasses):
+            members = np.where(classIds == classId)[0]
+            writeStar(join(args.outDir, '%s_k%i_split.star' % (OUT_STEM, classId)), labels,
+                      [rows[i] for i in members])
+            # First member as the class reference
+            writeVolume(particles[members[0]], join(refsDir, 'class_k%i.mrc' % classId))
+    logElapsedTime('plane_align_class.py', tStart, args.outDir)
+
+
+if __name__ == '__main__':
+    main()
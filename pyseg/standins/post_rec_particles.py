@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in of pySeg post_rec_particles.py: it multiplies each particle of the input star file by the mask,
+randomizes its rot angle and writes the output star file, with the same columns as pySeg. The membrane suppression
+and the low pass filter are not applied."""
+import os
+import time
+from os.path import join
+
+import numpy as np
+
+from standin_common import parseArgs, readStar, writeStar, removeBaseExt, readVolume, writeVolume, logElapsedTime
+
+
+def main():
+    tStart = time.time()
+    args = parseArgs(__doc__, ['--inStar', '--inMask', '--inMaskMbSup', '--mbSupFactor', '--doGaussLowPass',
+                               '--outDir', '--outStar', '-j'])
+    os.makedirs(args.outDir, exist_ok=True)
+    labels, rows = readStar(args.inStar)
+    imageCol = labels.index('rlnImageName')
+    rotCol = labels.index('rlnAngleRot') if 'rlnAngleRot' in labels else None
+    mask = readVolume(args.inMask)
+    rng = np.random.default_rng(0)
+    for row in rows:
+        outFile = join(args.outDir, removeBaseExt(row[imageCol]) + '.mrc')
+        writeVolume(readVolume(row[imageCol]) * mask, outFile)
+        row[imageCol] = outFile
+        if rotCol is not None:
+            row[rotCol] = '%.2f' % rng.uniform(0, 360)
+    writeStar(args.outStar, labels, rows)
+    logElapsedTime('post_rec_particles.py', tStart, args.outDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in of pySeg pre_tomos_seg.py: for each membrane of the input star file, it writes a small synthetic
+sub-volume and its segmentation into outDir/segs and the output star file, with the same names and columns as
+pySeg."""
+import os
+import time
+from os.path import join
+
+import numpy as np
+
+from standin_common import parseArgs, readStar, writeStar, removeBaseExt, readVolume, writeVolume, \
+    genSphericalShell, logElapsedTime, STANDIN_BOX
+
+OUT_LABELS = ['rlnMicrographName', 'rlnImageName', 'psSegImage', 'psSegLabel', 'psSegRot', 'psSegTilt', 'psSegPsi',
+              'psSegOffX', 'psSegOffY', 'psSegOffZ']
+
+
+def getLabelCenters(maskFile):
+    """Center of each label of a tomomask, as (x, y, z)."""
+    labels = readVolume(maskFile).astype(np.int32)
+    counts = np.bincount(labels.ravel())
+    # Coordinates sum of each label along x, y and z
+    sums = [np.bincount(labels.ravel(), weights=coords.ravel(), minlength=len(counts))
+            for coords in np.indices(labels.shape)[::-1]]
+    return {int(label): [axisSums[label] / counts[label] for axisSums in sums] for label in np.nonzero(counts)[0]}
+
+
+def main():
+    tStart = time.time()
+    args = parseArgs(__doc__, ['--inStar', '--outDir', '--spOffVoxels', '--sgVoxelSize', '--sgThreshold',
+                               '--sgSizeThreshold', '--sgMembThk', '--sgMembNeigh'])
+    segsDir = join(args.outDir, 'segs')
+    os.makedirs(segsDir, exist_ok=True)
+    labels, rows = readStar(args.inStar)
+    isCentered = 'rlnOriginX' in labels
+    vesicle = genSphericalShell()
+    # Segmentation areas: 1 membrane, 2 inner and 3 outer surroundings
+    seg = np.where(vesicle > 0, 1, 2).astype(np.float32)
+    seg[0], seg[-1] = 3, 3
+    centersDict = {}
+    outRows = []
+    for i, row in enumerate(rows):
+        values = dict(zip(labels, row))
+        tomoFile = values['rlnMicrographName']
+        if isCentered:
+            center = [float(values[label]) for label in ('rlnOriginX', 'rlnOriginY', 'rlnOriginZ')]
+        else:
+            maskFile = values['psSegImage']
+            if maskFile not in centersDict:
+                centersDict[maskFile] = getLabelCenters(maskFile)
+            center = centersDict[maskFile].get(int(values['psSegLabel']), [0, 0, 0])
+        offsets = [int(round(c - STANDIN_BOX / 2)) for c in center]
+        stem = join(segsDir, '%s_tid_%i' % (removeBaseExt(tomoFile), i))
+        writeVolume(vesicle, stem + '.mrc')
+        writeVolume(seg, stem + '_seg.mrc')
+        outRows.append([tomoFile, stem + '.mrc', stem + '_seg.mrc', values['psSegLabel'], 0, 0, 0] + offsets)
+    writeStar(join(args.outDir, removeBaseExt(args.inStar) + '_pre.star'), OUT_LABELS, outRows)
+    logElapsedTime('pre_tomos_seg.py', tStart, args.outDir)
+
+
+if __name__ == '__main__':
+    main()
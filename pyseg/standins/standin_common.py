@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Helpers shared by the pySeg stand-in scripts. As the scripts they are copied next to, along with the engines
+input/output module, it only depends on NumPy."""
+import argparse
+import os
+import time
+from os.path import basename, splitext
+
+import numpy as np
+
+try:
+    from ..engines.engine_io import readStar, writeStar, readVolume, writeVolume  # Imported from the plugin
+except ImportError:
+    from engine_io import readStar, writeStar, readVolume, writeVolume  # Installed next to the stand-ins
+
+# Environment variable with the file where each stand-in execution logs its elapsed time
+STANDIN_LOG_VAR = 'PYSEG_STANDIN_LOG'
+
+# Box size (voxels) of the sub-volumes generated by the stand-ins
+STANDIN_BOX = 16
+
+
+def parseArgs(description, argNames):
+    """Parse the given arguments (all of them read as strings), ignoring the unknown ones, so the stand-ins accept
+    the whole pySeg command line."""
+    parser = argparse.ArgumentParser(description=description)
+    for argName in argNames:
+        parser.add_argument(argName)
+    return parser.parse_known_args()[0]
+
+
+def removeBaseExt(fileName):
+    return splitext(basename(fileName))[0]
+
+
+def getDimensions(fileName):
+    """(x, y, z) dimensions of an MRC file."""
+    nx, ny, nz = np.fromfile(fileName, dtype=np.int32, count=3)
+    return int(nx), int(ny), int(nz)
+
+
+def genSphericalShell(boxSize=STANDIN_BOX, radius=None, thickness=2):
+    """Synthetic vesicle: spherical shell centered in the box."""
+    radius = radius if radius else boxSize / 4
+    coords = np.indices((boxSize,) * 3) - (boxSize - 1) / 2
+    dist = np.sqrt((coords ** 2).sum(axis=0))
+    return (np.abs(dist - radius) < thickness / 2).astype(np.float32)
+
+
+def logElapsedTime(scriptName, tStart, outDir):
+    """Append the elapsed time of the stand-in execution to the file pointed by PYSEG_STANDIN_LOG, if defined."""
+    logFile = os.environ.get(STANDIN_LOG_VAR)
+    if logFile:
+        with open(logFile, 'a') as f:
+            f.write('%s\t%s\t%f\n' % (scriptName, os.path.abspath(outDir), time.time() - tStart))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Performance gates of the tests: the time and memory of each protocol run by the tests (stage) are measured and
+compared to a stored baseline, reporting the comparison per stage when the test class finishes. The behavior is
+controlled with the following environment variables:
+
+    - PYSEG_PERF_MODE: record, to store the measurements in the baseline, or check, to make the test class fail if
+      any stage is slower or uses more memory than its baseline beyond the tolerance, or has no baseline. If not set,
+      the comparison is only reported.
+    - PYSEG_PERF_TOLERANCE: allowed relative increase (0.25 by default).
+    - PYSEG_PERF_BASELINE: baseline file (perf_baseline.json, next to this file, by default).
+
+The baseline is only meaningful for the machine where it was recorded, so it is not shipped with measurements and
+has to be recorded on the reference machine before checking, and again when the machine changes, e.g.::
+
+    PYSEG_PERF_MODE=record scipion3 tests pyseg.tests.test_preseg_graphs_fils_picking
+    PYSEG_PERF_MODE=check scipion3 tests pyseg.tests.test_preseg_graphs_fils_picking
+"""
+import json
+import logging
+import os
+import threading
+import time
+from os.path import join, dirname, exists
+
+import psutil
+
+from pyseg.benchmark import getProtocolTimings
+from pyseg.constants import PERF_MODE, PERF_RECORD, PERF_CHECK, PERF_BASELINE, PERF_TOLERANCE, \
+    DEFAULT_PERF_TOLERANCE, PERF_MIN_SECONDS, PERF_MIN_MB
+from pyworkflow.tests import BaseTest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE = join(dirname(__file__), 'perf_baseline.json')
+MEMORY_SAMPLING_PERIOD = 0.2  # Seconds
+MB = 1024 ** 2
+
+
+class MemorySampler(threading.Thread):
+    """Sample the memory (RSS) used by the processes launched by the current one until stopped, keeping the peak,
+    as the protocols are run in child processes."""
+
+    def __init__(self, period=MEMORY_SAMPLING_PERIOD):
+        super().__init__(daemon=True)
+        self.period = period
+        self.peak = 0
+        self._stopEvent = threading.Event()
+
+    def run(self):
+        while not self._stopEvent.is_set():
+            self.peak = max(self.peak, getChildrenMemory())
+            self._stopEvent.wait(self.period)
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+        return self.peak / MB
+
+
+class PerfBaseTest(BaseTest):
+    """BaseTest that measures each protocol launched and compares the measurements to the baseline when all the
+    tests of the class have finished."""
+
+    _perfStages = None
+    _perfTest = 'setUpClass'
+
+    def setUp(self):
+        super().setUp()
+        type(self)._perfTest = self._testMethodName
+
+    @classmethod
+    def launchProtocol(cls, prot, **kwargs):
+        sampler = MemorySampler()
+        sampler.start()
+        tStart = time.time()
+        try:
+            prot = super().launchProtocol(prot, **kwargs)
+        finally:
+            elapsed = time.time() - tStart
+            peakMemory = sampler.stop()
+        if prot.isFinished():
+            timings = getProtocolTimings(cls.proj, prot)
+            cls._getPerfStages()[cls._getStageKey(prot)] = {'wall': elapsed,
+                                                          'memory': peakMemory,
+                                                          'phases': timings['phases']}
+        return prot
+
+    @classmethod
+    def tearDownClass(cls):
+        stages = cls._getPerfStages()
+        if stages:
+            baselineFile = os.environ.get(PERF_BASELINE, DEFAULT_BASELINE)
+            tolerance = float(os.environ.get(PERF_TOLERANCE, DEFAULT_PERF_TOLERANCE))
+            mode = os.environ.get(PERF_MODE)
+            baseline = readBaseline(baselineFile)
+            report, regressions, missing = compareToBaseline(stages, baseline, tolerance)
+            logger.info('Performance of %s (tolerance %i%%):\n%s' % (cls.__name__, 100 * tolerance, report))
+            if mode == PERF_RECORD:
+                baseline.update(stages)
+                writeBaseline(baselineFile, baseline)
+                logger.info('Baseline updated in %s' % baselineFile)
+            elif mode == PERF_CHECK and (regressions or missing):
+                errors = []
+                if regressions:
+                    errors.append('Performance regressions in %s' % ', '.join(regressions))
+                if missing:
+                    errors.append('No baseline in %s for %s. Record it with %s=%s' %
+                                  (baselineFile, ', '.join(missing), PERF_MODE, PERF_RECORD))
+                raise AssertionError('%s:\n%s' % ('\n'.join(errors), report))
+
+    @classmethod
+    def _getPerfStages(cls):
+        # Each test class keeps its own stages
+        if cls.__dict__.get('_perfStages') is None:
+            cls._perfStages = {}
+        return cls._perfStages
+
+    @classmethod
+    def _getStageKey(cls, prot):
+        """Stage name: class, test and protocol label or class name, numbered if repeated in the same test."""
+        baseKey = '%s.%s.%s' % (cls.__name__, cls._perfTest, prot.getObjLabel() or prot.getClassName())
+        key = baseKey
+        counter = 1
+        while key in cls._getPerfStages():
+            counter += 1
+            key = '%s_%i' % (baseKey, counter)
+        return key
+
+
+# ---- UTIL functions ----
+def getChildrenMemory():
+    """Sum of the RSS of all the descendant processes of the current one, in bytes."""
+    memory = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            memory += child.memory_info().rss
+        except psutil.Error:  # Finished meanwhile
+            pass
+    return memory
+
+
+def readBaseline(baselineFile):
+    if exists(baselineFile):
+        with open(baselineFile) as f:
+            return json.load(f)
+    return {}
+
+
+def writeBaseline(baselineFile, baseline):
+    with open(baselineFile, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def isRegression(value, baseValue, tolerance, minIncrease):
+    return value - baseValue > max(tolerance * baseValue, minIncrease)
+
+
+def compareToBaseline(stages, baseline, tolerance):
+    """Compare the wall time and peak memory of each stage to its baseline. Return the report, a line per stage and
+    metric plus the phases of the regressed stages, the list of regressed stages and the list of stages with no
+    baseline."""
+    lines = ['%-70s %-8s %10s %10s %8s' % ('Stage', 'Metric', 'Baseline', 'Current', 'Change')]
+    regressions = []
+    missing = []
+    for stage, measures in stages.items():
+        base = baseline.get(stage)
+        if base is None:
+            lines.append('%-70s %-8s %10s %10.2f %8s' % (stage, 'wall', '-', measures['wall'], 'new'))
+            missing.append(stage)
+            continue
+        regressed = False
+        for metric, minIncrease in (('wall', PERF_MIN_SECONDS), ('memory', PERF_MIN_MB)):
+            value, baseValue = measures[metric], base[metric]
+            change = '%+.0f%%' % (100 * (value - baseValue) / baseValue) if baseValue else '-'
+            if isRegression(value, baseValue, tolerance, minIncrease):
+                regressed = True
+                change += ' !!'
+            lines.append('%-70s %-8s %10.2f %10.2f %8s' % (stage, metric, baseValue, value, change))
+        if regressed:
+            regressions.append(stage)
+            basePhases = base.get('phases', {})
+            for phase, value in measures['phases'].items():
+                baseValue = basePhases.get(phase)
+                lines.append('%-70s %-8s %10s %10.2f' % ('    ' + phase, 'phase',
+                                                         '%.2f' % baseValue if baseValue is not None else '-',
+                                                         value))
+    return '\n'.join(lines), regressions, missing
@@ -0,0 +1,194 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+import json
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr
+
+from pyseg.batch import loadManifest, runChains, Chain, CHAIN, PROFILES, DATASETS, DEFAULT_PROFILE
+
+# Number of checks a fake protocol takes to finish after being launched
+CHECKS_TO_FINISH = 2
+
+
+class FakeSet:
+    def __init__(self, size):
+        self._size = size
+
+    def getSize(self):
+        return self._size
+
+
+class FakeProtocol:
+    """Protocol whose outputs are sets of a fixed size and that finishes, or fails, after a few checks."""
+
+    def __init__(self, objId, protClass, params, fail=False):
+        self._objId = objId
+        self.protClass = protClass
+        self.params = params
+        self.label = None
+        self.fail = fail
+        self.checks = 0
+
+    def __getattr__(self, outputName):
+        return FakeSet(1)
+
+    def setObjLabel(self, label):
+        self.label = label
+
+    def getObjId(self):
+        return self._objId
+
+    def isFinished(self):
+        return not self.fail and self.checks >= CHECKS_TO_FINISH
+
+    def isFailed(self):
+        return self.fail and self.checks >= CHECKS_TO_FINISH
+
+    def isAborted(self):
+        return False
+
+    def getErrorMessage(self):
+        return 'fake error'
+
+
+class FakeProject:
+    """Project that creates fake protocols, failing those whose label is in failLabels and refusing to create those
+    whose label is in unlaunchableLabels. It keeps the number of protocols running at the same time."""
+
+    def __init__(self, failLabels=(), unlaunchableLabels=()):
+        self.failLabels = failLabels
+        self.unlaunchableLabels = unlaunchableLabels
+        self.protocols = {}
+        self.launched = []
+        self.maxRunning = 0
+
+    def newProtocol(self, protClass, **params):
+        prot = FakeProtocol(len(self.protocols) + 1, protClass, params)
+        self.protocols[prot.getObjId()] = prot
+        return prot
+
+    def launchProtocol(self, prot):
+        if prot.label in self.unlaunchableLabels:
+            raise Exception('fake launch error')
+        prot.fail = prot.label in self.failLabels
+        self.launched.append(prot.label)
+
+    def getProtocol(self, objId):
+        prot = self.protocols[objId]
+        prot.checks += 1
+        return prot
+
+    def getRuns(self, refresh=False):
+        running = [prot for prot in self.protocols.values()
+                   if prot.label in self.launched and not prot.isFinished() and not prot.isFailed()]
+        self.maxRunning = max(self.maxRunning, len(running))
+        return running
+
+
+class TestBatch(BaseTest):
+    """Manifest loading and chain scheduling of the batch runner, with a fake project."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    @staticmethod
+    def _getDataset(name, **kwargs):
+        dataset = {'name': name, 'tomograms': '/data/%s/*.mrc' % name, 'samplingRate': 13.68,
+                   'tomomasks': '/data/%s/masks/*.mrc' % name}
+        dataset.update(kwargs)
+        return dataset
+
+    def _writeManifest(self, name, manifest):
+        manifestFile = self.getOutputPath(name + '.json')
+        with open(manifestFile, 'w') as f:
+            json.dump(manifest, f)
+        return manifestFile
+
+    @staticmethod
+    def _getLabel(datasetName, stageName):
+        return '%s - %s' % (datasetName, stageName)
+
+    def testLoadManifest(self):
+        print(magentaStr("\n==> Batch runner manifest loading:"))
+        profiles = {DEFAULT_PROFILE: {'preseg': {'spOffVoxels': 22}}, 'thick': {'preseg': {'sgMembThk': 80}}}
+        datasets = [self._getDataset('ds1'), self._getDataset('ds2', profile='thick')]
+        self.assertEqual(loadManifest(self._writeManifest('valid', {PROFILES: profiles, DATASETS: datasets})),
+                         (profiles, datasets))
+
+        invalidManifests = {
+            'noDatasets': ({PROFILES: profiles, DATASETS: []}, 'No datasets'),
+            'missingKey': ({PROFILES: profiles, DATASETS: [{'name': 'ds1', 'tomograms': '*.mrc'}]},
+                           'samplingRate, tomomasks'),
+            'duplicated': ({PROFILES: profiles, DATASETS: [self._getDataset('ds1'), self._getDataset('ds1')]},
+                           'duplicated'),
+            'noProfile': ({PROFILES: profiles, DATASETS: [self._getDataset('ds1', profile='thin')]},
+                          'Profile thin'),
+            'noDefaultProfile': ({DATASETS: [self._getDataset('ds1')]}, 'Profile %s' % DEFAULT_PROFILE),
+        }
+        for name, (manifest, errorMsg) in invalidManifests.items():
+            with self.assertRaises(ValueError, msg=name) as context:
+                loadManifest(self._writeManifest(name, manifest))
+            self.assertIn(errorMsg, str(context.exception))
+
+    def testChain(self):
+        print(magentaStr("\n==> Batch runner chain of a dataset:"))
+        project = FakeProject()
+        profile = {'preseg': {'spOffVoxels': 22}}
+        chain = Chain(project, self._getDataset('ds1'), profile)
+        self.assertTrue(chain.launchNext())
+        done = False
+        while not done:
+            done = chain.update()
+        stageNames = [stageName for stageName, _, _ in CHAIN]
+        self.assertFalse(chain.failed)
+        self.assertEqual(project.launched, [self._getLabel('ds1', stageName) for stageName in stageNames])
+        self.assertEqual(list(chain.protocols), stageNames)
+        # The profile parameters are passed along with the inputs from the previous protocol of the chain
+        preseg = chain.protocols['preseg']
+        self.assertEqual(preseg.params['spOffVoxels'], 22)
+        self.assertIn('inTomoMasks', preseg.params)
+        self.assertIs(chain.protocols['graphs'].params['inSegProt'], preseg)
+        self.assertEqual(chain.getResults(), (1, 1))
+
+    def testRunChains(self):
+        print(magentaStr("\n==> Batch runner scheduling several chains:"))
+        # Dataset ds2 fails in the graphs stage and ds3 can't be launched, without stopping the others
+        project = FakeProject(failLabels=[self._getLabel('ds2', 'graphs')],
+                              unlaunchableLabels=[self._getLabel('ds3', 'importTomograms')])
+        datasets = [self._getDataset('ds%i' % i) for i in range(1, 6)]
+        maxConcurrent = 2
+        chains = runChains(project, {DEFAULT_PROFILE: {}}, datasets, maxConcurrent=maxConcurrent, pollTime=0)
+        self.assertEqual(sorted(chain.name for chain in chains), [dataset['name'] for dataset in datasets])
+        failed = {chain.name for chain in chains if chain.failed}
+        self.assertEqual(failed, {'ds2', 'ds3'})
+        for chain in chains:
+            self.assertIsNotNone(chain.tEnd)
+            if chain.name == 'ds2':
+                self.assertEqual(list(chain.protocols)[-1], 'graphs')
+            elif chain.name not in failed:
+                self.assertEqual(len(chain.protocols), len(CHAIN))
+        self.assertEqual(project.maxRunning, maxConcurrent)
@@ -0,0 +1,85 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+
+import json
+import subprocess
+import sys
+
+from pyworkflow.tests import BaseTest
+from pyworkflow.utils import magentaStr
+
+# Modules deferred to the functions using them
+VTK_MODULES = ['tomoviz', 'vtk']
+RELION_MODULES = ['reliontomo', 'relion']
+SCIPY_MODULES = ['scipy']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+tStart = time.time()
+%s
+print(json.dumps({'elapsed': time.time() - tStart, 'modules': sorted(sys.modules)}))
+"""
+
+
+class TestImportTime(BaseTest):
+    """Cost of loading the plugin, as done by Scipion when listing the plugins, and of discovering its protocols and
+    viewers. Each import is measured in a new interpreter, with the Scipion core already loaded as in the GUI."""
+
+    def testPluginImport(self):
+        loaded = self._checkImport('import pyseg', 'Plugin')
+        self._assertNotLoaded(loaded, VTK_MODULES + RELION_MODULES + SCIPY_MODULES + ['pyseg.protocols'])
+
+    def testProtocolImport(self):
+        loaded = self._checkImport('from pyseg.protocols import ProtPySegGraphs', 'Graphs protocol')
+        self._assertNotLoaded(loaded, VTK_MODULES + RELION_MODULES + ['pyseg.protocols.protocol_post_rec_particles'])
+
+    def testProtocolsDiscovery(self):
+        loaded = self._checkImport('import inspect, pyseg.protocols\n'
+                                   'inspect.getmembers(pyseg.protocols, inspect.isclass)', 'Protocols discovery')
+        self._assertNotLoaded(loaded, VTK_MODULES)
+        self.assertIn('pyseg.protocols.protocol_vesicle_pipeline', loaded)
+
+    def testViewersImport(self):
+        loaded = self._checkImport('import pyseg.viewers', 'Viewers')
+        self._assertNotLoaded(loaded, VTK_MODULES)
+
+    def _checkImport(self, statement, label):
+        """Run the import statement after loading the Scipion core, report its time and return the modules it loads."""
+        baseline = self._runImport('import pyworkflow.protocol, pwem.protocols, tomo.objects')
+        result = self._runImport('import pyworkflow.protocol, pwem.protocols, tomo.objects\n' + statement)
+        newModules = set(result['modules']) - set(baseline['modules'])
+        print(magentaStr('%s: %.3f s and %i new modules over the Scipion core (%.3f s)'
+                         % (label, result['elapsed'] - baseline['elapsed'], len(newModules), baseline['elapsed'])))
+        return newModules
+
+    @staticmethod
+    def _runImport(statement):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % statement], text=True)
+        return json.loads(output.strip().splitlines()[-1])
+
+    def _assertNotLoaded(self, loaded, modules):
+        for module in modules:
+            self.assertFalse([name for name in loaded if name == module or name.startswith(module + '.')],
+                             '%s should not be loaded' % module)
@@ -0,0 +1,166 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+
+import subprocess
+import time
+from os.path import exists, join
+
+import numpy as np
+from emtable import Table
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr, makePath
+from scipion.constants import PYTHON
+from scipy.ndimage import map_coordinates
+from scipy.spatial.transform import Rotation
+
+from pyseg import Plugin
+from pyseg.constants import POST_REC_SCRIPT_MEMB_ATT
+from pyseg.engines.mb_suppression import runMbSuppression, readVolume, writeVolume
+
+# Maximum relative RMS error allowed when the angles are rounded by the engine or processed by pySeg
+ANGULAR_STEP_TOL = 0.1
+
+
+class TestMbSuppressionEngine(BaseTest):
+    """Correctness and benchmark of the plugin membrane suppression engine on a synthetic set of particles."""
+
+    nParticles = 200
+    boxSize = 44
+    voxelSize = 13.68
+    mbSupFactor = 0.3
+    nThreads = 4
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.inDir = cls.getOutputPath('in')
+        makePath(cls.inDir)
+        rng = np.random.default_rng(0)
+        # Spherical particle mask, a membrane slab perpendicular to z and a patch of it not symmetric around z
+        coords = np.indices((cls.boxSize,) * 3) - (cls.boxSize - 1) / 2
+        cls.maskFile = cls.getOutputPath('mask.mrc')
+        writeVolume((np.sqrt((coords ** 2).sum(axis=0)) < 0.4 * cls.boxSize).astype(np.float32), cls.maskFile,
+                    voxelSize=cls.voxelSize)
+        cls.mbMaskFile = cls.getOutputPath('mbMask.mrc')
+        writeVolume((np.abs(coords[0]) < 3).astype(np.float32), cls.mbMaskFile, voxelSize=cls.voxelSize)
+        cls.asymMbMaskFile = cls.getOutputPath('asymMbMask.mrc')
+        writeVolume(((np.abs(coords[0]) < 3) & (np.abs(coords[1]) < 6) & (coords[2] > 0)).astype(np.float32),
+                    cls.asymMbMaskFile, voxelSize=cls.voxelSize)
+        # Particles, being the first one in the reference orientation
+        cls.rots = np.concatenate([[0], rng.uniform(0, 360, cls.nParticles - 1)])
+        cls.tilts = np.concatenate([[0], rng.uniform(0, 180, cls.nParticles - 1)])
+        cls.psis = np.concatenate([[0], rng.uniform(0, 360, cls.nParticles - 1)])
+        cls.inFiles = []
+        for i in range(cls.nParticles):
+            inFile = join(cls.inDir, 'particle_%03d.mrc' % i)
+            writeVolume(rng.normal(size=(cls.boxSize,) * 3).astype(np.float32), inFile, voxelSize=cls.voxelSize)
+            cls.inFiles.append(inFile)
+        cls.inStar = cls.getOutputPath('particles.star')
+        with open(cls.inStar, 'w') as f:
+            f.write('\ndata_\n\nloop_\n_rlnMicrographName #1\n_rlnImageName #2\n_rlnAngleRot #3\n'
+                    '_rlnAngleTilt #4\n_rlnAnglePsi #5\n')
+            for inFile, rot, tilt, psi in zip(cls.inFiles, cls.rots, cls.tilts, cls.psis):
+                f.write('tomo.mrc %s %f %f %f\n' % (inFile, rot, tilt, psi))
+
+    def _runEngine(self, outName, mbMaskFile, angularStep=5):
+        outDir = self.getOutputPath(outName)
+        makePath(outDir)
+        outStar = self.getOutputPath(outName + '.star')
+        tStart = time.time()
+        runMbSuppression(self.inStar, outStar, outDir, self.maskFile, mbMaskFile, self.mbSupFactor,
+                         nThreads=self.nThreads, angularStep=angularStep)
+        return outDir, time.time() - tStart
+
+    def _getExpected(self, i, mbMaskFile):
+        """Expected output of a particle, rotating the membrane mask to it with the full Euler angles, independently
+        of the engine: the particle voxel at x takes the membrane mask value at Rz(rot) Ry(tilt) Rz(psi) x."""
+        mbMask = readVolume(mbMaskFile)
+        matrix = Rotation.from_euler('ZYZ', [self.rots[i], self.tilts[i], self.psis[i]], degrees=True).as_matrix()
+        center = (self.boxSize - 1) / 2
+        coords = np.indices(mbMask.shape).reshape(3, -1)[::-1] - center
+        rotMbMask = map_coordinates(mbMask, (matrix @ coords + center)[::-1], order=1, mode='constant', cval=0)
+        rotMbMask = rotMbMask.reshape(mbMask.shape)
+        weights = readVolume(self.maskFile) * (1 - (1 - self.mbSupFactor) * np.clip(rotMbMask, 0, 1))
+        return readVolume(self.inFiles[i]) * weights
+
+    def _checkOutput(self, outDir, mbMaskFile, tol=None):
+        """Compare a sample of the particles, including the reference orientation one, with their expected output.
+        If tol is given, the relative RMS error is checked instead of the voxel values."""
+        for i in [0] + list(np.random.default_rng(1).choice(np.arange(1, self.nParticles), 10, replace=False)):
+            output = readVolume(join(outDir, 'particle_%03d.mrc' % i))
+            expected = self._getExpected(i, mbMaskFile)
+            if tol is None or i == 0:
+                self.assertTrue(np.allclose(output, expected, atol=1e-4), 'Particle %i differs' % i)
+            else:
+                self.assertLess(np.linalg.norm(output - expected) / np.linalg.norm(expected), tol)
+
+    def testEngine(self):
+        print(magentaStr("\n==> Plugin membrane suppression engine:"))
+        outDir, elapsed = self._runEngine('plugin', self.mbMaskFile)
+        print('Plugin engine: %i particles in %.2f s' % (self.nParticles, elapsed))
+        # The slab is symmetric around the membrane normal, so only the rounding of tilt and psi matters
+        self._checkOutput(outDir, self.mbMaskFile, tol=ANGULAR_STEP_TOL)
+
+    def testEngineAsymmetricMask(self):
+        print(magentaStr("\n==> Plugin membrane suppression engine with a mask not symmetric around the normal:"))
+        outDir, _ = self._runEngine('plugin_asym_exact', self.asymMbMaskFile, angularStep=0)
+        self._checkOutput(outDir, self.asymMbMaskFile)
+        outDir, _ = self._runEngine('plugin_asym', self.asymMbMaskFile)
+        self._checkOutput(outDir, self.asymMbMaskFile, tol=ANGULAR_STEP_TOL)
+
+    def testBenchmarkVsPySeg(self):
+        print(magentaStr("\n==> Plugin membrane suppression engine vs pySeg script:"))
+        script = Plugin.getHome(POST_REC_SCRIPT_MEMB_ATT)
+        if not exists(script):
+            self.skipTest('pySeg is not installed')
+        pluginDir, pluginTime = self._runEngine('plugin_bench', self.mbMaskFile)
+
+        outDir = self.getOutputPath('pyseg')
+        makePath(outDir)
+        outStar = self.getOutputPath('pyseg.star')
+        cmd = '%s %s && %s %s ' % (Plugin.getCondaActivationCmd(), Plugin.getPysegEnvActivation(), PYTHON, script)
+        cmd += '--inStar %s --inMask %s --inMaskMbSup %s --mbSupFactor %s --doGaussLowPass False ' \
+               '--outDir %s --outStar %s -j %i' % (self.inStar, self.maskFile, self.mbMaskFile, self.mbSupFactor,
+                                                   outDir, outStar, self.nThreads)
+        tStart = time.time()
+        subprocess.check_call(cmd, shell=True, env=Plugin.getEnviron())
+        pysegTime = time.time() - tStart
+
+        print('%i particles of %i^3 voxels, %i threads:\n'
+              '\t- pySeg script: %.2f s\n'
+              '\t- Plugin engine: %.2f s\n'
+              '\t- Speedup: %.1fx' % (self.nParticles, self.boxSize, self.nThreads, pysegTime, pluginTime,
+                                      pysegTime / pluginTime))
+
+        # Both engines must produce the same particles, up to the interpolation and angle rounding
+        table = Table()
+        table.read(outStar)
+        pysegFiles = [row.get('rlnImageName') for row in table]
+        self.assertEqual(len(pysegFiles), self.nParticles)
+        for i, pysegFile in enumerate(pysegFiles):
+            pysegOutput = readVolume(pysegFile)
+            pluginOutput = readVolume(join(pluginDir, 'particle_%03d.mrc' % i))
+            self.assertLess(np.linalg.norm(pluginOutput - pysegOutput) / np.linalg.norm(pysegOutput),
+                            ANGULAR_STEP_TOL, 'Particle %i differs from the pySeg one' % i)
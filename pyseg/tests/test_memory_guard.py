@@ -0,0 +1,62 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+import subprocess
+import sys
+
+from pyworkflow.tests import BaseTest
+
+from pyseg.constants import MEMORY_ERROR_EXIT_STATUS
+from pyseg.engines import MEMORY_GUARD
+from pyseg.utils import isLimitExceeded
+
+MAX_MEMORY = 50 * 1024  # kB
+# Native program exceeding the limit: tail keeps the whole input in memory, as it contains no line breaks
+NATIVE_HOG = 'head -c %i /dev/zero | tail | wc -c' % (300 * 1024 ** 2)
+
+
+class TestMemoryGuard(BaseTest):
+    """Memory limit applied by the guard to the resident memory of a program and its children."""
+
+    @staticmethod
+    def _runGuarded(*program):
+        return subprocess.run([sys.executable, MEMORY_GUARD, str(MEMORY_ERROR_EXIT_STATUS), str(MAX_MEMORY)] +
+                              list(program), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+    def testNativeChildExceedingTheLimit(self):
+        returnCode = self._runGuarded('sh', '-c', NATIVE_HOG)
+        self.assertEqual(returnCode, MEMORY_ERROR_EXIT_STATUS)
+        self.assertTrue(isLimitExceeded(subprocess.CalledProcessError(returnCode, NATIVE_HOG)))
+
+    def testPythonExceedingTheLimit(self):
+        self.assertEqual(self._runGuarded(sys.executable, '-c', 'x = bytearray(%i); import time; time.sleep(5)'
+                                          % (200 * 1024 ** 2)), MEMORY_ERROR_EXIT_STATUS)
+
+    def testStatusWithinTheLimit(self):
+        self.assertEqual(self._runGuarded('sh', '-c', 'exit 0'), 0)
+        returnCode = self._runGuarded('sh', '-c', 'exit 3')
+        self.assertEqual(returnCode, 3)
+        self.assertFalse(isLimitExceeded(subprocess.CalledProcessError(returnCode, 'exit 3')))
+        # Killed by a signal
+        self.assertEqual(self._runGuarded('sh', '-c', 'kill -9 $$'), 128 + 9)
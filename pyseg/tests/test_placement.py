@@ -0,0 +1,122 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+import json
+import socket
+import subprocess
+import sys
+from types import SimpleNamespace
+
+from pyworkflow.object import Integer
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import cleanPath
+
+from pyseg import Plugin
+from pyseg.placement import CpuPlacer, parseCpuList, formatCpuList
+
+# Two NUMA nodes of 4 CPUs
+NUMA_NODES = [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+
+class TestCpuPlacement(BaseTest):
+    """CPU lists in the kernel format and allocation of the CPUs among the steps of several processes."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.allocationFile = cls.getOutputPath('cpu_allocation.json')
+
+    def setUp(self):
+        cleanPath(self.allocationFile)
+
+    def _newPlacer(self):
+        return CpuPlacer(cpus=range(8), numaNodes=NUMA_NODES, allocationFile=self.allocationFile)
+
+    def testParseCpuList(self):
+        self.assertEqual(parseCpuList('0-3,8-11\n'), [0, 1, 2, 3, 8, 9, 10, 11])
+        self.assertEqual(parseCpuList('5'), [5])
+        self.assertEqual(parseCpuList('0,2-3 7'), [0, 2, 3, 7])
+        self.assertEqual(parseCpuList(''), [])
+
+    def testFormatCpuList(self):
+        self.assertEqual(formatCpuList([11, 0, 1, 2, 3, 8, 10]), '0-3,8,10-11')
+        self.assertEqual(formatCpuList([5]), '5')
+        self.assertEqual(formatCpuList([]), '')
+        cpus = [0, 1, 4, 6, 7, 8]
+        self.assertEqual(parseCpuList(formatCpuList(cpus)), cpus)
+
+    def testAcquire(self):
+        placer = self._newPlacer()
+        # Taken from the NUMA node that better fits them
+        first = placer.acquire(3)
+        self.assertEqual(first, [0, 1, 2])
+        self.assertEqual(placer.acquire(4), [4, 5, 6, 7])
+        # Not enough free CPUs
+        self.assertIsNone(placer.acquire(2))
+        # Spread over the nodes with more free CPUs when none of them has enough
+        placer.release(first)
+        placer.release([4, 5, 6, 7])
+        self.assertEqual(placer.acquire(3), [0, 1, 2])
+        self.assertEqual(placer.acquire(2), [4, 5])
+        self.assertEqual(sorted(placer.acquire(3)), [3, 6, 7])
+
+    def testAcquireAcrossProcesses(self):
+        # Placers sharing only the allocation file, like the ones of different processes, do not get the same CPUs
+        cpus = self._newPlacer().acquire(4)
+        otherCpus = self._newPlacer().acquire(4)
+        self.assertFalse(set(cpus) & set(otherCpus))
+        self.assertIsNone(self._newPlacer().acquire(1))
+        # Once released, they are available for the others
+        self._newPlacer().release(cpus)
+        self.assertEqual(sorted(self._newPlacer().acquire(4)), sorted(cpus))
+
+    def testAllocationsOfFinishedProcesses(self):
+        # The CPUs reserved by a process that is no longer running are available again
+        finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+        finished.wait()
+        with open(self.allocationFile, 'w') as f:
+            json.dump([{'host': socket.gethostname(), 'pid': finished.pid, 'cpus': list(range(8))}], f)
+        self.assertEqual(self._newPlacer().acquire(8), list(range(8)))
+
+
+class TestThreadLimits(BaseTest):
+    """Steps of a protocol counted as running at the same time and threads given to the processes of each one."""
+
+    @staticmethod
+    def _newProtocol(nThreads, parallel, funcNames):
+        return SimpleNamespace(numberOfThreads=Integer(nThreads), modeParallel=lambda: parallel,
+                               _steps=[SimpleNamespace(funcName=funcName) for funcName in funcNames])
+
+    def testThreadLimits(self):
+        # Serial protocol: a single step at a time, sharing the threads among its jobs
+        self.assertEqual(Plugin.getThreadLimits(self._newProtocol(8, False, ['convert', 'run', 'run'])), (1, 8))
+        self.assertEqual(Plugin.getThreadLimits(self._newProtocol(8, False, ['run']), nJobs=3), (1, 2))
+        # Parallel protocol: as many steps as threads minus one, at most the steps of the same kind
+        funcNames = ['convert'] + ['run'] * 10 + ['output']
+        self.assertEqual(Plugin.getThreadLimits(self._newProtocol(8, True, funcNames)), (7, 1))
+        self.assertEqual(Plugin.getThreadLimits(self._newProtocol(8, True, ['convert', 'run', 'run', 'output'])),
+                         (2, 4))
+        # A sole step gets the whole budget
+        self.assertEqual(Plugin.getThreadLimits(self._newProtocol(8, True, ['convert', 'run', 'output']), nJobs=2),
+                         (1, 4))
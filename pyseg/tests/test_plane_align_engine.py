@@ -0,0 +1,92 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+from os.path import exists, join
+from unittest.mock import patch
+
+import numpy as np
+from emtable import Table
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import magentaStr, makePath
+
+from pyseg.engines.engine_io import writeStar, writeVolume
+from pyseg.engines import plane_align
+from pyseg.engines.plane_align import main, PARTICLES_STACK, MASKS_STACK, FEATURE_VECTORS, SWEEP_DIR, SWEEP_STAR, \
+    NO_CLASS_SIZES, KMEANS, AG, IMAGE_NAME
+
+
+class TestPlaneAlignEngine(BaseTest):
+    """Plugin clustering engine on a synthetic pySeg pre-processing output."""
+
+    nParticles = 30
+    boxSize = 16
+    nClustersList = [2, 3]
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        rng = np.random.default_rng(0)
+        # Particle files are only read for their voxel size, so all the rows refer to the same one
+        particleFile = cls.getOutputPath('particle.mrc')
+        writeVolume(np.zeros((cls.boxSize,) * 3, dtype=np.float32), particleFile)
+        cls.inStar = cls.getOutputPath('particles.star')
+        writeStar(cls.inStar, [IMAGE_NAME], [[particleFile] for _ in range(cls.nParticles)])
+        # Flattened particles, masks and feature vectors of three well separated groups
+        cls.cacheDir = cls.getOutputPath('cache')
+        makePath(cls.cacheDir)
+        groups = np.arange(cls.nParticles) % 3
+        particles = rng.normal(size=(cls.nParticles, cls.boxSize, cls.boxSize)) + groups[:, None, None] * 5
+        writeVolume(particles.astype(np.float32), join(cls.cacheDir, PARTICLES_STACK))
+        writeVolume(np.ones_like(particles, dtype=np.float32), join(cls.cacheDir, MASKS_STACK))
+        np.save(join(cls.cacheDir, FEATURE_VECTORS), particles.reshape(cls.nParticles, -1)[:, :10])
+
+    def _runSweep(self, outName, *args):
+        outDir = self.getOutputPath(outName)
+        main(['--inStar', self.inStar, '--cacheDir', self.cacheDir, '--outDir', outDir, '--clusteringAlg', KMEANS,
+              '--nClusters'] + [str(nClusters) for nClusters in self.nClustersList] + list(args))
+        return outDir, list(Table(fileName=join(outDir, SWEEP_STAR)))
+
+    def testSweep(self):
+        print(magentaStr("\n==> Plugin clustering engine sweeping the number of clusters:"))
+        outDir, rows = self._runSweep('sweep')
+        for i, (nClusters, row) in enumerate(zip(self.nClustersList, rows)):
+            self.assertEqual(int(row.nClasses), nClusters)
+            self.assertEqual(sum(int(size) for size in str(row.classSizes).split(',')), self.nParticles)
+            self.assertTrue(exists(join(outDir, SWEEP_DIR % (i + 1), 'class_gather.star')))
+
+    def testSweepAllClassesPurged(self):
+        print(magentaStr("\n==> Plugin clustering engine sweep with all the classes purged:"))
+        # The summary must still be readable, with a placeholder instead of the empty class sizes
+        _, rows = self._runSweep('sweep_purged', '--apPartSizeFilter', str(self.nParticles + 1))
+        self.assertEqual(len(rows), len(self.nClustersList))
+        for row in rows:
+            self.assertEqual(int(row.nClasses), 0)
+            self.assertEqual(str(row.classSizes), NO_CLASS_SIZES)
+
+    def testAgParticlesLimit(self):
+        print(magentaStr("\n==> Plugin clustering engine rejecting AG on too many particles:"))
+        with patch.object(plane_align, 'AG_MAX', self.nParticles - 1):
+            with self.assertRaises(ValueError):
+                main(['--inStar', self.inStar, '--cacheDir', self.cacheDir, '--outDir', self.getOutputPath('ag'),
+                      '--clusteringAlg', AG, '--nClusters', '3'])
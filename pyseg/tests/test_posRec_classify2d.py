@@ -24,23 +24,33 @@
 # **************************************************************************
 
 from collections import Counter
+from os.path import islink, exists, samefile, dirname, abspath
+
+import numpy as np
 from xmipp3.constants import MASK3D_CYLINDER
 from xmipp3.protocols import XmippProtCreateMask3D
 from xmipp3.protocols.protocol_preprocess.protocol_create_mask3d import SOURCE_GEOMETRY
 
 from pyseg.protocols import ProtPySegPostRecParticles
-from pyworkflow.tests import BaseTest, setupTestProject, DataSet
-from pyworkflow.utils import magentaStr
+from pyseg.protocols.protocol_post_rec_particles import MB_SUP_PLUGIN
+from pyworkflow.tests import setupTestProject, DataSet
+from pyworkflow.utils import magentaStr, cleanPath
 from reliontomo.protocols import ProtImportSubtomogramsFromStar
+from pyseg.tests.perf_gates import PerfBaseTest
+from pyseg.constants import PLANE_ALIGN_CACHE_DIR, POST_REC_OUT
+from pyseg.utils import getConversionCacheDir, getPosRecMask
+from pyseg.engines.plane_align import FEATURE_VECTORS
 from pyseg.protocols.protocol_2d_classification import AFFINITY_PROP, CC_WITHIN_MASK, AGGLOMERATIVE, KMEANS, \
-    ProtPySegPlaneAlignClassification
+    ProtPySegPlaneAlignClassification, CLASS_PLUGIN, CLASS_PYSEG
 from pyseg.protocols.protocol_2d_classification import outputObjects as cl2dOutputs
+from pyseg.protocols.protocol_assign_classes import ProtPySegAssignToClasses
+from pyseg.protocols.protocol_assign_classes import outputObjects as assignOutputs
 from reliontomo.protocols.protocol_import_subtomograms_from_star import outputObjects as importSubtomoOutputs
 from tomo.protocols import ProtImportTomograms
 from tomo.tests import EMD_10439, DataSetEmd10439
 
 
-class TestPostRecAndClassify2d(BaseTest):
+class TestPostRecAndClassify2d(PerfBaseTest):
 
     dataset = None
     samplingRate = 13.68
@@ -118,6 +128,55 @@ class TestPostRecAndClassify2d(BaseTest):
         self._runCheckPosRec(protPosRec)
         return protPosRec
 
+    def testPosRecRotRandOnlyMetadata(self):
+        print(magentaStr("\n==> Pos rec with rot angle randomization only in the metadata:"))
+        inSubtomos = getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name)
+        protPosRec = self.newProtocol(
+            ProtPySegPostRecParticles,
+            inputSubtomos=inSubtomos,
+            inMask=getattr(self.protCreateParticleMask, 'outputMask', None),
+            rotRandOnlyMetadata=True
+        )
+        protPosRec.setObjLabel('Pos rec only rot rand metadata')
+        protPosRec = self.launchProtocol(protPosRec)
+        self._runCheckPosRec(protPosRec)
+        # The files must be the same as the input ones, only the metadata changes
+        subtomoSet = getattr(protPosRec, cl2dOutputs.subtomograms.name)
+        rotChanges = []
+        for inSubtomo, outSubtomo in zip(inSubtomos, subtomoSet):
+            self.assertEqual(inSubtomo.getFileName(), outSubtomo.getFileName())
+            # Only the rot angle changes: the Relion transformation (the inverse of the Scipion one) of the output is
+            # the input one followed by a rotation around z, being the tilt, psi and shifts the same
+            inRelion = np.linalg.inv(ProtPySegPostRecParticles._getMatrix(inSubtomo))
+            outRelion = np.linalg.inv(ProtPySegPostRecParticles._getMatrix(outSubtomo))
+            zRot = inRelion[:3, :3].T @ outRelion[:3, :3]
+            self.assertTrue(np.allclose(zRot[2], [0, 0, 1], atol=1e-5))
+            self.assertTrue(np.allclose(zRot[:2, 2], [0, 0], atol=1e-5))
+            self.assertTrue(np.allclose(inRelion[:3, 3], outRelion[:3, 3], atol=1e-4))
+            rotChanges.append(np.degrees(np.arctan2(zRot[1, 0], zRot[0, 0])))
+        # Randomized rot angles
+        self.assertTrue(all(abs(change) > 1e-3 for change in rotChanges))
+        self.assertGreater(len({round(change, 3) for change in rotChanges}), 1)
+        # The mask is recorded in the output metadata and used by default by the 2D classification
+        posRecMask = getPosRecMask(subtomoSet)
+        self.assertTrue(posRecMask.endswith('.mrc'))
+        protCl2d = self.newProtocol(ProtPySegPlaneAlignClassification,
+                                    inputSubtomos=subtomoSet,
+                                    clusteringAlg=KMEANS,
+                                    filterSize=2,
+                                    aggNClusters=2,
+                                    pcaComps=3)
+        self.assertEqual(protCl2d.getMaskFileName(), posRecMask)
+        protCl2d.setObjLabel('cl2d - K-means - posrec mask')
+        self._runClProtAndCheckResults(protCl2d, 2)
+        # Without a recorded mask, it has to be introduced
+        protCl2dNoMask = self.newProtocol(ProtPySegPlaneAlignClassification,
+                                          inputSubtomos=inSubtomos,
+                                          clusteringAlg=KMEANS,
+                                          filterSize=2,
+                                          aggNClusters=2)
+        self.assertTrue(any('mask is required' in error for error in protCl2dNoMask.validate()))
+
     def testPosRecWithMbAttenuation(self):
         print(magentaStr("\n==> Pos rec with membrane attenuation:"))
         protPosRec = self.newProtocol(
@@ -132,6 +191,88 @@ class TestPostRecAndClassify2d(BaseTest):
         self._runCheckPosRec(protPosRec)
         return protPosRec
 
+    def testPosRecWithMbAttenuationPluginEngine(self):
+        print(magentaStr("\n==> Pos rec with membrane attenuation using the plugin engine:"))
+        protPosRec = self.newProtocol(
+            ProtPySegPostRecParticles,
+            inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+            inMask=getattr(self.protCreateParticleMask, 'outputMask', None),
+            mbMask=getattr(self.protCreateMembraneMask, 'outputMask', None),
+            mbSupFactor=0.3,
+            mbSupEngine=MB_SUP_PLUGIN
+        )
+        protPosRec.setObjLabel('Pos rec with membrane attenuation - plugin engine')
+        protPosRec = self.launchProtocol(protPosRec)
+        self._runCheckPosRec(protPosRec)
+        return protPosRec
+
+    def testPosRecWithMbAttenuationToStacks(self):
+        print(magentaStr("\n==> Pos rec with membrane attenuation writing the particles into stacks:"))
+        stackSize = 3
+        protPosRec = self.newProtocol(
+            ProtPySegPostRecParticles,
+            inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+            inMask=getattr(self.protCreateParticleMask, 'outputMask', None),
+            mbMask=getattr(self.protCreateMembraneMask, 'outputMask', None),
+            mbSupFactor=0.3,
+            mbSupEngine=MB_SUP_PLUGIN,
+            stackSize=stackSize
+        )
+        protPosRec.setObjLabel('Pos rec with membrane attenuation - stacks')
+        protPosRec = self.launchProtocol(protPosRec)
+        self._runCheckPosRec(protPosRec)
+        subtomoSet = getattr(protPosRec, cl2dOutputs.subtomograms.name)
+        locations = [subtomo.getLocation() for subtomo in subtomoSet]
+        self.assertEqual([index for index, _ in locations], [i % stackSize + 1 for i in range(self.nSubtomos)])
+        self.assertEqual(len({fileName for _, fileName in locations}), -(-self.nSubtomos // stackSize))
+        return protPosRec
+
+    def testPosRecChunks(self):
+        print(magentaStr("\n==> Pos rec splitting the particles into chunks:"))
+        chunkSize = 3
+        protPosRec = self.newProtocol(
+            ProtPySegPostRecParticles,
+            inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+            inMask=getattr(self.protCreateParticleMask, 'outputMask', None),
+            chunkSize=chunkSize,
+            numberOfThreads=3
+        )
+        # The steps are only executed in parallel when there are chunks
+        self.assertTrue(protPosRec.modeParallel())
+        protPosRec.setObjLabel('Pos rec chunks')
+        protPosRec = self.launchProtocol(protPosRec)
+        self._runCheckPosRec(protPosRec)
+        # Each chunk is written into its own directory
+        subtomoSet = getattr(protPosRec, cl2dOutputs.subtomograms.name)
+        chunkDirs = {dirname(abspath(subtomo.getFileName())) for subtomo in subtomoSet}
+        self.assertEqual(len(chunkDirs), -(-self.nSubtomos // chunkSize))
+        self.assertEqual({dirname(chunkDir) for chunkDir in chunkDirs}, {abspath(protPosRec._getExtraPath(POST_REC_OUT))})
+        protPosRec.chunkSize.set(0)
+        self.assertFalse(protPosRec.modeParallel())
+
+    def testPosRecConversionCache(self):
+        print(magentaStr("\n==> Pos rec runs sharing the converted input star file:"))
+        inStars = []
+        for i in range(3):
+            if i == 2:
+                # Cleaning the project Tmp directory removes the conversion cache, but not the runs input star files
+                cleanPath(getConversionCacheDir())
+                self.assertTrue(all(exists(inStar) for inStar in inStars))
+            protPosRec = self.newProtocol(
+                ProtPySegPostRecParticles,
+                inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+                inMask=getattr(self.protCreateParticleMask, 'outputMask', None),
+            )
+            protPosRec.setObjLabel('Pos rec conversion cache %i' % (i + 1))
+            protPosRec = self.launchProtocol(protPosRec)
+            self._runCheckPosRec(protPosRec)
+            inStars.append(protPosRec._getExtraPath(protPosRec.inStarName))
+        # The first two runs hard link the same star file, generated only by the first one, while the last one
+        # generates it again
+        self.assertFalse(any(islink(inStar) for inStar in inStars))
+        self.assertTrue(samefile(inStars[0], inStars[1]))
+        self.assertFalse(samefile(inStars[0], inStars[2]))
+
     def _runCheckPosRec(self, protPosRec):
         subtomoSet = getattr(protPosRec, cl2dOutputs.subtomograms.name)
         self.assertSetSize(subtomoSet, size=self.nSubtomos)
@@ -167,6 +308,87 @@ class TestPostRecAndClassify2d(BaseTest):
         protCl2d.setObjLabel('cl2d - K-means')
         self._runClProtAndCheckResults(protCl2d, nClasses)
 
+    def testClassify2dPluginEngineReusingResults(self):
+        print(magentaStr("\n==> 2D classification with the plugin engine reusing the previous results:"))
+        nClasses = 3
+        protCl2d = self._genCl2dProtAggOrKmeans(AGGLOMERATIVE, nClasses)
+        protCl2d.classEngine.set(CLASS_PLUGIN)
+        protCl2d.setObjLabel('cl2d - AG - plugin')
+        self._runClProtAndCheckResults(protCl2d, nClasses)
+
+        nClasses = 4
+        protCl2dReuse = self._genCl2dProtAggOrKmeans(KMEANS, nClasses)
+        protCl2dReuse.classEngine.set(CLASS_PLUGIN)
+        protCl2dReuse.prevClassProt.set(protCl2d)
+        protCl2dReuse.setObjLabel('cl2d - K-means - plugin reusing AG')
+        self._runClProtAndCheckResults(protCl2dReuse, nClasses)
+        # pySeg was not run again, so its feature vectors are still linked to the ones of the previous run
+        self.assertTrue(islink(protCl2dReuse._getExtraPath(PLANE_ALIGN_CACHE_DIR, FEATURE_VECTORS)))
+
+    def testClassify2dPluginEngineSweep(self):
+        print(magentaStr("\n==> 2D classification with the plugin engine sweeping the number of clusters:"))
+        nClassesList = [2, 3, 4]
+        protCl2d = self._genCl2dProtAggOrKmeans(KMEANS, ' '.join(str(nClasses) for nClasses in nClassesList))
+        protCl2d.classEngine.set(CLASS_PLUGIN)
+        protCl2d.setObjLabel('cl2d - K-means - plugin sweep')
+        protCl2d = self.launchProtocol(protCl2d)
+        for i, nClasses in enumerate(nClassesList):
+            outputClasses = getattr(protCl2d, '%s_%i' % (cl2dOutputs.classes.name, i + 1))
+            self.assertSetSize(outputClasses, nClasses)
+
+    def testClassify2dPluginEngineSparseAP(self):
+        print(magentaStr("\n==> 2D classification with the plugin engine and AP on the nearest neighbours:"))
+        protCl2d = self.newProtocol(
+            ProtPySegPlaneAlignClassification,
+            inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+            inMask=getattr(self.protCreateParticleMask, 'outputMask', None),
+            classEngine=CLASS_PLUGIN,
+            clusteringAlg=AFFINITY_PROP,
+            filterSize=2,
+            ccMetric=CC_WITHIN_MASK,
+            apKnn=5,
+            apPartSizeFilter=self.minNumberOfParticles
+        )
+        protCl2d.setObjLabel('cl2d - AP - plugin knn')
+        protCl2d = self.launchProtocol(protCl2d)
+        outputClasses = getattr(protCl2d, cl2dOutputs.classes.name)
+        self.assertGreater(outputClasses.getSize(), 0)
+        for cl in outputClasses:
+            self.assertGreaterEqual(cl.getSize(), self.minNumberOfParticles)
+
+    def testAssignToClasses(self):
+        print(magentaStr("\n==> Assignment of particles to the classes of a previous 2D classification:"))
+        nClasses = 3
+        protCl2d = self._genCl2dProtAggOrKmeans(KMEANS, nClasses)
+        protCl2d.classEngine.set(CLASS_PLUGIN)
+        protCl2d.setObjLabel('cl2d - K-means - plugin to assign')
+        protCl2d = self.launchProtocol(protCl2d)
+
+        protAssign = self.newProtocol(
+            ProtPySegAssignToClasses,
+            inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+            classificationProt=protCl2d)
+        protAssign = self.launchProtocol(protAssign)
+        # The classified particles are assigned to the same classes they belong to
+        outSubtomoSet = getattr(protAssign, assignOutputs.subtomograms.name)
+        self.assertSetSize(outSubtomoSet, self.nSubtomos)
+        self.assertSetSize(getattr(protAssign, assignOutputs.classes.name), nClasses)
+        classifiedSubtomos = getattr(protCl2d, cl2dOutputs.subtomograms.name)
+        self.assertEqual(self._getClassIdList(outSubtomoSet), self._getClassIdList(classifiedSubtomos))
+
+        # The representatives of the classifications carried out with the pySeg script are valid references too, as
+        # the particles are flattened by pySeg in both cases
+        protCl2dPyseg = self._genCl2dProtAggOrKmeans(KMEANS, nClasses)
+        protCl2dPyseg.classEngine.set(CLASS_PYSEG)
+        protCl2dPyseg.setObjLabel('cl2d - K-means - pySeg to assign')
+        protCl2dPyseg = self.launchProtocol(protCl2dPyseg)
+        protAssignPyseg = self.newProtocol(
+            ProtPySegAssignToClasses,
+            inputSubtomos=getattr(self.protImporSubtomogramsFromStar, importSubtomoOutputs.subtomograms.name),
+            classificationProt=protCl2dPyseg)
+        protAssignPyseg = self.launchProtocol(protAssignPyseg)
+        self.assertSetSize(getattr(protAssignPyseg, assignOutputs.subtomograms.name), self.nSubtomos)
+
     # Agglomerative and k-means clustering algorithms share parameters
     def _genCl2dProtAggOrKmeans(self, clusteringAlg, nClasses):
         return self.newProtocol(
@@ -24,21 +24,31 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import time
 from glob import glob
-from os.path import exists
+from os.path import exists, join, basename
+
+from emtable import Table
 from imod.protocols import ProtImodTomoNormalization
-from pyseg.protocols import ProtPySegGraphs, ProtPySegFils
+from pyseg.protocols import ProtPySegGraphs, ProtPySegFils, ProtPySegVesiclePipeline
 from pyseg.protocols.protocol_picking import PROJECTIONS, ProtPySegPicking
 from pyseg.protocols.protocol_picking import outputObjects as pickingOutputs
 from pyseg.protocols.protocol_pre_seg import outputObjects as presegOutputs, ProtPySegPreSegParticles
-from pyworkflow.tests import BaseTest, setupTestProject, DataSet
-from pyworkflow.utils import magentaStr
+from pyworkflow.tests import setupTestProject, DataSet
+from pyworkflow.object import Set
+from pyworkflow.utils import magentaStr, createLink, removeExt
+from pyseg.tests.perf_gates import PerfBaseTest
 from pyseg.constants import FROM_SCIPION, MEMBRANE_OUTER_SURROUNDINGS, MEMBRANE, OUT_STARS_DIR, FILS_FILES
+from tomo.objects import SetOfTomoMasks
 from tomo.protocols import ProtImportTomograms, ProtImportTomomasks
 from tomo.tests import EMD_10439, DataSetEmd10439
 
+# Seconds to wait for the preseg run in streaming and between consecutive checks of it
+STREAMING_TIMEOUT = 1800
+STREAMING_SLEEP = 10
+
 
-class TestFromPresegToPicking(BaseTest):
+class TestFromPresegToPicking(PerfBaseTest):
 
     outputPath = None
     ds = None
@@ -49,6 +59,7 @@ class TestFromPresegToPicking(BaseTest):
     inTomoSet = None
     inTomoSetBinned = None
     inTomomaskSetBinned = None
+    protImportTomomasks = None
     protPreseg = None
     ProtGraphs = None
     ProtFils = None
@@ -101,7 +112,7 @@ class TestFromPresegToPicking(BaseTest):
                                               filesPath=cls.ds.getFile(DataSetEmd10439.tomoMaskAnnotated.value),
                                               inputTomos=cls.inTomoSetBinned)
 
-        cls.launchProtocol(protImportTomomasks)
+        cls.protImportTomomasks = cls.launchProtocol(protImportTomomasks)
         tomoMaskSet = getattr(protImportTomomasks, 'outputTomoMasks', None)
         cls.assertIsNotNone(tomoMaskSet, 'No tomograms were genetated.')
 
@@ -154,6 +165,96 @@ class TestFromPresegToPicking(BaseTest):
             self.assertTrue(vesicleMask.getDimensions() in vesicleSizeList)
         return protPreseg
 
+    def testPresegStreaming(self):
+        print(magentaStr("\n==> Running preSeg in streaming:"))
+        # Open set of tomomasks fed in two batches: the annotated tomomask and a copy of it referred to a link to its
+        # tomogram with another name, so its vesicles are named differently
+        tomoMask = self.inTomomaskSetBinned.getFirstItem()
+        tomoMaskCopy = self._copyTomoMask(tomoMask, 'batch2_')
+        inTomoMasks = self._createStreamingTomoMasks(tomoMask.clone())
+        protPreseg = self.newProtocol(
+            ProtPySegPreSegParticles,
+            segmentationFrom=FROM_SCIPION,
+            inTomoMasks=inTomoMasks,
+            spOffVoxels=22,
+            sgMembThk=60,
+            sgMembNeigh=330
+        )
+        protPreseg.setObjLabel('Preseg streaming')
+        self.proj.launchProtocol(protPreseg)
+
+        # First batch: the outputs are generated, but kept open while the input is open
+        protPreseg = self._waitForVesicles(protPreseg, self.nVesicles)
+        self._checkPresegStreamingOutputs(protPreseg, self.nVesicles, streamClosed=False)
+
+        # Second batch: the outputs grow
+        inTomoMasks.enableAppend()
+        inTomoMasks.append(tomoMaskCopy)
+        inTomoMasks.write()
+        protPreseg = self._waitForVesicles(protPreseg, 2 * self.nVesicles)
+
+        # Closing the input closes the outputs
+        inTomoMasks.setStreamState(Set.STREAM_CLOSED)
+        inTomoMasks.write()
+        inTomoMasks.close()
+        tStart = time.time()
+        while protPreseg.isActive() and time.time() - tStart < STREAMING_TIMEOUT:
+            time.sleep(STREAMING_SLEEP)
+            self.proj._updateProtocol(protPreseg)
+        self.assertTrue(protPreseg.isFinished())
+        self._checkPresegStreamingOutputs(protPreseg, 2 * self.nVesicles, streamClosed=True)
+
+    def _copyTomoMask(self, tomoMask, prefix):
+        """Copy of a tomomask, linking its file and annotated materials, referred to a link to its tomogram. The links
+        are named with the given prefix."""
+        copyDir = self.protImportTomomasks._getExtraPath()
+        maskFile = tomoMask.getFileName()
+        maskCopy = join(copyDir, prefix + basename(maskFile))
+        createLink(maskFile, maskCopy)
+        createLink(removeExt(maskFile) + '.txt', removeExt(maskCopy) + '.txt')
+        tomoCopy = join(copyDir, prefix + basename(tomoMask.getVolName()))
+        createLink(tomoMask.getVolName(), tomoCopy)
+        tomoMaskCopy = tomoMask.clone()
+        tomoMaskCopy.setObjId(None)
+        tomoMaskCopy.setFileName(maskCopy)
+        tomoMaskCopy.setVolName(tomoCopy)
+        return tomoMaskCopy
+
+    def _createStreamingTomoMasks(self, tomoMask):
+        """Open set of tomomasks with the given one, registered as an output of the tomomasks import, with the same
+        source relation, so it can be fed while the preseg processes it."""
+        protImport = self.proj.getProtocol(self.protImportTomomasks.getObjId())
+        streamSet = SetOfTomoMasks.create(protImport._getPath(), template='tomomasks%s.sqlite', suffix='streaming')
+        streamSet.copyInfo(self.inTomomaskSetBinned)
+        streamSet.setStreamState(Set.STREAM_OPEN)
+        streamSet.append(tomoMask)
+        streamSet.write()
+        protImport._defineOutputs(outputTomoMasksStreaming=streamSet)
+        protImport._defineSourceRelation(protImport.inputTomos, streamSet)
+        self.proj._storeProtocol(protImport)
+        return streamSet
+
+    def _waitForVesicles(self, protPreseg, nVesicles):
+        tStart = time.time()
+        while time.time() - tStart < STREAMING_TIMEOUT:
+            self.proj._updateProtocol(protPreseg)
+            self.assertFalse(protPreseg.isFailed(), 'Preseg in streaming failed')
+            vesicles = getattr(protPreseg, presegOutputs.vesicles.name, None)
+            if vesicles is not None and vesicles.getSize() >= nVesicles:
+                return protPreseg
+            time.sleep(STREAMING_SLEEP)
+        self.fail('Timeout waiting for %i vesicles' % nVesicles)
+
+    def _checkPresegStreamingOutputs(self, protPreseg, nVesicles, streamClosed):
+        # The star file read by the graphs protocol contains the vesicles of all the processed batches
+        outTable = Table()
+        outTable.read(protPreseg._getExtraPath('presegVesiclesCentered_pre.star'))
+        self.assertEqual(len(outTable), nVesicles)
+        for outputName in [presegOutputs.vesicles.name, presegOutputs.segmentations.name]:
+            outSet = getattr(protPreseg, outputName)
+            self.assertSetSize(outSet, nVesicles)
+            self.assertEqual(outSet.isStreamClosed(), streamClosed)
+
     @classmethod
     def _runGraphs(cls):
         print(magentaStr("\n==> Running graphs:"))
@@ -253,4 +354,29 @@ class TestFromPresegToPicking(BaseTest):
         for coord3d in outputCoordinates:
             self.assertTrue(int(coord3d.getGroupId()) in testVesicleInd)
 
+    def testVesiclePipeline(self):
+        print(magentaStr("\n==> Running the vesicle pipeline:"))
+        protPipeline = self.newProtocol(
+            ProtPySegVesiclePipeline,
+            inSegProt=self.protPreseg,
+            maxLen=330,
+            segLabelS=MEMBRANE,
+            segLabelT=MEMBRANE_OUTER_SURROUNDINGS,
+            maxEucDistT=30,
+            maxGeoLenT=60,
+            maxSinuT=2,
+            gRgEud='1 30',
+            gRgLen='1 60',
+            gRgSin='0 2',
+            side=MEMBRANE_OUTER_SURROUNDINGS,
+            cont=PROJECTIONS,
+            numberOfThreads=1 + self.nVesicles
+        )
+        protPipeline.setObjLabel('Vesicle pipeline')
+        protPipeline = self.launchProtocol(protPipeline)
 
+        # Same results as the graphs, fils and picking protocols executed one after the other
+        for i in range(self.nVesicles):
+            self.assertTrue(exists(protPipeline._getExtraPath(OUT_STARS_DIR, 'picking_%03d_parts.star' % (i + 1))))
+        outputCoordinates = getattr(protPipeline, pickingOutputs.coordinates.name)
+        self.assertSetSize(outputCoordinates, getattr(self.ProtPicking, pickingOutputs.coordinates.name).getSize())
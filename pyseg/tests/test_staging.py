@@ -0,0 +1,68 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+from os.path import join, samefile, dirname
+
+from emtable import Table
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import makePath
+
+from pyseg.constants import TOMOGRAM, VESICLE, SEGMENTATION
+from pyseg.staging import ScratchStaging
+
+
+class TestScratchStaging(BaseTest):
+    """Inputs of a pySeg script staged into the scratch."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testStageStarFile(self):
+        inDir = self.getOutputPath('in')
+        makePath(inDir)
+        files = {label: join(inDir, '%s.mrc' % label) for label in (TOMOGRAM, VESICLE, SEGMENTATION)}
+        for fileName in files.values():
+            with open(fileName, 'w') as f:
+                f.write(fileName)
+        inStar = join(inDir, 'vesicles.star')
+        table = Table(columns=list(files))
+        table.addRow(*files.values())
+        table.write(inStar)
+
+        outDir = self.getOutputPath('out')
+        staging = ScratchStaging(self.getOutputPath('scratch'), outDir, keep=['*.star'])
+        try:
+            args = staging.start('--inStar %s --outDir %s' % (inStar, outDir))
+            stagedStar = args.split(' ')[1]
+            self.assertEqual(dirname(dirname(stagedStar)), staging.scratchIn)
+            row = next(iter(Table(fileName=stagedStar)))
+            # The tomogram is left in place, while the files read by the scripts are staged
+            self.assertEqual(row.get(TOMOGRAM), files[TOMOGRAM])
+            for label in (VESICLE, SEGMENTATION):
+                self.assertNotEqual(row.get(label), files[label])
+                self.assertTrue(row.get(label).startswith(staging.scratchIn))
+                self.assertTrue(samefile(row.get(label), files[label]))
+        finally:
+            staging.clean()
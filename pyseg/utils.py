@@ -25,13 +25,23 @@
 # *
 # **************************************************************************
 import glob
-from os.path import abspath, join, basename
+import hashlib
+import json
+import os
+import shutil
+from subprocess import CalledProcessError
+from os.path import abspath, join, basename, getsize, exists, islink, dirname
 import numpy as np
+import pwem
 from pwem.convert import transformations
 from pwem.emlib.image import ImageHandler
-from pyseg.constants import IN_STARS_DIR, OUT_STARS_DIR
+from emtable import Table
+from pyseg.constants import IN_STARS_DIR, OUT_STARS_DIR, MEMBRANE, VESICLE, NOT_FOUND, RETRY_SSIG_FACTOR, \
+    RETRY_VDEN_FACTOR, CONVERSION_CACHE_DIR, MASKS_CACHE_DIR, GRAPHS_COST_MODEL_FILE, LIMIT_EXIT_STATUSES
+from pyworkflow.object import String
+from pyworkflow.project.project import PROJECT_TMP
+from pyworkflow.protocol import IntParam, FloatParam, GE, LEVEL_ADVANCED
 from pyworkflow.utils import replaceExt, getExt, makePath, createLink
-from reliontomo.constants import SHIFTX, SHIFTY, SHIFTZ, TILT, PSI, ROT
 
 COMP_EXT_MASK_LIST = ['.mrc', '.em', '.rec']
 
@@ -50,9 +60,57 @@ def getFinalMaskFileName(inMask):
 
 
 def checkMaskFormat(inMask):
+    """Convert the mask into a format readable by pySeg if necessary. The converted masks are stored in the conversion
+    cache, indexed by the hash of the input mask file, so each mask is converted only once and linked afterwards."""
     if getExt(inMask.getFileName()) not in COMP_EXT_MASK_LIST:
-        ih = ImageHandler()
-        ih.convert(inMask.getFileName(), getFinalMaskFileName(inMask))
+        cachedMask = getConversionCacheDir(MASKS_CACHE_DIR, getFileHash(inMask.getFileName()) + '.mrc')
+        if not exists(cachedMask):
+            makePath(dirname(cachedMask))
+            # Converted with a temporary name, so a concurrent run never links a partially written mask
+            tmpMask = replaceExt(cachedMask, '%i.mrc' % os.getpid())
+            ImageHandler().convert(inMask.getFileName(), tmpMask)
+            os.replace(tmpMask, cachedMask)
+        linkCachedFile(cachedMask, getFinalMaskFileName(inMask))
+
+
+def setPosRecMask(subtomoSet, inMask):
+    """Record the mask of a posrec run that did not apply it to the particles (rot angle randomized only in the
+    metadata) in its output subtomograms, so the 2D classification uses it by default."""
+    checkMaskFormat(inMask)
+    subtomoSet._posRecMask = String(getFinalMaskFileName(inMask))
+
+
+def getPosRecMask(subtomoSet):
+    """Mask recorded in the subtomograms by setPosRecMask, None if there is no one."""
+    posRecMask = getattr(subtomoSet, '_posRecMask', None)
+    return posRecMask.get() if posRecMask is not None and posRecMask.get() else None
+
+
+def getConversionCacheDir(*paths):
+    """Path of the conversion cache, relative to the project directory, which is the protocols working directory."""
+    return join(PROJECT_TMP, CONVERSION_CACHE_DIR, *paths)
+
+
+def linkCachedFile(cachedFile, linkFile):
+    """Hard link a file of the conversion cache to linkFile, so it is kept when the project Tmp directory, where the
+    cache is, is cleaned. If it can't be hard linked, e. g. because it is in another file system, it is copied. The
+    symbolic links of previous versions, which may be dangling, are replaced."""
+    if exists(linkFile) and not islink(linkFile) and os.path.samefile(cachedFile, linkFile):
+        return
+    if os.path.lexists(linkFile):
+        os.remove(linkFile)
+    try:
+        os.link(cachedFile, linkFile)
+    except OSError:
+        shutil.copy(cachedFile, linkFile)
+
+
+def getFileHash(fileName, blockSize=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 
 def createStarDirectories(extraPath):
@@ -82,6 +140,136 @@ def genOutSplitStarFileName(outDir, starFile):
     return join(outDir, basename(starFile))
 
 
+def getStarFileCost(starFile):
+    """Estimate the processing cost of the vesicles contained in a star file as the size of the pickle files they refer
+    to (graphs or filament networks), which grows with their number of vertices and edges."""
+    vesTable = Table()
+    vesTable.read(starFile)
+    colNames = vesTable.getColumnNames()
+    cost = 0
+    for row in vesTable:
+        for colName in colNames:
+            value = row.get(colName)
+            if isinstance(value, str) and value.endswith('.pkl') and exists(value):
+                cost += getsize(value)
+    return cost
+
+
+def sortStarFilesByCost(starFiles):
+    """Sort the star files from the most to the least expensive to be processed, so when they are processed in
+    parallel the biggest vesicles do not remain at the end of the execution as a long tail."""
+    return sorted(starFiles, key=getStarFileCost, reverse=True)
+
+
+def addStragglerControlParams(form, withRetries=False):
+    """Add the parameters to limit the execution time and the memory used per vesicle, so the pathological
+    vesicles do not block the whole protocol"""
+    group = form.addGroup('Straggler control', expertLevel=LEVEL_ADVANCED)
+    group.addParam('vesicleTimeout', IntParam,
+                   label='Max. execution time per vesicle (min)',
+                   default=0,
+                   validators=[GE(0)],
+                   expertLevel=LEVEL_ADVANCED,
+                   help='Vesicles exceeding this time will be killed%s and quarantined, so the rest of the dataset '
+                        'can be processed. If 0, no limit will be applied.'
+                        % (' and retried with coarser parameters' if withRetries else ''))
+    group.addParam('vesicleMaxMem', FloatParam,
+                   label='Max. memory per vesicle (GB)',
+                   default=0,
+                   validators=[GE(0)],
+                   expertLevel=LEVEL_ADVANCED,
+                   help='Vesicles exceeding this memory will be killed%s and quarantined, so the rest of the dataset '
+                        'can be processed. If 0, no limit will be applied.'
+                        % (' and retried with coarser parameters' if withRetries else ''))
+    if withRetries:
+        group.addParam('nRetries', IntParam,
+                       label='Retries with coarser parameters',
+                       default=1,
+                       validators=[GE(0)],
+                       condition='vesicleTimeout > 0 or vesicleMaxMem > 0',
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Number of times a vesicle exceeding the limits will be processed again before being '
+                            'quarantined. In each retry, the sigma for gaussian filtering is multiplied by %s and the '
+                            'vertex density by %s.' % (RETRY_SSIG_FACTOR, RETRY_VDEN_FACTOR))
+
+
+def isStragglerControlEnabled(prot):
+    return bool(prot.vesicleTimeout.get() or prot.vesicleMaxMem.get())
+
+
+def getStragglerLimits(prot, nVesicles=1, nThreads=1):
+    """Get the limits to be passed to Plugin.runPySeg for a package of nVesicles processed with nThreads."""
+    return {'timeout': prot.vesicleTimeout.get() * 60 * -(-nVesicles // nThreads),
+            'maxMemory': prot.vesicleMaxMem.get()}
+
+
+def isLimitExceeded(error):
+    """Tell if a failed pySeg run was killed because of the straggler limits (see Plugin.runPySeg), so any other
+    error (wrong paths, script errors, bad parameters...) is not mistaken for a straggler."""
+    if isinstance(error, MemoryError):
+        return True
+    return isinstance(error, CalledProcessError) and error.returncode in LIMIT_EXIT_STATUSES
+
+
+def quarantineVesicles(starFile, quarantineFile):
+    """Register in the quarantine file the vesicles contained in the given star file."""
+    vesTable = Table()
+    vesTable.read(starFile)
+    with open(quarantineFile, 'a') as f:
+        for row in vesTable:
+            f.write('%s\n' % row.get(VESICLE, NOT_FOUND))
+
+
+def getQuarantinedVesicles(quarantineFile):
+    try:
+        with open(quarantineFile) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return []
+
+
+def registerRetriedVesicles(starFile, retriedFile, sSig, vDen):
+    """Register in the retried file the vesicles contained in the given star file, processed with the given
+    coarser parameters."""
+    vesTable = Table()
+    vesTable.read(starFile)
+    with open(retriedFile, 'a') as f:
+        for row in vesTable:
+            f.write('%s %s %s\n' % (row.get(VESICLE, NOT_FOUND), sSig, vDen))
+
+
+def getRetriedVesicles(retriedFile):
+    """Get a list of tuples (vesicle, sSig, vDen) with the vesicles processed with coarser parameters. If a vesicle
+    was registered several times (e. g. when continuing the protocol), the last registration is kept."""
+    retried = {}
+    try:
+        with open(retriedFile) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3:
+                    retried[fields[0]] = (fields[0], float(fields[1]), float(fields[2]))
+    except FileNotFoundError:
+        pass
+    return list(retried.values())
+
+
+def randomizeRotAngles(matrices, seed=None):
+    """Randomize the rot angle (Relion convention) of a stack of Scipion transformation matrices of shape (n, 4, 4).
+    Scipion matrices are the inverse of the Relion ones, so a random rotation around the z axis applied after the
+    rot angle in Relion is applied before the whole matrix in Scipion. All the matrices are processed at once."""
+    nMatrices = len(matrices)
+    angles = np.random.default_rng(seed).uniform(0, 2 * np.pi, nMatrices)
+    cosAngles, sinAngles = np.cos(angles), np.sin(angles)
+    rotZ = np.zeros((nMatrices, 4, 4))
+    rotZ[:, 0, 0] = cosAngles
+    rotZ[:, 0, 1] = -sinAngles
+    rotZ[:, 1, 0] = sinAngles
+    rotZ[:, 1, 1] = cosAngles
+    rotZ[:, 2, 2] = 1
+    rotZ[:, 3, 3] = 1
+    return np.matmul(rotZ, matrices)
+
+
 # TODO: remove this once reliontomo3 is deprecated and import this method from reliontomo4 utils
 def manageDims(fileName, z, n):
     if fileName.endswith('.mrc') or fileName.endswith('.map'):
@@ -95,5 +283,144 @@ def manageDims(fileName, z, n):
     return zDim
 
 
+# Graphs cost model. The reference coefficients are coarse single core values for mb_graph_mp.py, used until the model
+# is fitted on profiling runs of the target hardware with the benchmark (python -m pyseg.benchmark --calibrateGraphs),
+# which stores the fitted coefficients and their provenance in the EM root
+REFERENCE_GRAPHS_COST_COEFS = {
+    'secPerVoxel': 2e-6,  # Gaussian filtering and DisPerSE Morse complex computation
+    'secPerGraphElement': 4e-5,  # Graph construction, simplification and property measurement
+    'baseBytes': 500 * 1024 ** 2,  # Python interpreter and pyseg imports
+    'bytesPerVoxel': 48,  # Input, filtered, seg and distance arrays plus DisPerSE buffers
+    'bytesPerGraphElement': 700,  # Graph-tool and python objects of the vertices and edges
+    'diskBytesPerVoxel': 4,  # Output vti
+    'diskBytesPerGraphElement': 350,  # Output pickle and vtp files
+    'disperseDiskBytesPerVoxel': 60  # DisPerSE intermediate files
+}
+# Cost model terms used to fit each measured quantity
+GRAPHS_COST_FIT_TERMS = {
+    'time': ['secPerVoxel', 'secPerGraphElement'],
+    'memory': ['baseBytes', 'bytesPerVoxel', 'bytesPerGraphElement'],
+    'disk': ['diskBytesPerVoxel', 'diskBytesPerGraphElement'],
+    'disperseDisk': ['disperseDiskBytesPerVoxel']
+}
+
+
+def getGraphsCostModelFile():
+    return join(pwem.Config.EM_ROOT, GRAPHS_COST_MODEL_FILE)
+
+
+def getGraphsCostModel():
+    """Get the graphs cost model fitted on this site, stored by the benchmark calibration, or the reference one if it
+    has not been fitted. It is a dict with the coefficients and their provenance."""
+    try:
+        with open(getGraphsCostModelFile()) as f:
+            model = json.load(f)
+        if set(model['coefficients']) == set(REFERENCE_GRAPHS_COST_COEFS):
+            return model
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {'coefficients': dict(REFERENCE_GRAPHS_COST_COEFS), 'provenance': None}
+
+
+def describeGraphsCostModel(model):
+    provenance = model.get('provenance')
+    if not provenance:
+        return 'reference coefficients, not fitted on this hardware (see the benchmark calibration)'
+    return 'fitted on %i runs of %i vesicles on %s (%s, pySeg %s, R² time %.2f, memory %.2f)' % \
+        (provenance['nRuns'], provenance['nVesicles'], provenance['host'], provenance['date'],
+         provenance['pysegVersion'], provenance['r2']['time'], provenance['r2']['memory'])
+
+
+def getVesicleCostFeatures(segFile):
+    """Read a vesicle segmentation generated by the preseg protocol and return a tuple with the number of voxels of
+    the whole subvolume, the number of membrane voxels and the number of voxels of the membrane surroundings."""
+    data = ImageHandler().read(segFile).getData()
+    mbLabel = encodePresegArea(MEMBRANE)
+    nMbVoxels = int(np.count_nonzero(data == mbLabel))
+    nSurrVoxels = int(np.count_nonzero(data > mbLabel))
+    return int(data.size), nMbVoxels, nSurrVoxels
+
+
+def getVesicleCostTerms(nVoxels, nMbVoxels, nSurrVoxels, pixSize, sSig, vDen, vRatio, maxLen, mbNeigh):
+    """Get the terms of the graphs cost model for a vesicle: the number of voxels, the number of critical points and
+    the number of graph elements (vertices and edges). Sizes pixSize, maxLen and mbNeigh are expected in nm.
+    The model considers that:
+        - DisPerSE generates roughly one critical point per smoothing volume (sSig³) before the simplification.
+        - After the simplification, the number of vertices is vDen times the analyzed volume in nm³, being this volume
+          the membrane plus the fraction of the surroundings closer than maxLen, and the number of edges is vRatio
+          times the number of vertices.
+    """
+    surrFraction = min(1., maxLen / mbNeigh) if mbNeigh > 0 else 1.
+    nRegionVoxels = nMbVoxels + surrFraction * nSurrVoxels
+    nCritPoints = nRegionVoxels / max(sSig, 0.5) ** 3
+    nVertices = vDen * nRegionVoxels * pixSize ** 3
+    return nVoxels, nCritPoints, nVertices * (1 + vRatio)
+
+
+def estimateVesicleGraphCost(nVoxels, nMbVoxels, nSurrVoxels, pixSize, sSig, vDen, vRatio, maxLen, mbNeigh,
+                             coefs=None):
+    """Estimate the execution time (s), the peak memory (bytes), the disk usage (bytes) and the disk used by the
+    DisPerSE intermediate files (bytes) of the graph generation for a vesicle, with the given cost model coefficients
+    (the ones of getGraphsCostModel by default)."""
+    coefs = coefs if coefs else getGraphsCostModel()['coefficients']
+    nVoxels, nCritPoints, nGraphElements = getVesicleCostTerms(nVoxels, nMbVoxels, nSurrVoxels, pixSize, sSig, vDen,
+                                                               vRatio, maxLen, mbNeigh)
+    time = coefs['secPerVoxel'] * nVoxels + coefs['secPerGraphElement'] * (nCritPoints + nGraphElements)
+    memory = coefs['baseBytes'] + coefs['bytesPerVoxel'] * nVoxels + \
+        coefs['bytesPerGraphElement'] * max(nCritPoints, nGraphElements)
+    disk = coefs['diskBytesPerVoxel'] * nVoxels + coefs['diskBytesPerGraphElement'] * nGraphElements
+    disperseDisk = coefs['disperseDiskBytesPerVoxel'] * nVoxels
+    return time, memory, disk, disperseDisk
+
+
+def fitGraphsCostModel(samples):
+    """Fit the graphs cost model coefficients on profiling runs. Each sample is a dict with the cost terms of the
+    vesicle (nVoxels, nCritPoints and nGraphElements, see getVesicleCostTerms) and the measured time (s), peak memory,
+    disk and DisPerSE disk (bytes) of its graphs run. Each quantity is fitted by non-negative least squares on its
+    terms. It returns the coefficients and the coefficient of determination (R²) of each quantity."""
+    from scipy.optimize import nnls
+    nVoxels, nCritPoints, nGraphElements = np.array([[sample['nVoxels'], sample['nCritPoints'],
+                                                      sample['nGraphElements']] for sample in samples], dtype=float).T
+    designs = {'time': [nVoxels, nCritPoints + nGraphElements],
+               'memory': [np.ones_like(nVoxels), nVoxels, np.maximum(nCritPoints, nGraphElements)],
+               'disk': [nVoxels, nGraphElements],
+               'disperseDisk': [nVoxels]}
+    coefs = {}
+    r2 = {}
+    for quantity, columns in designs.items():
+        design = np.column_stack(columns)
+        measured = np.array([sample[quantity] for sample in samples], dtype=float)
+        # Columns normalized so the very different magnitudes of the terms do not affect the solver
+        scale = np.abs(design).max(axis=0)
+        scale[scale == 0] = 1
+        solution, _ = nnls(design / scale, measured)
+        solution /= scale
+        coefs.update(zip(GRAPHS_COST_FIT_TERMS[quantity], solution.tolist()))
+        residual = np.sum((measured - design @ solution) ** 2)
+        total = np.sum((measured - measured.mean()) ** 2)
+        r2[quantity] = float(1 - residual / total) if total > 0 else 1.
+    return coefs, r2
 
 
+def estimateGraphsCost(segFiles, nVesicles, nThreads, pixSize, sSig, vDen, vRatio, maxLen, mbNeigh, nSamples=5):
+    """Estimate the cost of the graphs protocol from a sample of nSamples vesicles evenly spaced over the list of
+    segmentation files. It returns a dictionary with the predicted total time (s), the peak memory per thread
+    (bytes), the output disk usage (bytes), the disk used by the DisPerSE intermediate files (bytes) and the cost
+    model used."""
+    model = getGraphsCostModel()
+    nSamples = min(nSamples, len(segFiles))
+    sampleInds = np.unique(np.linspace(0, len(segFiles) - 1, nSamples).astype(int))
+    costs = np.array([estimateVesicleGraphCost(*getVesicleCostFeatures(segFiles[ind]),
+                                               pixSize, sSig, vDen, vRatio, maxLen, mbNeigh,
+                                               coefs=model['coefficients'])
+                      for ind in sampleInds])
+    times, memories, disks, disperseDisks = costs.T
+    scale = nVesicles / len(sampleInds)
+    nThreads = max(1, nThreads)
+    # The vesicles are distributed among the threads, so the slowest one is a lower bound of the total time
+    return {'nSampled': len(sampleInds),
+            'time': max(scale * times.sum() / nThreads, times.max()),
+            'memoryPerThread': memories.max(),
+            'disk': scale * disks.sum(),
+            'disperseDisk': scale * disperseDisks.sum(),
+            'model': model}
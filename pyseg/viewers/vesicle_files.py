@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+from bisect import bisect_left
+from os.path import join, basename, isdir, exists, getmtime
+
+from pyseg.constants import FILS_FILES, DECIMATED_SUFFIX
+from pyworkflow.utils import makePath, removeExt
+
+FROM_GRAPHS = 0
+FROM_FILS = 1
+FROM_PICKING = 2
+
+# Files displayed for each vesicle: viewer argument, directory relative to the protocol extra path (filaments are
+# stored in one sub-directory per vesicle chunk) and file suffix
+VESICLE_FILES = {
+    FROM_GRAPHS: [('graph_file', '', '_edges_2.vtp')],
+    FROM_FILS: [('net_file', join(FILS_FILES, '*'), '_net.vtp')],
+    FROM_PICKING: [('peaks_file', '', '_peak.vtp'),
+                   ('surf_file', '', '_surf.vtp')]
+}
+# Meshes which may be displayed decimated
+DECIMABLE_FILES = ['graph_file', 'net_file']
+
+_indexCache = {}  # (protocol extra path, source): (protocol end time, index)
+
+
+class VesicleFilesIndex:
+    """ Map each vesicle to the files displayed by the vesicle viewer. Each output directory is listed only once,
+    instead of globbing it each time a vesicle is displayed. """
+
+    def __init__(self, prot, source):
+        self._entries = {}  # Viewer argument: (file suffix, sorted list of (file base name, file path))
+        for argName, relDir, suffix in VESICLE_FILES.get(source, []):
+            entries = []
+            for fDir in _expandDir(prot._getExtraPath(), relDir):
+                with os.scandir(fDir) as it:
+                    entries += [(entry.name, entry.path) for entry in it
+                                if entry.name.endswith(suffix) and entry.is_file()]
+            self._entries[argName] = (suffix, sorted(entries))
+
+    def getFiles(self, vesicleBaseName):
+        """ Return a dict {viewer argument: file} with the files whose name start with the vesicle base name. If there
+        are several, the one named as the vesicle is preferred (e. g. vesicle_1 and vesicle_10), and then the first one
+        in alphabetical order. The arguments with no file found are not included. """
+        files = {}
+        for argName, (suffix, entries) in self._entries.items():
+            ind = bisect_left(entries, (vesicleBaseName,))
+            matches = []
+            while ind < len(entries) and entries[ind][0].startswith(vesicleBaseName):
+                matches.append(entries[ind])
+                ind += 1
+            if matches:
+                exact = [fPath for fName, fPath in matches if fName == vesicleBaseName + suffix]
+                files[argName] = exact[0] if exact else matches[0][1]
+        return files
+
+
+def getVesicleFilesIndex(prot, source):
+    """ Get the vesicle files index of a protocol, built once and rebuilt only if the protocol has been executed again.
+    """
+    key = (prot._getExtraPath(), source)
+    endTime = prot.endTime.get()
+    cached = _indexCache.get(key)
+    if cached and cached[0] == endTime:
+        return cached[1]
+    index = VesicleFilesIndex(prot, source)
+    _indexCache[key] = (endTime, index)
+    return index
+
+
+def getDecimatedFile(vtpFile, maxCells, outDir):
+    """ Return a decimated copy of the given mesh if it has more than maxCells cells, or the mesh itself otherwise. The
+    decimated copy is written in outDir and reused while it is newer than the mesh. Quadric clustering is used because,
+    unlike the decimation of triangle meshes, it also simplifies the lines of the graphs and filaments. """
+    outFile = join(outDir, '%s%s%i.vtp' % (removeExt(basename(vtpFile)), DECIMATED_SUFFIX, maxCells))
+    if exists(outFile) and getmtime(outFile) >= getmtime(vtpFile):
+        return outFile
+
+    # VTK is only loaded when a mesh has to be decimated
+    import vtk
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(vtpFile)
+    reader.Update()
+    mesh = reader.GetOutput()
+    if not maxCells or mesh.GetNumberOfCells() <= maxCells:
+        return vtpFile
+
+    # Coarsen the clustering grid until the decimated mesh fits in the cells budget
+    decimated = mesh
+    nDivisions = 512
+    while decimated.GetNumberOfCells() > maxCells and nDivisions >= 8:
+        decimator = vtk.vtkQuadricClustering()
+        decimator.SetInputData(mesh)
+        decimator.SetNumberOfDivisions(nDivisions, nDivisions, nDivisions)
+        decimator.AutoAdjustNumberOfDivisionsOff()
+        decimator.Update()
+        decimated = decimator.GetOutput()
+        nDivisions //= 2
+
+    makePath(outDir)
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(outFile)
+    writer.SetInputData(decimated)
+    writer.Write()
+    print('%s decimated from %i to %i cells' % (basename(vtpFile), mesh.GetNumberOfCells(),
+                                                decimated.GetNumberOfCells()))
+    return outFile
+
+
+# ---- UTIL functions ----
+def _expandDir(baseDir, relDir):
+    """ List the existing directories matching relDir (only a trailing '*' is expanded) in baseDir. """
+    if relDir.endswith('*'):
+        parentDir = join(baseDir, relDir[:-1])
+        if not isdir(parentDir):
+            return []
+        with os.scandir(parentDir) as it:
+            return sorted(entry.path for entry in it if entry.is_dir())
+    fDir = join(baseDir, relDir)
+    return [fDir] if isdir(fDir) else []
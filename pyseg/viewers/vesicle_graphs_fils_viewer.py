@@ -23,18 +23,13 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import glob
 from os.path import join
 
-from pyseg.constants import FILS_FILES
-from pyworkflow.gui.dialog import ToolbarListDialog
+from pyseg import Plugin
+from pyseg.viewers.vesicle_files import getVesicleFilesIndex, getDecimatedFile, DECIMABLE_FILES
+from pyworkflow.gui.dialog import ToolbarListDialog, ToolbarButton
+from pyworkflow.utils import Icon
 from pyworkflow.utils.path import removeBaseExt
-from tomoviz.viewers.viewer_vtk import VtkPlot
-from tomoviz.viewers.viewer_triangulations import guiThread
-
-FROM_GRAPHS = 0
-FROM_FILS = 1
-FROM_PICKING = 2
 
 
 class VesicleViewerDialog(ToolbarListDialog):
@@ -47,24 +42,41 @@ class VesicleViewerDialog(ToolbarListDialog):
         self.provider = kwargs.get("provider", None)
         self.prot = kwargs.get('prot', None)
         self.source = kwargs.get('source', None)
+        toolbarButtons = None
+        if self.provider and self.provider.getNumberOfPages() > 1:
+            toolbarButtons = [ToolbarButton('Previous', self._previousPage, Icon.ACTION_FIND_PREVIOUS,
+                                            tooltip='Previous page of vesicles'),
+                              ToolbarButton('Next', self._nextPage, Icon.ACTION_FIND_NEXT,
+                                            tooltip='Next page of vesicles')]
         ToolbarListDialog.__init__(self, parent,
                                    "Vesicle Visualization Object Manager",
                                    allowsEmptySelection=False,
                                    itemDoubleClick=self.launchVesicleViewer,
                                    allowSelect=False,
+                                   toolbarButtons=toolbarButtons,
                                    **kwargs)
 
+    def _previousPage(self, e=None):
+        if self.provider.setPage(self.provider.getPage() - 1):
+            self.refresh()
+
+    def _nextPage(self, e=None):
+        if self.provider.setPage(self.provider.getPage() + 1):
+            self.refresh()
+
     def launchVesicleViewer(self, vesicle):
+        # VTK is only loaded when a vesicle is displayed
+        from tomoviz.viewers.viewer_vtk import VtkPlot
+        from tomoviz.viewers.viewer_triangulations import guiThread
         print("\n==> Running Vesicle Viewer:")
         vesicleBaseName = removeBaseExt(vesicle.getFileName())
         vtiName = join(self.vtiPath, vesicleBaseName + '.vti')
         args = {'vti_file': vtiName}
-        if self.source == FROM_GRAPHS:
-            args['graph_file'] = glob.glob(self.prot._getExtraPath(vesicleBaseName + '*_edges_2.vtp'))[0]
-        elif self.source == FROM_FILS:
-            args['net_file'] = glob.glob(self.prot._getExtraPath(FILS_FILES, '*', vesicleBaseName + '*_net.vtp'))[0]
-        elif self.source == FROM_PICKING:
-            args['peaks_file'] = glob.glob(self.prot._getExtraPath(vesicleBaseName + '*_peak.vtp'))[0]
-            args['surf_file'] = glob.glob(self.prot._getExtraPath(vesicleBaseName + '*_surf.vtp'))[0]
+        args.update(getVesicleFilesIndex(self.prot, self.source).getFiles(vesicleBaseName))
+        maxCells = Plugin.getViewerMaxCells()
+        if maxCells:
+            for argName in DECIMABLE_FILES:
+                if argName in args:
+                    args[argName] = getDecimatedFile(args[argName], maxCells, self.prot._getTmpPath())
 
         guiThread(VtkPlot, 'initializePlot', **args)
@@ -24,17 +24,43 @@
 # *  e-mail address 'you@yourinstitution.email'
 # *
 # **************************************************************************
-from os.path import join, isfile
+from math import ceil
 
+from pyseg.constants import VESICLES_PAGE_SIZE
 from pyworkflow.utils import removeBaseExt
 from tomo.viewers.views_tkinter_tree import TomogramsTreeProvider
 
 
 class VesicleViewerProvider(TomogramsTreeProvider):
+    """ Populate the tree with the vesicles of a set, one page at a time. Only the vesicles of the current page are
+    read from the set. """
+
+    def __init__(self, vesicleSet, pageSize=VESICLES_PAGE_SIZE):
+        TomogramsTreeProvider.__init__(self, vesicleSet, None, None)
+        self._pageSize = pageSize
+        self._page = 0
+
+    def getNumberOfPages(self):
+        return max(ceil(self.tomoList.getSize() / self._pageSize), 1)
+
+    def getPage(self):
+        return self._page
+
+    def setPage(self, page):
+        """ Set the current page, returning False if it does not exist. """
+        if 0 <= page < self.getNumberOfPages():
+            self._page = page
+            return True
+        return False
+
+    def getObjects(self):
+        return [vesicle.clone() for vesicle in
+                self.tomoList.iterItems(limit=(self._pageSize, self._page * self._pageSize))]
 
     def getObjectInfo(self, inVesicle):
         vesicleName = removeBaseExt(inVesicle.getFileName())
         return {'key': vesicleName, 'parent': None}
 
     def getColumns(self):
-        return [('Vesicle', 400)]
+        nPages = self.getNumberOfPages()
+        return [('Vesicle' if nPages == 1 else 'Vesicle (%i per page, %i pages)' % (self._pageSize, nPages), 400)]
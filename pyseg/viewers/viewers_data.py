@@ -27,7 +27,8 @@
 import pyworkflow.viewer as pwviewer
 import pwem.viewers.views as vi
 
-from .vesicle_graphs_fils_viewer import VesicleViewerDialog, FROM_GRAPHS, FROM_FILS, FROM_PICKING
+from .vesicle_files import FROM_GRAPHS, FROM_FILS, FROM_PICKING
+from .vesicle_graphs_fils_viewer import VesicleViewerDialog
 from .vesicle_visualization_tree import VesicleViewerProvider
 from ..protocols import ProtPySegGraphs, ProtPySegFils, ProtPySegPicking
 
@@ -65,8 +66,8 @@ class TomoViz4PysegDataViewer(pwviewer.Viewer):
             vtiPath = obj.inFilsProt.get().inGraphsProt.get()._getExtraPath()
             vesicleSubTomos = obj.inFilsProt.get().inGraphsProt.get().inSegProt.get().vesicles
 
-        vesicleList = [vesicle.clone() for vesicle in vesicleSubTomos.iterItems()]
-        vesicleProvider = VesicleViewerProvider(vesicleList, None, None)
+        # The vesicles are read page by page when listed
+        vesicleProvider = VesicleViewerProvider(vesicleSubTomos)
 
         if issubclass(cls, ProtPySegGraphs):
             VesicleViewerDialog(self._tkRoot, vtiPath=vtiPath, provider=vesicleProvider,
@@ -24,8 +24,13 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+from datetime import timedelta
 from pwem.wizards import EmWizard
 from pyseg.protocols import ProtPySegGraphs
+from pyseg.protocols.protocol_pre_seg import outputObjects as presegOutputObjects
+from pyseg.utils import estimateGraphsCost, describeGraphsCostModel
+from pyworkflow.gui.dialog import showInfo
+from pyworkflow.utils import prettySize, prettyDelta
 
 
 class PysegGraphsDistanceToMbWizard(EmWizard):
@@ -41,3 +46,47 @@ class PysegGraphsDistanceToMbWizard(EmWizard):
             return
 
         form.setVar(self.maxLenParamName, presegProt.sgMembNeigh.get())
+
+
+class PysegGraphsCostEstimationWizard(EmWizard):
+    """Estimate the execution time, the memory and the disk required by the graphs protocol for the current
+    parameters before launching it, using a sample of the vesicles generated by the pre-segmentation."""
+    _targets = [(ProtPySegGraphs, ['sSig'])]
+
+    def show(self, form):
+        pysegGraphsProt = form.protocol
+        presegProt = pysegGraphsProt.inSegProt.get()
+        segmentations = getattr(presegProt, presegOutputObjects.segmentations.name, None) if presegProt else None
+        if not segmentations:
+            print('A finished pre-segmentation protocol is required to estimate the graphs protocol cost.')
+            return
+
+        mbNeigh = presegProt.sgMembNeigh.get() / 10  # In nm
+        maxLen = pysegGraphsProt.maxLen.get()
+        maxLen = maxLen / 10 if maxLen else mbNeigh  # In nm
+        nThreads = pysegGraphsProt.numberOfThreads.get()
+        segFiles = [tomoMask.getFileName() for tomoMask in segmentations]
+        cost = estimateGraphsCost(segFiles,
+                                  len(segFiles),
+                                  nThreads,
+                                  segmentations.getSamplingRate() / 10,  # In nm
+                                  pysegGraphsProt.sSig.get(),
+                                  pysegGraphsProt.vDen.get(),
+                                  pysegGraphsProt.vRatio.get(),
+                                  maxLen,
+                                  mbNeigh)
+        msg = 'Estimation based on %i of %i vesicles using %i threads:\n\n' \
+              '\t- Total execution time: %s\n' \
+              '\t- Peak memory per thread: %s\n' \
+              '\t- Disk used by the outputs: %s\n' \
+              '\t- Disk used by DisPerSE intermediate files: %s%s\n\n' \
+              'Cost model: %s.\n\n' \
+              'Higher sigma or lower vertex density values will reduce the cost.' % \
+              (cost['nSampled'], len(segFiles), nThreads,
+               prettyDelta(timedelta(seconds=int(cost['time']))),
+               prettySize(cost['memoryPerThread']),
+               prettySize(cost['disk']),
+               prettySize(cost['disperseDisk']),
+               '' if pysegGraphsProt.keepOnlyReqFiles.get() else ' (kept)',
+               describeGraphsCostModel(cost['model']))
+        showInfo('Graphs cost estimation', msg, form.root)
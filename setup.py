@@ -40,7 +40,7 @@ setup(
         'pyworkflow.plugin': 'pyseg = pyseg'
     },
     package_data={  # Optional
-        'pyseg': ['icon.png', 'protocols.conf'],
+        'pyseg': ['icon.png', 'protocols.conf', 'pyseg_env.yml', 'tests/perf_baseline.json'],
     },
     # For a list of valid classifiers, see
     # https://pypi.python.org/pypi?%3Aaction=list_classifiers